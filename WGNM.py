@@ -10,18 +10,31 @@ This is a mostly feature-equivalent translation of the original
 `setup-wg.sh` Bash script.
 """
 
+import concurrent.futures
+import ctypes
+import functools
 import hashlib
+import http.client
 import json
+import mmap
 import os
 import re
+import select
 import shlex
+import shutil
+import signal
+import socket
 import sqlite3
+import struct
 import subprocess
 import sys
 import time
 import threading
+import urllib.request
+import zipfile
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlsplit
 
 
 # Colors
@@ -31,14 +44,148 @@ YELLOW = "\033[1;33m"
 BLUE = "\033[0;34m"
 NC = "\033[0m"
 
+# Cursor home + clear screen + clear scrollback (what `clear` prints)
+CLEAR_SCREEN = "\033[H\033[2J\033[3J"
+
+
+NETNS_RUN_DIR = "/var/run/netns"
+CLONE_NEWNET = 0x40000000
+_LIBC: Optional[ctypes.CDLL] = None
+
+
+def _libc() -> ctypes.CDLL:
+    """Return the process' libc for syscalls the os module lacks."""
+    global _LIBC
+    if _LIBC is None:
+        _LIBC = ctypes.CDLL(None, use_errno=True)
+    return _LIBC
+
+
+def _netns_enter_fn(ns_fd: int):
+    """Return a function that moves the calling thread into the netns behind `ns_fd`.
+
+    Python 3.12+ has os.setns; older versions call libc setns() via ctypes.
+    libc is resolved here, before the call, so the returned function only
+    makes the syscall.
+    """
+    if hasattr(os, "setns"):
+        return lambda: os.setns(ns_fd, CLONE_NEWNET)
+
+    libc_setns = _libc().setns
+
+    def _enter() -> None:
+        if libc_setns(ns_fd, CLONE_NEWNET) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    return _enter
+
+
+def _call_in_netns(ns: str, fn):
+    """Run `fn()` with the network namespace of `ns` and return its result.
+
+    A throwaway thread enters the namespace, calls `fn` and exits, so the
+    calling thread never changes namespace. Sockets created and /proc/net
+    files opened by `fn` stay bound to `ns`, as do processes it spawns. An
+    exception from entering the namespace or from `fn` is re-raised in the
+    caller.
+    """
+    ns_fd = os.open(os.path.join(NETNS_RUN_DIR, ns), os.O_RDONLY | os.O_CLOEXEC)
+    result: List = []
+
+    def _worker() -> None:
+        try:
+            _netns_enter_fn(ns_fd)()
+            result.append(fn())
+        except Exception as e:
+            result.append(e)
+
+    try:
+        worker = threading.Thread(target=_worker, daemon=True)
+        worker.start()
+        worker.join()
+    finally:
+        os.close(ns_fd)
+    if isinstance(result[0], Exception):
+        raise result[0]
+    return result[0]
+
+
+def _output_kwargs(capture_output: bool, discard: bool) -> Dict:
+    """subprocess.run() keyword arguments for the requested output handling.
+
+    `discard` sends stdout/stderr to /dev/null, skipping the pipes and the
+    decoding of output nobody reads.
+    """
+    if discard:
+        return {"stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+    return {"capture_output": capture_output}
+
+
+def run_in_netns(
+    ns: str,
+    args: List[str],
+    check: bool = False,
+    capture_output: bool = True,
+    input: Optional[str] = None,
+    discard: bool = False,
+) -> subprocess.CompletedProcess:
+    """Run an argv list inside a network namespace without `ip netns exec`.
+
+    The child is spawned from a throwaway thread that has entered the
+    namespace (see _call_in_netns); a setns() preexec_fn is not safe while
+    other threads (restore pool, watchers) are running. The namespace file
+    is opened for the duration of the call only; keeping the fd cached
+    would pin the namespace alive after `ip netns delete`. Unlike `ip netns
+    exec`, /etc/netns/<ns>/resolv.conf is not bind-mounted, so commands that
+    need the namespace's DNS config must go through the shell branch of
+    run_cmd. Falls back to `ip netns exec` if the namespace cannot be
+    entered, so errors are reported the same way as before.
+    """
+    spawned = []
+
+    def _run() -> subprocess.CompletedProcess:
+        spawned.append(True)
+        try:
+            return subprocess.run(
+                args,
+                check=check,
+                input=input,
+                text=True,
+                **_output_kwargs(capture_output, discard),
+            )
+        except FileNotFoundError as e:
+            # Same outcome as `ip netns exec` with a missing binary
+            if check:
+                raise
+            return subprocess.CompletedProcess(args, 127, "", f"{e}\n")
+
+    try:
+        return _call_in_netns(ns, _run)
+    except OSError:
+        if spawned:
+            raise
+    return subprocess.run(
+        ["ip", "netns", "exec", ns] + args,
+        check=check,
+        input=input,
+        text=True,
+        **_output_kwargs(capture_output, discard),
+    )
+
 
 def run_cmd(
     cmd: str,
     check: bool = False,
     capture_output: bool = True,
     ns: Optional[str] = None,
+    discard: bool = False,
 ) -> subprocess.CompletedProcess:
-    """Run a shell command, optionally inside a network namespace."""
+    """Run a shell command, optionally inside a network namespace.
+
+    With `discard` the output goes to /dev/null instead of being captured;
+    use it for calls whose result is only the return code.
+    """
     if ns:
         # For commands with pipes or complex shell operations, use shell=True
         # but wrap in ip netns exec for security
@@ -49,18 +196,17 @@ def run_cmd(
                 full_cmd,
                 shell=True,
                 check=check,
-                capture_output=capture_output,
                 text=True,
+                **_output_kwargs(capture_output, discard),
             )
         else:
-            # Simple command - use list format for better security
-            cmd_parts = shlex.split(cmd)
-            full_cmd_list = ["ip", "netns", "exec", ns] + cmd_parts
-            return subprocess.run(
-                full_cmd_list,
+            # Simple command - enter the namespace with setns() directly
+            return run_in_netns(
+                ns,
+                shlex.split(cmd),
                 check=check,
                 capture_output=capture_output,
-                text=True,
+                discard=discard,
             )
     else:
         # For commands without namespace, use shell for compatibility
@@ -68,9 +214,638 @@ def run_cmd(
             cmd,
             shell=True,
             check=check,
-            capture_output=capture_output,
             text=True,
+            **_output_kwargs(capture_output, discard),
+        )
+
+
+def run_argv(
+    argv: List[str],
+    check: bool = False,
+    capture_output: bool = True,
+    ns: Optional[str] = None,
+    input: Optional[str] = None,
+    discard: bool = False,
+) -> subprocess.CompletedProcess:
+    """Run an argv list directly, optionally inside a network namespace.
+
+    Unlike run_cmd no `/bin/sh -c` is spawned; prefer this for anything that
+    does not need pipes or redirection.
+    """
+    if ns:
+        return run_in_netns(
+            ns, argv, check=check, capture_output=capture_output,
+            input=input, discard=discard,
+        )
+    try:
+        return subprocess.run(
+            argv,
+            check=check,
+            input=input,
+            text=True,
+            **_output_kwargs(capture_output, discard),
+        )
+    except FileNotFoundError as e:
+        # Same outcome as the shell reporting a missing binary
+        if check:
+            raise
+        return subprocess.CompletedProcess(argv, 127, "", f"{e}\n")
+
+
+def run_ip_batch(
+    commands: List[str],
+    ns: Optional[str] = None,
+    force: bool = True,
+    discard: bool = False,
+) -> subprocess.CompletedProcess:
+    """Run several `ip` sub-commands through one `ip -batch -` process.
+
+    Each entry is an `ip` command line without the leading `ip`, e.g.
+    "link set lo up". With `ns` the batch is executed inside that namespace
+    via `ip -n`. With `force` (default) ip keeps going after a failing line;
+    without it ip stops at the first error. Either way the return code is
+    non-zero if any line failed. With `discard` ip's output is not captured.
+    """
+    cmd = ["ip"]
+    if ns:
+        cmd += ["-n", ns]
+    if force:
+        cmd.append("-force")
+    cmd += ["-batch", "-"]
+    return subprocess.run(
+        cmd,
+        input="\n".join(commands) + "\n",
+        text=True,
+        **_output_kwargs(True, discard),
+    )
+
+
+# Serializes our own iptables-save/iptables-restore calls: concurrent
+# restores would otherwise fail on the xtables lock (and `-w` is not
+# supported by older iptables-restore versions)
+IPTABLES_LOCK = threading.RLock()
+
+
+def run_iptables_restore(
+    rules: List[Tuple[str, str]],
+    ns: Optional[str] = None,
+) -> subprocess.CompletedProcess:
+    """Apply (table, rule) pairs in a single `iptables-restore --noflush` call.
+
+    Rules are written the way they would be passed to `iptables -t <table>`,
+    e.g. ("nat", "-A POSTROUTING -o wg0 -j MASQUERADE"). Rules of one table
+    are committed atomically, in the given order.
+    """
+    tables: Dict[str, List[str]] = {}
+    for table, rule in rules:
+        tables.setdefault(table, []).append(rule)
+    payload = "".join(
+        f"*{table}\n" + "\n".join(lines) + "\nCOMMIT\n"
+        for table, lines in tables.items()
+    )
+    cmd = ["iptables-restore", "--noflush"]
+    with IPTABLES_LOCK:
+        if ns:
+            return run_in_netns(ns, cmd, input=payload)
+        return subprocess.run(cmd, input=payload, capture_output=True, text=True)
+
+
+def _iptables_rule_key(rule: str) -> Tuple[str, Tuple[Tuple[str, ...], ...]]:
+    """Normalize a rule so our spelling compares equal to `iptables-save` output.
+
+    iptables-save reorders options, adds implicit `-m tcp`/`-m udp` matches
+    and appends `/32` to bare addresses, so compare chain + the sorted
+    (option, values...) groups. Each value stays with its option, so
+    `-s A -d B` and `-s B -d A` differ. The default LOG level (4) is not
+    saved either, so it is dropped.
+    """
+    tokens = shlex.split(rule)
+    chain, rest = tokens[1], tokens[2:]
+    if tokens[0] == "-I" and rest and rest[0].isdigit():
+        rest = rest[1:]
+    groups: List[List[str]] = []
+    negate = False
+    for tok in rest:
+        if tok == "!":
+            negate = True
+        elif tok.startswith("-"):
+            groups.append([f"! {tok}" if negate else tok])
+            negate = False
+        elif groups:
+            groups[-1].append(tok)
+        else:
+            raise ValueError(f"value without option in rule: {rule!r}")
+    normalized: List[Tuple[str, ...]] = []
+    for opt, *values in groups:
+        if opt == "-m" and values in (["tcp"], ["udp"]):
+            continue
+        if opt == "--log-level" and values in (["4"], ["warning"]):
+            continue
+        if opt.lstrip("! ") in ("-s", "-d") and len(values) == 1 and "/" not in values[0]:
+            values = [f"{values[0]}/32"]
+        normalized.append((opt, *values))
+    return chain, tuple(sorted(normalized))
+
+
+def _is_head_insert(rule: str) -> bool:
+    """True for `-I <chain>` rules that insert at position 1."""
+    tokens = rule.split(None, 3)
+    return tokens[0] == "-I" and (len(tokens) < 3 or not tokens[2].isdigit() or tokens[2] == "1")
+
+
+def _saved_iptables_rules(ns: Optional[str] = None) -> List[Tuple[str, str, Tuple]]:
+    """(table, `-A` line, rule key) for each rule of one `iptables-save`, in chain order."""
+    if ns:
+        res = run_in_netns(ns, ["iptables-save"])
+    else:
+        res = subprocess.run(["iptables-save"], capture_output=True, text=True)
+    saved: List[Tuple[str, str, Tuple]] = []
+    table = ""
+    for line in res.stdout.splitlines():
+        if line.startswith("*"):
+            table = line[1:].strip()
+        elif line.startswith("-A "):
+            try:
+                saved.append((table, line, _iptables_rule_key(line)))
+            except ValueError:
+                continue
+    return saved
+
+
+def _installed_iptables_rules(
+    rules: List[Tuple[str, str]],
+    saved: List[Tuple[str, str, Tuple]],
+) -> Dict[Tuple, List[Tuple[str, str]]]:
+    """Map (table, rule key) -> `-D` lines for every installed copy of `rules`.
+
+    Uses one `iptables-save` snapshot instead of probing rule by rule, and
+    deletes using the saved spelling so iptables-restore always matches.
+    """
+    installed: Dict[Tuple, List[Tuple[str, str]]] = {
+        (table, _iptables_rule_key(rule)): [] for table, rule in rules
+    }
+    for table, line, key in saved:
+        copies = installed.get((table, key))
+        if copies is not None:
+            copies.append((table, "-D " + line[3:]))
+    return installed
+
+
+def _existing_iptables_rules(
+    rules: List[Tuple[str, str]],
+    ns: Optional[str] = None,
+) -> List[Tuple[str, str]]:
+    """Return `-D` lines for every installed copy of the given rules."""
+    installed = _installed_iptables_rules(rules, _saved_iptables_rules(ns))
+    return [d for copies in installed.values() for d in copies]
+
+
+def iptables_replace_rules(
+    rules: List[Tuple[str, str]],
+    ns: Optional[str] = None,
+) -> subprocess.CompletedProcess:
+    """Make sure each rule is installed exactly once.
+
+    Same end state as the `iptables -D ... || true; iptables -A ...` pairs
+    used to keep setups idempotent, but diffed against one iptables-save:
+    rules already present once are left alone, missing or duplicated ones
+    are (re)added in one iptables-restore, and nothing runs if all match.
+    `-I <chain> 1` rules must also still head their chain, in the order
+    inserting them leaves them; otherwise they are moved back to the top,
+    above DROP/REJECT rules added later (e.g. by docker or ufw).
+    """
+    with IPTABLES_LOCK:
+        saved = _saved_iptables_rules(ns)
+        installed = _installed_iptables_rules(rules, saved)
+        chains: Dict[Tuple[str, str], List[Tuple]] = {}
+        for table, _, key in saved:
+            chains.setdefault((table, key[0]), []).append(key)
+        # Expected top of each chain: the last rule inserted ends up first
+        heads: Dict[Tuple[str, str], List[Tuple]] = {}
+        for table, rule in rules:
+            if _is_head_insert(rule):
+                key = _iptables_rule_key(rule)
+                heads.setdefault((table, key[0]), []).insert(0, key)
+        displaced = {
+            chain for chain, head in heads.items()
+            if chains.get(chain, [])[:len(head)] != head
+        }
+        changes: List[Tuple[str, str]] = []
+        additions: List[Tuple[str, str]] = []
+        for table, rule in rules:
+            key = _iptables_rule_key(rule)
+            copies = installed.pop((table, key), None)
+            if copies is None:
+                continue
+            if len(copies) != 1 or (_is_head_insert(rule) and (table, key[0]) in displaced):
+                changes += copies
+                additions.append((table, rule))
+        if not additions:
+            return subprocess.CompletedProcess(["iptables-restore"], 0, "", "")
+        return run_iptables_restore(changes + additions, ns=ns)
+
+
+def iptables_delete_rules(
+    rules: List[Tuple[str, str]],
+    ns: Optional[str] = None,
+) -> Optional[subprocess.CompletedProcess]:
+    """Delete every installed copy of the given rules; missing ones are fine.
+
+    Replaces runs of `iptables -D ... 2>/dev/null || true` with one
+    iptables-save and, only if something matched, one iptables-restore.
+    Returns None when there was nothing to delete.
+    """
+    with IPTABLES_LOCK:
+        deletions = _existing_iptables_rules(rules, ns)
+        if not deletions:
+            return None
+        return run_iptables_restore(deletions, ns=ns)
+
+
+# ((st_ino, st_mtime_ns) of NETNS_RUN_DIR, its entries) from the last listing
+_NETNS_CACHE: Optional[Tuple[Tuple[int, int], frozenset]] = None
+# A listing is only reused if the directory was last modified at least this
+# long ago; within that window a second add/delete may not move the
+# (coarse-grained) mtime, so the directory is read again
+NETNS_CACHE_MIN_AGE = 1.0
+
+
+def _get_existing_netns() -> Set[str]:
+    """Return the names of all named network namespaces.
+
+    Reads the directory `ip netns list` reads, without spawning ip + awk.
+    Menu actions call this several times in a row, so the listing is reused
+    until the directory changes: `ip netns add/delete` updates its mtime,
+    which makes invalidation automatic.
+    """
+    global _NETNS_CACHE
+    try:
+        st = os.stat(NETNS_RUN_DIR)
+        key = (st.st_ino, st.st_mtime_ns)
+        if _NETNS_CACHE is not None and _NETNS_CACHE[0] == key:
+            return set(_NETNS_CACHE[1])
+        names = os.listdir(NETNS_RUN_DIR)
+    except OSError:
+        _NETNS_CACHE = None
+        return set()
+    if time.time() - st.st_mtime >= NETNS_CACHE_MIN_AGE:
+        _NETNS_CACHE = (key, frozenset(names))
+    else:
+        _NETNS_CACHE = None
+    return set(names)
+
+
+# rtnetlink constants (linux/netlink.h, linux/rtnetlink.h, linux/if_addr.h,
+# linux/if_link.h)
+RTM_GETLINK = 18
+RTM_GETADDR = 22
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFLA_IFNAME = 3
+IFLA_OPERSTATE = 16
+NLMSG_HDR = struct.Struct("=IHHII")
+IFADDRMSG = struct.Struct("=BBBBI")
+IFINFOMSG = struct.Struct("=BxHiII")
+RTATTR = struct.Struct("=HH")
+# Attribute type bits; NLA_F_NESTED / NLA_F_NET_BYTEORDER sit above them
+NLA_TYPE_MASK = 0x3FFF
+# IF_OPER_* values, named the way `ip link` prints them
+OPERSTATE_NAMES = ("UNKNOWN", "NOTPRESENT", "DOWN", "LOWERLAYERDOWN", "TESTING", "DORMANT", "UP")
+
+# Tunnel-side veth addresses are 10.100.X.2
+TUNNEL_IP_PREFIX = "10.100."
+
+DNAT_TARGET_REGEX = re.compile(
+    r"^-A PREROUTING .*--to-destination (\d+\.\d+\.\d+\.\d+):(\d+)"
+)
+
+
+def _netns_socket(ns: str, family: int, type_: int, proto: int = 0) -> socket.socket:
+    """Create a socket that lives in network namespace `ns`."""
+    return _call_in_netns(ns, lambda: socket.socket(family, type_, proto))
+
+
+# st column of /proc/net/tcp{,6} for listening sockets (TCP_LISTEN)
+PROC_TCP_LISTEN = "0A"
+
+
+def _read_listening_tcp_ports() -> Set[int]:
+    """Parse the calling thread's /proc/net/tcp and tcp6 for LISTEN ports."""
+    ports: Set[int] = set()
+    for name in ("tcp", "tcp6"):
+        try:
+            # thread-self: the namespace of this thread, not of the process
+            with open(f"/proc/thread-self/net/{name}") as f:
+                next(f, None)
+                for line in f:
+                    fields = line.split(None, 4)
+                    if len(fields) > 3 and fields[3] == PROC_TCP_LISTEN:
+                        ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+        except FileNotFoundError:
+            continue
+    return ports
+
+
+SS_PID_REGEX = re.compile(r"pid=(\d+)")
+
+
+def get_listening_pids(port: int, ns: Optional[str] = None) -> List[int]:
+    """Return the PIDs of processes listening on TCP `port` (inside `ns`).
+
+    ss filters by port itself (`sport = :PORT`), so there is no shell and
+    no grep/sed; the PIDs are picked out of its output with a regex.
+    """
+    cmd = ["ss", "-tlnp", "sport", "=", f":{port}"]
+    try:
+        if ns:
+            res = run_in_netns(ns, cmd)
+        else:
+            res = subprocess.run(cmd, capture_output=True, text=True)
+    except OSError as e:
+        debug_log(f"get_listening_pids: ss failed: {e!r}")
+        return []
+    return [int(pid) for pid in dict.fromkeys(SS_PID_REGEX.findall(res.stdout or ""))]
+
+
+def get_ns_listening_tcp_ports(ns: str) -> Set[int]:
+    """Return the TCP ports something listens on inside namespace `ns`.
+
+    Reads procfs from inside the namespace instead of running `ss -ltnp |
+    grep` there.
+    """
+    try:
+        return _call_in_netns(ns, _read_listening_tcp_ports)
+    except OSError as e:
+        debug_log(f"get_ns_listening_tcp_ports: cannot read sockets in {ns}: {e!r}")
+        return set()
+
+
+def _netlink_attr_list(data: bytes, pos: int = 0, end: Optional[int] = None) -> List[Tuple[int, bytes]]:
+    """Parse netlink attributes in data[pos:end] into ordered (type, payload) pairs.
+
+    Nested arrays (e.g. WireGuard peers) repeat the same type, so they must
+    be walked as a list rather than looked up by type.
+    """
+    if end is None:
+        end = len(data)
+    attrs = []
+    while pos + RTATTR.size <= end:
+        rta_len, rta_type = RTATTR.unpack_from(data, pos)
+        if rta_len < RTATTR.size:
+            break
+        attrs.append((rta_type & NLA_TYPE_MASK, data[pos + RTATTR.size:pos + rta_len]))
+        pos += (rta_len + 3) & ~3
+    return attrs
+
+
+def _netlink_attrs(data: bytes, pos: int = 0, end: Optional[int] = None) -> Dict[int, bytes]:
+    """Parse netlink attributes in data[pos:end] into {type: payload}."""
+    return dict(_netlink_attr_list(data, pos, end))
+
+
+def _netlink_dump(
+    ns: str,
+    msg_type: int,
+    payload: bytes,
+    proto: int = socket.NETLINK_ROUTE,
+    flags: int = NLM_F_REQUEST | NLM_F_DUMP,
+    attrs: bytes = b"",
+) -> List[Dict[int, bytes]]:
+    """Run a netlink request (an rtnetlink dump by default) inside `ns`.
+
+    Returns the attributes of each reply message as {rta_type: data}; the
+    fixed header in front of them is assumed to be as long as `payload`.
+    `attrs` are request attributes sent after that header.
+    """
+    replies: List[Dict[int, bytes]] = []
+    sock = _netns_socket(ns, socket.AF_NETLINK, socket.SOCK_RAW, proto)
+    with sock:
+        sock.sendall(
+            NLMSG_HDR.pack(
+                NLMSG_HDR.size + len(payload) + len(attrs),
+                msg_type,
+                flags,
+                1,
+                0,
+            )
+            + payload
+            + attrs
+        )
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSG_HDR.size <= len(data):
+                msg_len, reply_type, _, _, _ = NLMSG_HDR.unpack_from(data, offset)
+                if reply_type in (NLMSG_DONE, NLMSG_ERROR) or msg_len < NLMSG_HDR.size:
+                    return replies
+                replies.append(
+                    _netlink_attrs(data, offset + NLMSG_HDR.size + len(payload), offset + msg_len)
+                )
+                offset += (msg_len + 3) & ~3
+            if not data or not flags & NLM_F_DUMP:
+                return replies
+
+
+def _netlink_attr(attr_type: int, data: bytes) -> bytes:
+    """Encode one netlink attribute, padded to 4 bytes."""
+    attr = RTATTR.pack(RTATTR.size + len(data), attr_type) + data
+    return attr + b"\0" * (-len(attr) % 4)
+
+
+# generic netlink / WireGuard netlink constants (linux/genetlink.h,
+# linux/wireguard.h); the socket module does not export NETLINK_GENERIC
+NETLINK_GENERIC = 16
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+GENLMSGHDR = struct.Struct("=BBxx")
+WG_GENL_NAME = b"wireguard"
+WG_GENL_VERSION = 1
+WG_CMD_GET_DEVICE = 0
+WGDEVICE_A_IFNAME = 2
+WGDEVICE_A_PEERS = 8
+WGPEER_A_LAST_HANDSHAKE_TIME = 6
+KERNEL_TIMESPEC = struct.Struct("=qq")
+
+
+def get_wg_last_handshakes(ns: str, wg_iface: str) -> Optional[List[int]]:
+    """Return each peer's latest handshake (unix seconds, 0 = never).
+
+    Queries the WireGuard generic netlink family from inside `ns`, so
+    polling for a handshake costs no `wg` fork. Returns None when netlink
+    is not usable (old kernel, missing namespace); callers then fall back
+    to `wg show`.
+    """
+    try:
+        family = _netlink_dump(
+            ns, GENL_ID_CTRL, GENLMSGHDR.pack(CTRL_CMD_GETFAMILY, 1),
+            proto=NETLINK_GENERIC, flags=NLM_F_REQUEST,
+            attrs=_netlink_attr(CTRL_ATTR_FAMILY_NAME, WG_GENL_NAME + b"\0"),
+        )
+        family_id = next(
+            (struct.unpack("=H", a[CTRL_ATTR_FAMILY_ID][:2])[0]
+             for a in family if CTRL_ATTR_FAMILY_ID in a),
+            None,
+        )
+        if family_id is None:
+            return None
+        device = _netlink_dump(
+            ns, family_id, GENLMSGHDR.pack(WG_CMD_GET_DEVICE, WG_GENL_VERSION),
+            proto=NETLINK_GENERIC,
+            attrs=_netlink_attr(WGDEVICE_A_IFNAME, wg_iface.encode() + b"\0"),
+        )
+    except OSError as e:
+        debug_log(f"get_wg_last_handshakes: netlink query in {ns} failed: {e!r}")
+        return None
+    handshakes = []
+    # Large devices are split over several replies, each with its own peers
+    for attrs in device:
+        for _, peer in _netlink_attr_list(attrs.get(WGDEVICE_A_PEERS, b"")):
+            raw = _netlink_attrs(peer).get(WGPEER_A_LAST_HANDSHAKE_TIME)
+            if raw and len(raw) >= KERNEL_TIMESPEC.size:
+                handshakes.append(KERNEL_TIMESPEC.unpack_from(raw)[0])
+    return handshakes
+
+
+def get_ns_ipv4_addrs(ns: str) -> List[str]:
+    """Return the IPv4 addresses configured in namespace `ns`.
+
+    One RTM_GETADDR netlink dump replaces the `ip -4 addr show | grep | awk
+    | cut` pipeline that used to run inside the namespace.
+    """
+    addrs = []
+    try:
+        replies = _netlink_dump(ns, RTM_GETADDR, IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0))
+    except OSError as e:
+        debug_log(f"get_ns_ipv4_addrs: cannot open netlink socket in {ns}: {e!r}")
+        return addrs
+    for attrs in replies:
+        # `ip addr` shows IFA_LOCAL when set (peer addresses), else IFA_ADDRESS
+        raw = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+        if raw and len(raw) == 4:
+            addrs.append(socket.inet_ntoa(raw))
+    return addrs
+
+
+def get_ns_link_states(ns: str) -> Dict[str, str]:
+    """Map interface name -> operstate ("UP", "DOWN", "UNKNOWN", ...) in `ns`.
+
+    One RTM_GETLINK dump instead of an `ip link show | grep state` per
+    interface.
+    """
+    states: Dict[str, str] = {}
+    try:
+        replies = _netlink_dump(ns, RTM_GETLINK, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+    except OSError as e:
+        debug_log(f"get_ns_link_states: cannot open netlink socket in {ns}: {e!r}")
+        return states
+    for attrs in replies:
+        name = attrs.get(IFLA_IFNAME)
+        oper = attrs.get(IFLA_OPERSTATE)
+        if not name:
+            continue
+        code = oper[0] if oper else 0
+        states[name.rstrip(b"\0").decode("utf-8", "replace")] = (
+            OPERSTATE_NAMES[code] if code < len(OPERSTATE_NAMES) else "UNKNOWN"
         )
+    return states
+
+
+LINK_STATE_TIMEOUT = 2.0
+LINK_STATE_POLL_INTERVAL = 0.05
+
+
+def wait_for_link_state(ns: str, ifname: str, up: bool, timeout: float = LINK_STATE_TIMEOUT) -> bool:
+    """Poll `ifname` in `ns` until it is up (or down); False on timeout.
+
+    Interfaces without carrier reporting, such as WireGuard, stay UNKNOWN
+    when up, so anything but DOWN counts as up.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        state = get_ns_link_states(ns).get(ifname)
+        if state is not None and (state != "DOWN") == up:
+            return True
+        if time.monotonic() >= deadline:
+            debug_log(f"wait_for_link_state: {ifname} in {ns} still {state} after {timeout}s")
+            return False
+        time.sleep(LINK_STATE_POLL_INTERVAL)
+
+
+# ns name -> ((st_dev, st_ino) of the namespace, its tunnel IP)
+_NS_TUNNEL_IP_CACHE: Dict[str, Tuple[Tuple[int, int], str]] = {}
+
+
+def get_ns_tunnel_ip(ns: str) -> Optional[str]:
+    """Return the 10.100.X.2 address of a tunnel namespace, if any.
+
+    Hits are cached against the namespace's nsfs inode, which changes when
+    the namespace is deleted and recreated, so watcher ticks and repeated
+    lookups cost one stat() instead of a netlink dump.
+    """
+    try:
+        st = os.stat(os.path.join(NETNS_RUN_DIR, ns))
+    except OSError:
+        _NS_TUNNEL_IP_CACHE.pop(ns, None)
+        return None
+    ns_id = (st.st_dev, st.st_ino)
+    cached = _NS_TUNNEL_IP_CACHE.get(ns)
+    if cached is not None and cached[0] == ns_id:
+        return cached[1]
+    for addr in get_ns_ipv4_addrs(ns):
+        if addr.startswith(TUNNEL_IP_PREFIX):
+            _NS_TUNNEL_IP_CACHE[ns] = (ns_id, addr)
+            return addr
+    return None
+
+
+def get_dnat_port_map() -> Dict[str, int]:
+    """Map namespace IP -> tunnel port from the host PREROUTING DNAT rules.
+
+    Parses one `iptables-save -t nat` instead of running `iptables -S | grep
+    | awk` once per namespace. The first rule for an IP wins, as before.
+    """
+    ports: Dict[str, int] = {}
+    try:
+        res = subprocess.run(["iptables-save", "-t", "nat"], capture_output=True, text=True)
+    except OSError as e:
+        debug_log(f"get_dnat_port_map: iptables-save failed: {e!r}")
+        return ports
+    for line in res.stdout.splitlines():
+        m = DNAT_TARGET_REGEX.match(line)
+        if m:
+            ports.setdefault(m.group(1), int(m.group(2)))
+    return ports
+
+
+def get_tunnel_bindings() -> Dict[str, Tuple[str, int]]:
+    """Map each tunnel namespace (ns-<port>) to its (ns_ip, port).
+
+    Namespaces without a 10.100.X.2 address or a matching DNAT rule are
+    skipped. The namespace list and NAT table are each read once.
+    """
+    bindings: Dict[str, Tuple[str, int]] = {}
+    namespaces = sorted(n for n in _get_existing_netns() if n.startswith("ns-"))
+    if not namespaces:
+        return bindings
+    dnat_ports = get_dnat_port_map()
+    for ns in namespaces:
+        # Derive NS IP (10.100.X.2) from interface address
+        ns_ip = get_ns_tunnel_ip(ns)
+        if not ns_ip:
+            debug_log(f"tunnel_bindings: {ns} has no 10.100.x.x IP")
+            continue
+        port = dnat_ports.get(ns_ip)
+        if port is None:
+            debug_log(f"tunnel_bindings: could not infer port for {ns} (ns_ip={ns_ip})")
+            continue
+        bindings[ns] = (ns_ip, port)
+    return bindings
 
 
 def require_root() -> None:
@@ -80,33 +855,53 @@ def require_root() -> None:
         sys.exit(1)
 
 
+# Resolved command paths; only hits are cached since callers install missing
+# packages and then probe again
+COMMAND_PATH_CACHE: Dict[str, str] = {}
+
+
 def command_exists(cmd: str) -> bool:
     """Check if a command exists in the system PATH."""
-    return subprocess.run(
-        ["bash", "-lc", f"command -v {shlex.quote(cmd)} >/dev/null 2>&1"],
-        capture_output=True,
-    ).returncode == 0
+    if cmd in COMMAND_PATH_CACHE:
+        return True
+    path = shutil.which(cmd)
+    if path is None:
+        return False
+    COMMAND_PATH_CACHE[cmd] = path
+    return True
+
+
+def _kernel_module_loaded(name: str) -> bool:
+    """Check /proc/modules for a loaded kernel module (what lsmod reads)."""
+    prefix = name + " "
+    try:
+        with open("/proc/modules") as f:
+            return any(line.startswith(prefix) for line in f)
+    except OSError:
+        return False
+
+
+# Command probed on PATH -> dependency reported when it is missing
+DEPENDENCY_COMMANDS: List[Tuple[str, str]] = [
+    ("wg", "wireguard-tools"),
+    ("ip", "iproute2"),
+    ("iptables", "iptables"),
+    ("curl", "curl"),
+    ("ss", "iproute2"),
+]
 
 
 def check_and_install_dependencies() -> None:
     print(f"{BLUE}Checking dependencies...{NC}")
     missing = []
 
-    if not command_exists("wg"):
-        missing.append("wireguard-tools")
-    if not command_exists("ip"):
-        missing.append("iproute2")
-    if not command_exists("iptables"):
-        missing.append("iptables")
-    if not command_exists("curl"):
-        missing.append("curl")
-    if not command_exists("ss"):
-        missing.append("iproute2")
+    for cmd, dep in DEPENDENCY_COMMANDS:
+        if not command_exists(cmd) and dep not in missing:
+            missing.append(dep)
 
     # WireGuard kernel module
-    lsmod = run_cmd("lsmod | grep -q wireguard", capture_output=False)
-    if lsmod.returncode != 0:
-        modprobe = run_cmd("modprobe wireguard", capture_output=False)
+    if not _kernel_module_loaded("wireguard"):
+        modprobe = run_argv(["modprobe", "wireguard"], capture_output=False)
         if modprobe.returncode != 0:
             missing.append("wireguard-dkms")
 
@@ -123,26 +918,28 @@ def check_and_install_dependencies() -> None:
 
     # Detect package manager
     pkg_manager = None
-    update_cmd = ""
-    install_cmd = ""
+    update_cmd: List[str] = []
+    install_cmd: List[str] = []
+    # `yum/dnf check-update` exit 100 when updates exist; the update return
+    # code is ignored anyway
     if command_exists("apt-get"):
         pkg_manager = "apt-get"
-        update_cmd = "apt-get update"
-        install_cmd = "apt-get install -y"
+        update_cmd = ["apt-get", "update"]
+        install_cmd = ["apt-get", "install", "-y"]
     elif command_exists("yum"):
         pkg_manager = "yum"
-        update_cmd = "yum check-update || true"
-        install_cmd = "yum install -y"
+        update_cmd = ["yum", "check-update"]
+        install_cmd = ["yum", "install", "-y"]
     elif command_exists("dnf"):
         pkg_manager = "dnf"
-        update_cmd = "dnf check-update || true"
-        install_cmd = "dnf install -y"
+        update_cmd = ["dnf", "check-update"]
+        install_cmd = ["dnf", "install", "-y"]
     else:
         print(f"{RED}Could not detect package manager. Please install manually.{NC}")
         sys.exit(1)
 
     print(f"{BLUE}Updating package list...{NC}")
-    run_cmd(update_cmd, capture_output=False)
+    run_argv(update_cmd, capture_output=False)
 
     pkgs_to_install = []
     for dep in missing:
@@ -164,15 +961,13 @@ def check_and_install_dependencies() -> None:
 
     if pkgs_to_install:
         print(f"{BLUE}Installing: {' '.join(pkgs_to_install)}{NC}")
-        res = run_cmd(
-            f"{install_cmd} {' '.join(pkgs_to_install)}", capture_output=False
-        )
+        res = run_argv(install_cmd + pkgs_to_install, capture_output=False)
         if res.returncode != 0:
             print(f"{RED}Installation failed. Please install manually.{NC}")
             sys.exit(1)
 
     # Try to load wireguard again
-    modprobe = run_cmd("modprobe wireguard", capture_output=False)
+    modprobe = run_argv(["modprobe", "wireguard"], capture_output=False)
     if modprobe.returncode != 0:
         print(
             f"{YELLOW}Warning: Could not load wireguard module. You may need to reboot.{NC}"
@@ -189,6 +984,84 @@ def _shorten_path(path: str, max_len: int = 40) -> str:
     return "..." + path[-(max_len - 3) :]
 
 
+# Persistent read-only connection to the panel DB (reopened if the path or
+# the underlying file changes, e.g. when the panel replaces its DB file)
+_PANEL_RO_CONN: Optional[sqlite3.Connection] = None
+_PANEL_RO_KEY: Optional[Tuple[str, int, int]] = None
+_PANEL_RO_LOCK = threading.Lock()
+# (schema_version, {table: columns}) of the tables the UUID scan reads
+_PANEL_RO_SCHEMA: Optional[Tuple[int, Dict[str, List[str]]]] = None
+
+# Pragmas for the panel DB connection: read pages through the OS page cache
+# and give the pager room for the whole users/proxies tables
+PANEL_SCAN_PRAGMAS = (
+    "PRAGMA query_only=1",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def _close_panel_ro_conn() -> None:
+    """Close the cached panel DB connection. Caller must hold _PANEL_RO_LOCK."""
+    global _PANEL_RO_CONN, _PANEL_RO_KEY, _PANEL_RO_SCHEMA
+    if _PANEL_RO_CONN is not None:
+        try:
+            _PANEL_RO_CONN.close()
+        except sqlite3.Error:
+            pass
+    _PANEL_RO_CONN = None
+    _PANEL_RO_KEY = None
+    _PANEL_RO_SCHEMA = None
+
+
+def _get_panel_ro_conn(db_path: str) -> sqlite3.Connection:
+    """Return the shared read-only connection for `db_path`, opening it if needed.
+
+    Caller must hold _PANEL_RO_LOCK while using the connection.
+    """
+    global _PANEL_RO_CONN, _PANEL_RO_KEY
+    st = os.stat(db_path)
+    key = (db_path, st.st_dev, st.st_ino)
+    if _PANEL_RO_CONN is not None and _PANEL_RO_KEY == key:
+        return _PANEL_RO_CONN
+
+    _close_panel_ro_conn()
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    for pragma in PANEL_SCAN_PRAGMAS:
+        conn.execute(pragma)
+    _PANEL_RO_CONN = conn
+    _PANEL_RO_KEY = key
+    debug_log(f"panel_ro_conn: opened {db_path}")
+    return conn
+
+
+def _get_panel_ro_schema(conn: sqlite3.Connection) -> Dict[str, List[str]]:
+    """Return {table: columns} for the panel tables the UUID scan reads.
+
+    Cached until the DB's schema_version changes (e.g. a panel migration),
+    so a refresh tick costs one PRAGMA instead of a sqlite_master query and
+    a table_info per table. Caller must hold _PANEL_RO_LOCK.
+    """
+    global _PANEL_RO_SCHEMA
+    (version,) = conn.execute("PRAGMA schema_version").fetchone()
+    if _PANEL_RO_SCHEMA is not None and _PANEL_RO_SCHEMA[0] == version:
+        return _PANEL_RO_SCHEMA[1]
+    tables = {
+        r[0]
+        for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'"
+        ).fetchall()
+    }
+    schema = {
+        table: [r[1] for r in conn.execute(f'PRAGMA table_info("{table}")').fetchall()]
+        for table in ("proxies", "users")
+        if table in tables
+    }
+    _PANEL_RO_SCHEMA = (version, schema)
+    return schema
+
+
 def _get_current_uuid_count() -> Optional[int]:
     """Return how many UUIDs/users are currently in the panel DB, if possible.
 
@@ -204,49 +1077,55 @@ def _get_current_uuid_count() -> Optional[int]:
 
     # For Marzban, use live COUNT(*) from users table
     if PANEL_PANEL_NAME == "marzban":
-        try:
-            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
-            cur = conn.cursor()
-            cur.execute('SELECT COUNT(*) FROM "users"')
-            (cnt,) = cur.fetchone()
-            conn.close()
-            return int(cnt)
-        except Exception as e:  # pragma: no cover - defensive
-            debug_log(f"header_uuid_count: marzban count(*) failed: {e!r}")
-            return LAST_UUID_COUNT
+        with _PANEL_RO_LOCK:
+            try:
+                conn = _get_panel_ro_conn(db_path)
+                (cnt,) = conn.execute('SELECT COUNT(*) FROM "users"').fetchone()
+                return int(cnt)
+            except Exception as e:  # pragma: no cover - defensive
+                debug_log(f"header_uuid_count: marzban count(*) failed: {e!r}")
+                _close_panel_ro_conn()
+                return LAST_UUID_COUNT
 
     return LAST_UUID_COUNT
 
 
-def show_header() -> None:
-    global UUID_WATCHER_STARTED
-    os.system("clear")
-    print(f"{BLUE}╔════════════════════════════════════════════════════╗{NC}")
-    print(f"{BLUE}║        WireGuard Namespace Manager                 ║{NC}")
-    print(f"{BLUE}╚════════════════════════════════════════════════════╝{NC}")
-    print("Repo: https://github.com/alihm-us/WireGuard-Namespace-Manager\n")
+# Static part of the header, built once; show_header only formats the
+# status lines and writes everything with a single write()
+HEADER_BANNER = (
+    f"{BLUE}╔════════════════════════════════════════════════════╗{NC}\n"
+    f"{BLUE}║        WireGuard Namespace Manager                 ║{NC}\n"
+    f"{BLUE}╚════════════════════════════════════════════════════╝{NC}\n"
+    "Repo: https://github.com/alihm-us/WireGuard-Namespace-Manager\n\n"
+)
+
 
+def show_header() -> None:
     # Panel / UUID status line
     panel = PANEL_PANEL_NAME or "Not set"
     db_path = PANEL_DB_PATH or "N/A"
     uuid_count = _get_current_uuid_count()
 
-    print(f"{YELLOW}Panel:{NC} {panel}")
-    print(f"{YELLOW}DB:{NC}    {_shorten_path(db_path)}")
     if uuid_count is None:
-        print(f"{YELLOW}UUIDs:{NC} N/A (select panel DB in Xray management)")
+        uuid_line = f"{YELLOW}UUIDs:{NC} N/A (select panel DB in Xray management)"
     else:
-        print(f"{YELLOW}UUIDs:{NC} {GREEN}{uuid_count}{NC} loaded from panel DB")
+        uuid_line = f"{YELLOW}UUIDs:{NC} {GREEN}{uuid_count}{NC} loaded from panel DB"
     
     # Display Auto-Refresh Watcher status
-    if UUID_WATCHER_STARTED:
-        config = load_config()
-        interval = config.get("uuid_refresh_interval", 5)
-        watcher_status = f"{GREEN}Active{NC} (refreshing every {interval} seconds)"
+    if UUID_WATCHER_STARTED.is_set():
+        interval = UUID_WATCHER_INTERVAL
+        watcher_status = f"{GREEN}Active{NC} (on panel DB changes, at most every {interval} seconds)"
     else:
         watcher_status = f"{YELLOW}Not started{NC}"
-    print(f"{YELLOW}Auto-Refresh:{NC} {watcher_status}")
-    print()
+
+    sys.stdout.write(
+        f"{CLEAR_SCREEN}{HEADER_BANNER}"
+        f"{YELLOW}Panel:{NC} {panel}\n"
+        f"{YELLOW}DB:{NC}    {_shorten_path(db_path)}\n"
+        f"{uuid_line}\n"
+        f"{YELLOW}Auto-Refresh:{NC} {watcher_status}\n\n"
+    )
+    sys.stdout.flush()
 
 
 GEO_CACHE: Dict[str, str] = {}
@@ -254,17 +1133,66 @@ GEO_CACHE: Dict[str, str] = {}
 # Simple log file for UUID refresh/debug info
 DEBUG_LOG_FILE = "/tmp/setup-wg-watch.log"
 
-# Small state file so we remember chosen panel DB across runs
+# Legacy panel state file; migrated into CONFIG_FILE by load_panel_state
 PANEL_STATE_FILE = "/tmp/setup-wg-panel.state"
 
 # Setup state file to restore tunnels after reboot
 SETUP_STATE_FILE = "/etc/setup-wg-tunnels.state"
 SETUP_STATE_DIR = "/etc/setup-wg"
 
+SETUP_STATE_FILE_REGEX = re.compile(r"^tunnel-(\d+)\.state$")
+
 # Main configuration file
 CONFIG_FILE = "/etc/setup-wg/config.json"
 
 
+def atomic_write(path: str, data: bytes, fsync: bool = False) -> None:
+    """Replace `path` with `data` so readers never see a partial file.
+
+    Writes a temp file next to `path` and renames it over the target. Use
+    `fsync` for files that must survive a crash (not needed under /tmp).
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+TAIL_CHUNK_SIZE = 8192
+
+
+def tail_lines(path: str, n: int) -> List[str]:
+    """Return the last `n` lines of `path` without reading the whole file.
+
+    Reads backwards from the end in TAIL_CHUNK_SIZE blocks until enough
+    newlines were seen. Raises OSError (e.g. FileNotFoundError) like open().
+    """
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        data = b""
+        # n + 1 newlines guarantee n complete lines (the file ends in one)
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(TAIL_CHUNK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.splitlines()
+    if pos > 0:
+        # The first line of the window may be cut off
+        lines = lines[1:]
+    return [line.decode("utf-8", "replace") for line in lines[-n:]] if n > 0 else []
+
+
 def debug_log(message: str) -> None:
     """Append a timestamped debug line to the watcher log."""
     ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
@@ -281,89 +1209,147 @@ PANEL_DB_PATH: Optional[str] = None
 PANEL_PANEL_NAME: Optional[str] = None
 
 # Background watcher state
-UUID_WATCHER_STARTED = False
+UUID_WATCHER_STARTED = threading.Event()
+UUID_WATCHER_INTERVAL = 5  # Interval the in-process watcher runs with
 MARZBAN_LOG_WATCHER_STARTED = False
-UUID_WATCHER_LOCK = threading.Lock()  # Thread safety for watcher
+UUID_WATCHER_LOCK = threading.Lock()  # Serializes watcher startup only
+UUID_WATCHER_STOP = threading.Event()  # Set to end the watcher loops
+UUID_WATCHER_MAX_BACKOFF = 300  # Cap (seconds) for the retry delay after errors
+# Refresh period while inotify reports both DB and tunnel changes; the timer
+# is then only a safety net for missed events
+UUID_WATCHER_SAFETY_INTERVAL = 300
+
+
+def _watcher_delay(interval_seconds: float, consecutive_errors: int) -> float:
+    """Seconds until the next refresh, doubling per consecutive error (capped)."""
+    if not consecutive_errors:
+        return interval_seconds
+    return min(interval_seconds * 2 ** min(consecutive_errors, 5), UUID_WATCHER_MAX_BACKOFF)
 
 # Last known UUID stats (updated whenever we successfully read from panel DB)
 LAST_UUID_COUNT: Optional[int] = None
 LAST_UUID_UPDATE_TS: Optional[float] = None
 LAST_UUID_HASH: Optional[str] = None  # Hash of UUID list to detect changes
+# Tunnel namespaces seen by the last full refresh in this process
+LAST_REFRESH_NAMESPACES: Optional[Set[str]] = None
+# Held for a whole refresh: the watcher thread and the setup thread must not
+# start Xray on the same port or interleave the hash/mtime state writes
+UUID_REFRESH_LOCK = threading.RLock()
 
 # UUID file path (one file per namespace/port)
 UUID_FILE_DIR = "/tmp/setup-wg-uuids"
-UUID_HASH_FILE = os.path.join(UUID_FILE_DIR, "last_hash.txt")
-UUID_DB_MTIME_FILE = os.path.join(UUID_FILE_DIR, "last_db_mtime.txt")
+
+# Watcher state (last UUID hash, last DB mtime) shared by all processes
+WATCHER_STATE_DB = os.path.join(UUID_FILE_DIR, "state.db")
 
 # Ensure UUID file directory exists
 os.makedirs(UUID_FILE_DIR, exist_ok=True)
 
+_WATCHER_STATE_CONN: Optional[sqlite3.Connection] = None
+_WATCHER_STATE_LOCK = threading.Lock()
+
+
+def _watcher_state_conn() -> sqlite3.Connection:
+    """Return the watcher state DB connection. Caller must hold the lock."""
+    global _WATCHER_STATE_CONN
+    if _WATCHER_STATE_CONN is None:
+        conn = sqlite3.connect(
+            WATCHER_STATE_DB,
+            isolation_level=None,
+            check_same_thread=False,
+            timeout=5,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v TEXT)")
+        _WATCHER_STATE_CONN = conn
+    return _WATCHER_STATE_CONN
+
+
+def get_state(key: str) -> Optional[str]:
+    """Read a value from the watcher state DB (None if unset or on error)."""
+    with _WATCHER_STATE_LOCK:
+        try:
+            row = _watcher_state_conn().execute(
+                "SELECT v FROM kv WHERE k = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            debug_log(f"get_state: failed to read {key}: {e!r}")
+            return None
+    return row[0] if row else None
+
+
+def set_state(key: str, value: str) -> None:
+    """Store a value in the watcher state DB."""
+    with _WATCHER_STATE_LOCK:
+        try:
+            _watcher_state_conn().execute(
+                "REPLACE INTO kv (k, v) VALUES (?, ?)", (key, value)
+            )
+        except sqlite3.Error as e:
+            debug_log(f"set_state: failed to save {key}: {e!r}")
+
 
 def load_last_uuid_hash() -> Optional[str]:
-    """Load last UUID hash from file to persist across process restarts."""
-    if not os.path.isfile(UUID_HASH_FILE):
-        return None
-    try:
-        with open(UUID_HASH_FILE, "r", encoding="utf-8") as f:
-            return f.read().strip()
-    except Exception:
-        return None
+    """Load last UUID hash to persist across process restarts."""
+    return get_state("uuid_hash")
 
 
 def save_last_uuid_hash(hash_value: str) -> None:
-    """Save UUID hash to file to persist across process restarts."""
-    try:
-        with open(UUID_HASH_FILE, "w", encoding="utf-8") as f:
-            f.write(hash_value)
-    except Exception as e:
-        debug_log(f"save_last_uuid_hash: failed to save: {e!r}")
+    """Save UUID hash to persist across process restarts."""
+    set_state("uuid_hash", hash_value)
 
 
 def get_db_mtime(db_path: str) -> Optional[float]:
-    """Get database file modification time."""
+    """Get database modification time, counting a WAL file if there is one.
+
+    In WAL mode new rows land in `<db>-wal` and the main file is only
+    touched on checkpoint, so its mtime alone would miss changes.
+    """
     try:
-        return os.path.getmtime(db_path)
+        mtime = os.path.getmtime(db_path)
     except Exception:
         return None
+    try:
+        return max(mtime, os.path.getmtime(db_path + "-wal"))
+    except OSError:
+        return mtime
 
 
 def load_last_db_mtime() -> Optional[float]:
-    """Load last DB mtime from file."""
-    if not os.path.isfile(UUID_DB_MTIME_FILE):
-        return None
+    """Load last DB mtime."""
+    value = get_state("db_mtime")
     try:
-        with open(UUID_DB_MTIME_FILE, "r", encoding="utf-8") as f:
-            return float(f.read().strip())
-    except Exception:
+        return float(value) if value is not None else None
+    except ValueError:
         return None
 
 
 def save_last_db_mtime(mtime: float) -> None:
-    """Save DB mtime to file."""
-    try:
-        with open(UUID_DB_MTIME_FILE, "w", encoding="utf-8") as f:
-            f.write(str(mtime))
-    except Exception as e:
-        debug_log(f"save_last_db_mtime: failed to save: {e!r}")
+    """Save DB mtime."""
+    set_state("db_mtime", repr(mtime))
 
 
 def save_uuids_to_file(port: int, uuids: List[str]) -> None:
     """Save UUIDs to a text file for this port."""
     uuid_file = os.path.join(UUID_FILE_DIR, f"uuids-{port}.txt")
     try:
-        with open(uuid_file, "w", encoding="utf-8") as f:
-            for uuid in sorted(uuids):  # Sort for consistency
-                f.write(f"{uuid}\n")
+        data = "\n".join(sorted(uuids))  # Sort for consistency
+        if data:
+            data += "\n"
+        atomic_write(uuid_file, data.encode("utf-8"))
         debug_log(f"save_uuids: saved {len(uuids)} UUID(s) to {uuid_file}")
     except Exception as e:
         debug_log(f"save_uuids: failed to save to {uuid_file}: {e!r}")
 
 
 def get_uuids_hash(uuids: List[str]) -> str:
-    """Calculate hash of UUID list to detect changes."""
-    sorted_uuids = sorted(uuids)
-    uuid_string = "\n".join(sorted_uuids)
-    return hashlib.md5(uuid_string.encode("utf-8")).hexdigest()
+    """Calculate hash of UUID list to detect changes.
+
+    Hashes the sorted, newline-terminated UUIDs in a single update() call.
+    """
+    data = "\n".join(sorted(uuids)) + "\n" if uuids else ""
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
 
 
 def load_uuids_from_file(port: int) -> Optional[List[str]]:
@@ -373,13 +1359,26 @@ def load_uuids_from_file(port: int) -> Optional[List[str]]:
         return None
     try:
         with open(uuid_file, "r", encoding="utf-8") as f:
-            uuids = [line.strip() for line in f if line.strip()]
-        return uuids
+            return f.read().split()
     except Exception as e:
         debug_log(f"load_uuids: failed to load from {uuid_file}: {e!r}")
         return None
 
 
+# Parsed CONFIG_FILE, reused while the file on disk is unchanged
+_CONFIG_CACHE: Optional[Dict] = None
+_CONFIG_CACHE_KEY: Optional[Tuple[str, int, int, int]] = None
+
+
+def _config_file_key() -> Optional[Tuple[str, int, int, int]]:
+    """Identify the current CONFIG_FILE contents by path/inode/mtime/size."""
+    try:
+        st = os.stat(CONFIG_FILE)
+    except OSError:
+        return None
+    return (CONFIG_FILE, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
 def load_config() -> Dict:
     """Load main configuration from file.
     
@@ -390,21 +1389,30 @@ def load_config() -> Dict:
         "panel_type": None,  # "x-ui" or "marzban"
         "panel_db_path": None,
         "uuid_refresh_interval": 5,  # seconds
+        "restore_workers": 8,  # tunnels restored in parallel after reboot
         "auto_restore_enabled": True,
         "setup_completed": False
     }
     
-    if not os.path.isfile(CONFIG_FILE):
+    global _CONFIG_CACHE, _CONFIG_CACHE_KEY
+    
+    key = _config_file_key()
+    if key is None:
         return default_config
+    if _CONFIG_CACHE is not None and key == _CONFIG_CACHE_KEY:
+        # Callers modify the returned dict before save_config, so hand out a copy
+        return dict(_CONFIG_CACHE)
     
     try:
         with open(CONFIG_FILE, "r", encoding="utf-8") as f:
             config = json.load(f)
         # Merge with defaults to ensure all keys exist
-        for key, value in default_config.items():
-            if key not in config:
-                config[key] = value
+        for key_name, value in default_config.items():
+            if key_name not in config:
+                config[key_name] = value
         debug_log(f"load_config: loaded from {CONFIG_FILE}")
+        _CONFIG_CACHE = dict(config)
+        _CONFIG_CACHE_KEY = key
         return config
     except Exception as e:
         debug_log(f"load_config: failed to load: {e!r}, using defaults")
@@ -413,15 +1421,67 @@ def load_config() -> Dict:
 
 def save_config(config: Dict) -> None:
     """Save main configuration to file."""
+    global _CONFIG_CACHE, _CONFIG_CACHE_KEY
     try:
         os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=2)
+        atomic_write(
+            CONFIG_FILE, json.dumps(config, indent=2).encode("utf-8"), fsync=True
+        )
+        _CONFIG_CACHE = dict(config)
+        _CONFIG_CACHE_KEY = _config_file_key()
         debug_log(f"save_config: saved to {CONFIG_FILE}")
     except Exception as e:
         debug_log(f"save_config: failed to save: {e!r}")
 
 
+def sd_notify(state: str) -> bool:
+    """Send `state` (e.g. "READY=1") to systemd's $NOTIFY_SOCKET, if any.
+
+    Same protocol as sd_notify(3) without the libsystemd dependency; a
+    no-op returning False when not started by a Type=notify unit.
+    """
+    addr = os.environ.get("NOTIFY_SOCKET")
+    if not addr:
+        return False
+    if addr.startswith("@"):
+        # Abstract namespace socket
+        addr = "\0" + addr[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+            sock.sendto(state.encode("utf-8"), addr)
+        return True
+    except OSError as e:
+        debug_log(f"sd_notify: failed to notify systemd: {e!r}")
+        return False
+
+
+def restore_service_unit(script_path: str) -> str:
+    """Unit file of setup-wg-restore.service.
+
+    Type=notify: `--restore` reports READY once the tunnels are up, so units
+    ordered after this one do not wait for the UUID watcher startup.
+    Restoring many tunnels can take longer than the default start timeout
+    (90s), so there is none: a slow boot must not get the restore killed.
+    """
+    return f"""[Unit]
+Description=WireGuard Namespace Manager - Restore Tunnels After Reboot
+After=network.target
+Wants=network.target
+
+[Service]
+Type=notify
+NotifyAccess=main
+ExecStart=/usr/bin/python3 {script_path} --restore
+TimeoutStartSec=infinity
+RemainAfterExit=yes
+StandardOutput=journal
+StandardError=journal
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+
 def setup_wizard() -> None:
     """First-time setup wizard to configure the script."""
     print(f"\n{BLUE}{'='*60}{NC}")
@@ -473,7 +1533,8 @@ def setup_wizard() -> None:
     
     # UUID refresh interval
     print(f"\n{BLUE}3. UUID Refresh Interval:{NC}")
-    print("   How often should the script check for new UUIDs? (in seconds)")
+    print("   UUIDs are refreshed when the panel DB changes. Minimum time between two")
+    print("   refreshes (in seconds); also the polling interval if inotify is unavailable")
     while True:
         try:
             interval = input(f"{YELLOW}Enter interval (default: 5): {NC}").strip()
@@ -509,26 +1570,12 @@ def setup_wizard() -> None:
         if not os.path.isfile(service_file):
             print(f"\n{BLUE}5. Setting up systemd service...{NC}")
             script_path = os.path.abspath(__file__)
-            service_content = f"""[Unit]
-Description=WireGuard Namespace Manager - Restore Tunnels After Reboot
-After=network.target
-Wants=network.target
-
-[Service]
-Type=oneshot
-ExecStart=/usr/bin/python3 {script_path} --restore
-RemainAfterExit=yes
-StandardOutput=journal
-StandardError=journal
-
-[Install]
-WantedBy=multi-user.target
-"""
+            service_content = restore_service_unit(script_path)
             try:
                 with open(service_file, "w", encoding="utf-8") as f:
                     f.write(service_content)
-                run_cmd("systemctl daemon-reload", capture_output=False)
-                run_cmd("systemctl enable setup-wg-restore.service", capture_output=False)
+                run_argv(["systemctl", "daemon-reload"], capture_output=False)
+                run_argv(["systemctl", "enable", "setup-wg-restore.service"], capture_output=False)
                 print(f"{GREEN}✓ Systemd service configured and enabled{NC}")
             except Exception as e:
                 print(f"{RED}✗ Failed to setup systemd service: {e}{NC}")
@@ -545,15 +1592,14 @@ WantedBy=multi-user.target
     if config["panel_type"]:
         PANEL_PANEL_NAME = config["panel_type"]
         PANEL_DB_PATH = config["panel_db_path"]
-        save_panel_state()
     
     # Start UUID watcher in background if panel is configured
     if config["panel_type"] and config["panel_db_path"]:
         print(f"\n{BLUE}Starting UUID auto-refresh watcher...{NC}")
         if start_background_uuid_watcher():
             interval = config.get("uuid_refresh_interval", 5)
-            print(f"{GREEN}✓ UUID Auto-Refresh Watcher started (every {interval} seconds){NC}")
-            print(f"{BLUE}  UUIDs will be automatically updated from panel every {interval} seconds{NC}")
+            print(f"{GREEN}✓ UUID Auto-Refresh Watcher started{NC}")
+            print(f"{BLUE}  UUIDs will be updated from the panel when its DB changes, at most every {interval} seconds{NC}")
             print(f"{BLUE}  New users will be able to connect automatically{NC}")
         else:
             print(f"{YELLOW}⚠ Could not start UUID watcher automatically{NC}")
@@ -566,33 +1612,50 @@ WantedBy=multi-user.target
     input("Press Enter to continue...")
 
 
+# Config file key (see _config_file_key) at the last load_panel_state
+_PANEL_STATE_KEY: Optional[Tuple[str, int, int, int]] = None
+
+
 def load_panel_state() -> None:
-    """Load previously chosen panel DB path (if any) from disk."""
-    global PANEL_DB_PATH, PANEL_PANEL_NAME
+    """Load previously chosen panel DB path (if any) from the main config.
+
+    Does nothing if the config file is unchanged since the last call, so
+    the watchers can call it every tick for the price of one stat().
+    """
+    global PANEL_DB_PATH, PANEL_PANEL_NAME, _PANEL_STATE_KEY
     
-    # First try to load from main config
-    config = load_config()
-    if config.get("panel_type") and config.get("panel_db_path"):
-        PANEL_PANEL_NAME = config["panel_type"]
-        PANEL_DB_PATH = config["panel_db_path"]
-        debug_log(f"panel_state: loaded from config: panel={PANEL_PANEL_NAME}, db={PANEL_DB_PATH}")
+    key = _config_file_key()
+    if key is not None and key == _PANEL_STATE_KEY:
         return
     
-    # Fallback to old state file
-    if not os.path.isfile(PANEL_STATE_FILE):
-        return
+    config = load_config()
+    
+    # One-time migration of the old two-line state file into the config
     try:
         with open(PANEL_STATE_FILE, "r", encoding="utf-8") as f:
             lines = [ln.strip() for ln in f.readlines() if ln.strip()]
-        if len(lines) >= 2:
-            PANEL_PANEL_NAME = lines[0]
-            PANEL_DB_PATH = lines[1]
-            debug_log(
-                f"panel_state: loaded from {PANEL_STATE_FILE}: "
-                f"panel={PANEL_PANEL_NAME}, db={PANEL_DB_PATH}"
-            )
+    except FileNotFoundError:
+        lines = []
     except Exception as e:
-        debug_log(f"panel_state: failed to load: {e}")
+        debug_log(f"panel_state: failed to read {PANEL_STATE_FILE}: {e}")
+        lines = []
+    else:
+        if len(lines) >= 2 and not (config.get("panel_type") and config.get("panel_db_path")):
+            config["panel_type"] = lines[0]
+            config["panel_db_path"] = lines[1]
+            save_config(config)
+            debug_log(f"panel_state: migrated {PANEL_STATE_FILE} into {CONFIG_FILE}")
+        try:
+            os.remove(PANEL_STATE_FILE)
+        except OSError as e:
+            debug_log(f"panel_state: failed to remove {PANEL_STATE_FILE}: {e}")
+    
+    if config.get("panel_type") and config.get("panel_db_path"):
+        PANEL_PANEL_NAME = config["panel_type"]
+        PANEL_DB_PATH = config["panel_db_path"]
+        debug_log(f"panel_state: loaded from config: panel={PANEL_PANEL_NAME}, db={PANEL_DB_PATH}")
+    # Key after a possible migration write, so that write is not re-read
+    _PANEL_STATE_KEY = _config_file_key()
 
 
 def save_panel_state() -> None:
@@ -600,15 +1663,14 @@ def save_panel_state() -> None:
     global PANEL_DB_PATH, PANEL_PANEL_NAME
     if not PANEL_DB_PATH or not PANEL_PANEL_NAME:
         return
-    try:
-        with open(PANEL_STATE_FILE, "w", encoding="utf-8") as f:
-            f.write(f"{PANEL_PANEL_NAME}\n{PANEL_DB_PATH}\n")
-        debug_log(
-            f"panel_state: saved to {PANEL_STATE_FILE}: "
-            f"panel={PANEL_PANEL_NAME}, db={PANEL_DB_PATH}"
-        )
-    except Exception as e:
-        debug_log(f"panel_state: failed to save: {e}")
+    config = load_config()
+    config["panel_type"] = PANEL_PANEL_NAME
+    config["panel_db_path"] = PANEL_DB_PATH
+    save_config(config)
+    debug_log(
+        f"panel_state: saved to {CONFIG_FILE}: "
+        f"panel={PANEL_PANEL_NAME}, db={PANEL_DB_PATH}"
+    )
 
 
 def save_setup_state(port: int, wg_config_path: str) -> None:
@@ -616,8 +1678,9 @@ def save_setup_state(port: int, wg_config_path: str) -> None:
     try:
         os.makedirs(SETUP_STATE_DIR, exist_ok=True)
         state_file = os.path.join(SETUP_STATE_DIR, f"tunnel-{port}.state")
-        with open(state_file, "w", encoding="utf-8") as f:
-            f.write(f"{port}\n{wg_config_path}\n")
+        # One write and one fsync; a crash leaves the old state or the new
+        # one, never a truncated file that restore would drop
+        atomic_write(state_file, f"{port}\n{wg_config_path}\n".encode("utf-8"), fsync=True)
         debug_log(f"save_setup_state: saved tunnel {port} with config {wg_config_path}")
     except Exception as e:
         debug_log(f"save_setup_state: failed to save tunnel {port}: {e!r}")
@@ -627,9 +1690,10 @@ def delete_setup_state(port: int) -> None:
     """Delete tunnel setup state file."""
     try:
         state_file = os.path.join(SETUP_STATE_DIR, f"tunnel-{port}.state")
-        if os.path.isfile(state_file):
-            os.remove(state_file)
-            debug_log(f"delete_setup_state: removed state for tunnel {port}")
+        os.remove(state_file)
+        debug_log(f"delete_setup_state: removed state for tunnel {port}")
+    except FileNotFoundError:
+        pass
     except Exception as e:
         debug_log(f"delete_setup_state: failed to delete tunnel {port}: {e!r}")
 
@@ -645,40 +1709,367 @@ def load_all_setup_states() -> List[Tuple[int, str]]:
         return tunnels
     
     try:
-        for filename in os.listdir(SETUP_STATE_DIR):
-            if not filename.startswith("tunnel-") or not filename.endswith(".state"):
-                continue
-            state_file = os.path.join(SETUP_STATE_DIR, filename)
-            try:
-                with open(state_file, "r", encoding="utf-8") as f:
-                    lines = [ln.strip() for ln in f.readlines() if ln.strip()]
-                if len(lines) >= 2:
-                    port = int(lines[0])
-                    wg_config_path = lines[1]
-                    if os.path.isfile(wg_config_path):
-                        tunnels.append((port, wg_config_path))
-                    else:
-                        debug_log(f"load_all_setup_states: config file not found: {wg_config_path}, removing state")
-                        os.remove(state_file)
-            except (ValueError, IndexError, OSError) as e:
-                debug_log(f"load_all_setup_states: error reading {state_file}: {e!r}")
+        with os.scandir(SETUP_STATE_DIR) as it:
+            for entry in it:
+                # Port is encoded in the name (tunnel-{port}.state)
+                m = SETUP_STATE_FILE_REGEX.match(entry.name)
+                if not m or not entry.is_file():
+                    continue
+                port = int(m.group(1))
+                state_file = entry.path
+                try:
+                    with open(state_file, "r", encoding="utf-8") as f:
+                        lines = [ln.strip() for ln in f.readlines() if ln.strip()]
+                    if len(lines) >= 2:
+                        wg_config_path = lines[1]
+                        if os.path.isfile(wg_config_path):
+                            tunnels.append((port, wg_config_path))
+                        else:
+                            debug_log(f"load_all_setup_states: config file not found: {wg_config_path}, removing state")
+                            os.remove(state_file)
+                except (ValueError, IndexError, OSError) as e:
+                    debug_log(f"load_all_setup_states: error reading {state_file}: {e!r}")
     except OSError as e:
         debug_log(f"load_all_setup_states: error listing {SETUP_STATE_DIR}: {e!r}")
     
     return tunnels
 
 
-def restore_setup(port: int, wg_config_path: str) -> bool:
+# Host-side creation of a tunnel is retried this many times, with a short
+# delay, instead of sleeping after removing leftover interfaces
+RESTORE_CREATE_ATTEMPTS = 10
+RESTORE_CREATE_RETRY_DELAY = 0.05
+
+
+def tunnel_link_batches(
+    ns_name: str, veth_host: str, veth_ns: str, host_ip: str, wg_name: str
+) -> Tuple[List[str], List[str]]:
+    """Host-side `ip -batch` lines for a tunnel: (create, cleanup).
+
+    The create batch adds the namespace, the veth pair (host end up and
+    addressed, peer moved into the namespace) and the WireGuard interface.
+    """
+    create = [
+        f"netns add {shlex.quote(ns_name)}",
+        f"link add {shlex.quote(veth_host)} type veth peer name {shlex.quote(veth_ns)}",
+        f"link set {shlex.quote(veth_host)} up",
+        f"addr add {host_ip}/24 dev {shlex.quote(veth_host)}",
+        f"link set {shlex.quote(veth_ns)} netns {shlex.quote(ns_name)}",
+        f"link add {shlex.quote(wg_name)} type wireguard",
+    ]
+    cleanup = [
+        f"link delete {shlex.quote(wg_name)}",
+        f"link delete {shlex.quote(veth_host)}",
+        f"netns delete {shlex.quote(ns_name)}",
+    ]
+    return create, cleanup
+
+
+def create_tunnel_links(create: List[str], cleanup: List[str]) -> subprocess.CompletedProcess:
+    """Run a tunnel's host-side create batch, retrying briefly on failure.
+
+    Without -force ip stops at the first failing line; between attempts the
+    partial result is removed, in case links deleted just before are still
+    being torn down. On final failure everything is cleaned up.
+    """
+    for attempt in range(RESTORE_CREATE_ATTEMPTS):
+        res = run_ip_batch(create, force=False)
+        if res.returncode == 0:
+            return res
+        run_ip_batch(cleanup, discard=True)
+        if attempt + 1 < RESTORE_CREATE_ATTEMPTS:
+            time.sleep(RESTORE_CREATE_RETRY_DELAY)
+    return res
+
+
+def tunnel_ns_batch(
+    ns_ip: str,
+    subnet: str,
+    veth_ns: str,
+    host_ip: str,
+    wg_name: str,
+    wg_address: str,
+    endpoint_ip: str,
+) -> List[str]:
+    """Namespace-side `ip -batch` lines: addresses, routes and the fwmark rule.
+
+    Everything but the WireGuard endpoint goes through the tunnel; replies
+    to DNATed connections (fwmark 1) go back out the veth via table 100.
+    """
+    return [
+        "link set lo up",
+        f"link set {shlex.quote(veth_ns)} up",
+        f"addr add {ns_ip}/24 dev {shlex.quote(veth_ns)}",
+        f"addr add {wg_address} dev {shlex.quote(wg_name)}",
+        f"link set {shlex.quote(wg_name)} up",
+        "route flush table main",
+        "route flush table 100",
+        f"route add {subnet} dev {shlex.quote(veth_ns)} proto kernel scope link src {ns_ip}",
+        f"route add {endpoint_ip}/32 via {host_ip}",
+        f"route add default dev {shlex.quote(wg_name)}",
+        f"route add default via {host_ip} dev {shlex.quote(veth_ns)} table 100",
+        "rule add fwmark 1 lookup 100",
+    ]
+
+
+def host_tunnel_rules(
+    port: int, ns_ip: str, subnet: str, veth_host: str, forward: bool = True
+) -> List[Tuple[str, str]]:
+    """Host-side (table, rule) pairs for a tunnel: masquerade, DNAT, FORWARD.
+
+    With `forward=False` the per-tunnel FORWARD rules are left out; the
+    tunnel is then accepted through the shared ipsets instead.
+    """
+    rules = [("nat", f"-A POSTROUTING -s {subnet} ! -o {veth_host} -j MASQUERADE")]
+    for proto in ("tcp", "udp"):
+        rules.append(
+            ("nat", f"-A PREROUTING -p {proto} --dport {port} -j DNAT --to-destination {ns_ip}:{port}")
+        )
+        if forward:
+            rules += [
+                ("filter", f"-I FORWARD 1 -p {proto} -d {ns_ip}/32 --dport {port} -j ACCEPT"),
+                ("filter", f"-I FORWARD 1 -p {proto} -s {ns_ip}/32 -j ACCEPT"),
+            ]
+    return rules
+
+
+def tunnel_log_rules(port: int, ns_ip: str) -> List[Tuple[str, str]]:
+    """(table, rule) pairs that LOG a tunnel's DNAT, forward and return packets.
+
+    No --log-level: the default (4) is what we want, and iptables-save
+    leaves it out, so the rules compare equal to the saved ones.
+    """
+    rules = []
+    for proto in ("tcp", "udp"):
+        rules += [
+            ("nat", f'-I PREROUTING 1 -p {proto} --dport {port} -j LOG --log-prefix "[DNAT-{port}] "'),
+            ("filter", f'-I FORWARD 1 -p {proto} -d {ns_ip}/32 --dport {port} -j LOG --log-prefix "[FWD-{port}] "'),
+            ("filter", f'-I FORWARD 1 -p {proto} -s {ns_ip}/32 -j LOG --log-prefix "[RET-{port}] "'),
+        ]
+    return rules
+
+
+# ipsets holding every tunnel's FORWARD targets: (ns_ip, proto:port) for
+# inbound traffic, ns_ip for replies. Two sets and three FORWARD rules
+# replace four FORWARD rules per tunnel, so the chain no longer grows.
+FORWARD_SET_DST = "wgnm-fwd-dst"
+FORWARD_SET_SRC = "wgnm-fwd-src"
+FORWARD_SETS_READY = False
+
+
+def run_ipset_restore(lines: List[str]) -> subprocess.CompletedProcess:
+    """Apply ipset commands in one `ipset -exist restore` call."""
+    try:
+        return subprocess.run(
+            ["ipset", "-exist", "restore"],
+            input="\n".join(lines) + "\n",
+            capture_output=True,
+            text=True,
+        )
+    except OSError as e:
+        return subprocess.CompletedProcess(["ipset"], 127, "", f"{e}\n")
+
+
+def ensure_forward_sets() -> bool:
+    """Create the FORWARD ipsets and their accept rules if ipset is available.
+
+    Returns False (per-tunnel FORWARD rules are used instead) when ipset is
+    missing or the sets cannot be set up.
+    """
+    global FORWARD_SETS_READY
+    if FORWARD_SETS_READY:
+        return True
+    if not command_exists("ipset"):
+        return False
+    with IPTABLES_LOCK:
+        if FORWARD_SETS_READY:
+            return True
+        res = run_ipset_restore([
+            f"create {FORWARD_SET_DST} hash:ip,port family inet",
+            f"create {FORWARD_SET_SRC} hash:ip family inet",
+        ])
+        if res.returncode != 0:
+            debug_log(f"ensure_forward_sets: ipset create failed: {res.stderr.strip()}")
+            return False
+        rules = [("filter", f"-I FORWARD 1 -m set --match-set {FORWARD_SET_DST} dst,dst -j ACCEPT")]
+        for proto in ("tcp", "udp"):
+            rules.append(
+                ("filter", f"-I FORWARD 1 -p {proto} -m set --match-set {FORWARD_SET_SRC} src -j ACCEPT")
+            )
+        res = iptables_replace_rules(rules)
+        if res.returncode != 0:
+            debug_log(f"ensure_forward_sets: FORWARD rules failed: {res.stderr.strip()}")
+            return False
+        FORWARD_SETS_READY = True
+    return True
+
+
+def forward_set_entries(ns_ip: str, port: int) -> List[str]:
+    """`<set> <entry>` pairs that let a tunnel's traffic through FORWARD."""
+    return [
+        f"{FORWARD_SET_DST} {ns_ip},tcp:{port}",
+        f"{FORWARD_SET_DST} {ns_ip},udp:{port}",
+        f"{FORWARD_SET_SRC} {ns_ip}",
+    ]
+
+
+def apply_host_tunnel_rules(
+    port: int, ns_ip: str, subnet: str, veth_host: str
+) -> subprocess.CompletedProcess:
+    """Install a tunnel's host-side NAT rules and FORWARD accepts."""
+    use_sets = ensure_forward_sets()
+    res = iptables_replace_rules(
+        host_tunnel_rules(port, ns_ip, subnet, veth_host, forward=not use_sets)
+    )
+    if use_sets:
+        set_res = run_ipset_restore(
+            [f"add {entry}" for entry in forward_set_entries(ns_ip, port)]
+        )
+        if set_res.returncode != 0:
+            return set_res
+    return res
+
+
+def ns_tunnel_rules(ns_ip: str, wg_name: str) -> List[Tuple[str, str]]:
+    """Namespace-side (table, rule) pairs: reply fwmark and WG masquerade."""
+    return [
+        ("mangle", f"-A OUTPUT -m conntrack --ctstate ESTABLISHED,RELATED -s {ns_ip} -j MARK --set-mark 1"),
+        ("nat", f"-A POSTROUTING -o {shlex.quote(wg_name)} -j MASQUERADE"),
+    ]
+
+
+NETNS_RESOLV_CONF = b"nameserver 1.1.1.1\n"
+
+
+def write_netns_resolv_conf(ns_name: str) -> None:
+    """Point the namespace's DNS at 1.1.1.1 (bind-mounted by `ip netns exec`).
+
+    The file is left untouched if it already has that content.
+    """
+    etc_ns = f"/etc/netns/{ns_name}"
+    path = os.path.join(etc_ns, "resolv.conf")
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(NETNS_RESOLV_CONF) + 1) == NETNS_RESOLV_CONF:
+                return
+    except OSError:
+        os.makedirs(etc_ns, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, NETNS_RESOLV_CONF)
+    finally:
+        os.close(fd)
+
+
+@dataclass(frozen=True)
+class TunnelTopology:
+    """Names and addresses derived from a tunnel port."""
+    port: int
+    ns_name: str
+    veth_host: str
+    veth_ns: str
+    host_ip: str
+    ns_ip: str
+    subnet: str
+
+
+@functools.lru_cache(maxsize=256)
+def tunnel_topology(port: int) -> TunnelTopology:
+    """Return the namespace, veth pair and 10.100.X.0/24 addresses of `port`."""
+    # Subnet octet: port % 250 + 2 to avoid conflicts
+    # (port 250 and 500 would both map to 1, so we use +2)
+    subnet_octet = (port % 250) + 2
+    return TunnelTopology(
+        port=port,
+        ns_name=f"ns-{port}",
+        veth_host=f"veth-{port}",
+        veth_ns=f"vpeer-{port}",
+        host_ip=f"10.100.{subnet_octet}.1",
+        ns_ip=f"10.100.{subnet_octet}.2",
+        subnet=f"10.100.{subnet_octet}.0/24",
+    )
+
+
+def wg_interface_name(port: int) -> str:
+    """Return the WireGuard interface name used for a tunnel port.
+
+    Same value as `echo PORT | md5sum | cut -c1-8` (note the trailing
+    newline), so existing tunnels keep their interface names.
+    """
+    return "wg-" + hashlib.md5(f"{port}\n".encode("ascii")).hexdigest()[:8]
+
+
+# Keys understood by wg-quick but rejected by `wg setconf`
+WG_QUICK_KEY_REGEX = re.compile(
+    r"^(Address|DNS|Table|MTU|PreUp|PostUp|PreDown|PostDown)\b"
+)
+
+
+def parse_wg_config(wg_config_path: str) -> Tuple[str, str, str]:
+    """Read a WireGuard config file once.
+
+    Returns:
+        Tuple of (address, endpoint, setconf_text): the interface Address
+        (default 10.0.0.2/32), the first peer Endpoint ("" if none) and the
+        config without the wg-quick-only keys, ready to be passed to
+        `wg setconf` on stdin.
+    """
+    with open(wg_config_path, "r", encoding="utf-8") as f:
+        return parse_wg_config_text(f.read())
+
+
+def parse_wg_config_text(text: str) -> Tuple[str, str, str]:
+    """parse_wg_config for config text already in memory."""
+    lines = text.splitlines()
+    wg_address = ""
+    endpoint = ""
+    kept = []
+    for line in lines:
+        key = line.split("=", 1)[0].strip().lower() if "=" in line else ""
+        if key.startswith("address"):
+            wg_address = wg_address or line.split("=", 1)[1].strip()
+        elif key.startswith("endpoint"):
+            endpoint = endpoint or line.split("=", 1)[1].strip()
+        if not WG_QUICK_KEY_REGEX.match(line):
+            kept.append(line)
+    return wg_address or "10.0.0.2/32", endpoint, "\n".join(kept) + "\n"
+
+
+def wg_setconf(wg_name: str, setconf_text: str) -> bool:
+    """Apply `setconf_text` to WireGuard interface `wg_name` via stdin."""
+    try:
+        return subprocess.run(
+            ["wg", "setconf", wg_name, "/dev/stdin"],
+            input=setconf_text,
+            text=True,
+        ).returncode == 0
+    except OSError:
+        return False
+
+
+def restore_setup(
+    port: int,
+    wg_config_path: str,
+    existing_ns: Optional[Set[str]] = None,
+    start_xray: bool = True,
+) -> bool:
     """Restore a single tunnel setup from saved state.
     
+    Args:
+        existing_ns: Namespace names from _get_existing_netns(), so callers
+                     restoring many tunnels only look them up once.
+        start_xray: If False, skip the Xray refresh; used when restoring
+                    several tunnels, which then refreshes Xray only once.
+    
     Returns:
         True if restore was successful, False otherwise.
     """
     ns_name = f"ns-{port}"
     
     # Check if namespace already exists
-    ns_list = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'").stdout.split()
-    if ns_name in ns_list:
+    if existing_ns is None:
+        existing_ns = _get_existing_netns()
+    if ns_name in existing_ns:
         debug_log(f"restore_setup: namespace {ns_name} already exists, skipping")
         return True
     
@@ -687,125 +2078,68 @@ def restore_setup(port: int, wg_config_path: str) -> bool:
     
     # Recreate setup using existing create_setup logic
     # We'll extract the relevant parts
-    subnet_octet = (port % 250) + 2
-    veth_host = f"veth-{port}"
-    veth_ns = f"vpeer-{port}"
-    host_ip = f"10.100.{subnet_octet}.1"
-    ns_ip = f"10.100.{subnet_octet}.2"
-    subnet = f"10.100.{subnet_octet}.0/24"
+    topo = tunnel_topology(port)
+    veth_host, veth_ns = topo.veth_host, topo.veth_ns
+    host_ip, ns_ip, subnet = topo.host_ip, topo.ns_ip, topo.subnet
+    
+    # WireGuard interface name, address, endpoint and wg-compatible config
+    wg_name = wg_interface_name(port)
+    wg_address, wg_endpoint, wg_setconf_text = parse_wg_config(wg_config_path)
     
     # Resolve endpoint
-    endpoint_host, endpoint_ip = resolve_endpoint_ip(wg_config_path)
+    endpoint_host, endpoint_ip = resolve_endpoint_ip(wg_endpoint)
     if not endpoint_ip:
         print(f"{RED}Could not resolve endpoint: {endpoint_host}{NC}")
         debug_log(f"restore_setup: failed to resolve endpoint for {wg_config_path}")
         return False
     
-    # Create namespace and veth
-    if run_cmd(f"ip netns add {shlex.quote(ns_name)}", capture_output=False).returncode != 0:
-        debug_log(f"restore_setup: failed to create namespace {ns_name}")
-        return False
-    
-    run_cmd(f"ip link delete {shlex.quote(veth_host)} 2>/dev/null || true", capture_output=False)
-    time.sleep(1)
-    if run_cmd(
-        f"ip link add {shlex.quote(veth_host)} type veth peer name {shlex.quote(veth_ns)}",
-        capture_output=False,
-    ).returncode != 0:
-        debug_log(f"restore_setup: failed to create veth pair")
-        run_cmd(f"ip netns delete {shlex.quote(ns_name)} 2>/dev/null || true", capture_output=False)
-        return False
-    
-    run_cmd(f"ip link set {shlex.quote(veth_host)} up", capture_output=False)
-    run_cmd(f"ip addr flush dev {shlex.quote(veth_host)} 2>/dev/null || true", capture_output=False)
-    run_cmd(f"ip addr add {host_ip}/24 dev {shlex.quote(veth_host)}", capture_output=False)
-    
-    run_cmd(f"ip link set {shlex.quote(veth_ns)} netns {shlex.quote(ns_name)}", capture_output=False)
-    run_cmd("ip link set lo up", ns=ns_name, capture_output=False)
-    run_cmd(f"ip link set {shlex.quote(veth_ns)} up", ns=ns_name, capture_output=False)
-    run_cmd(f"ip addr flush dev {shlex.quote(veth_ns)} 2>/dev/null || true", ns=ns_name, capture_output=False)
-    run_cmd(f"ip addr add {ns_ip}/24 dev {shlex.quote(veth_ns)}", ns=ns_name, capture_output=False)
-    
-    # WireGuard setup
-    wg_name = ""
-    if command_exists("md5sum"):
-        res = run_cmd(f"echo {port} | md5sum | cut -c1-8")
-        wg_name = f"wg-{res.stdout.strip()}"
-    elif command_exists("md5"):
-        res = run_cmd(f"echo {port} | md5 | cut -c1-8")
-        wg_name = f"wg-{res.stdout.strip()}"
-    else:
-        wg_name = f"wg-{(port * 31):08x}"[:11]
+    # Remove leftovers of a previous run (failures are expected here)
+    run_ip_batch(
+        [
+            f"link delete {shlex.quote(veth_host)}",
+            f"link delete {shlex.quote(wg_name)}",
+        ],
+        discard=True,
+    )
     
-    wg_address = "10.0.0.2/32"
-    with open(wg_config_path, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip().lower().startswith("address"):
-                wg_address = line.split("=", 1)[1].strip()
-                break
-    
-    run_cmd(f"ip netns exec {shlex.quote(ns_name)} ip link delete {shlex.quote(wg_name)} 2>/dev/null || true", capture_output=False)
-    run_cmd(f"ip link delete {shlex.quote(wg_name)} 2>/dev/null || true", capture_output=False)
-    time.sleep(1)
-    
-    if run_cmd(f"ip link add {shlex.quote(wg_name)} type wireguard", capture_output=False).returncode != 0:
-        debug_log(f"restore_setup: failed to create WireGuard interface")
-        run_cmd(f"ip link delete {shlex.quote(veth_host)} 2>/dev/null || true", capture_output=False)
-        run_cmd(f"ip netns delete {shlex.quote(ns_name)} 2>/dev/null || true", capture_output=False)
+    # Create namespace, veth pair and WireGuard interface in one host-side
+    # batch, retried briefly instead of sleeping up front
+    host_batch, cleanup_batch = tunnel_link_batches(ns_name, veth_host, veth_ns, host_ip, wg_name)
+    host_res = create_tunnel_links(host_batch, cleanup_batch)
+    if host_res.returncode != 0:
+        debug_log(f"restore_setup: failed to create namespace/interfaces: {host_res.stderr.strip()}")
         return False
     
-    filter_cmd = (
-        r"grep -vE '^(Address|DNS|Table|MTU|PreUp|PostUp|PreDown|PostDown)' "
-        f"{shlex.quote(wg_config_path)} | wg setconf {shlex.quote(wg_name)} /dev/stdin"
-    )
-    if run_cmd(filter_cmd, capture_output=False).returncode != 0:
+    if not wg_setconf(wg_name, wg_setconf_text):
         debug_log(f"restore_setup: failed to configure WireGuard")
-        run_cmd(f"ip link delete {shlex.quote(wg_name)} 2>/dev/null || true", capture_output=False)
-        run_cmd(f"ip link delete {shlex.quote(veth_host)} 2>/dev/null || true", capture_output=False)
-        run_cmd(f"ip netns delete {shlex.quote(ns_name)} 2>/dev/null || true", capture_output=False)
+        run_ip_batch(cleanup_batch, discard=True)
         return False
     
-    run_cmd(f"ip link set {shlex.quote(wg_name)} netns {shlex.quote(ns_name)}", capture_output=False)
-    run_cmd(f"ip addr add {wg_address} dev {shlex.quote(wg_name)}", ns=ns_name, capture_output=False)
-    run_cmd(f"ip link set {shlex.quote(wg_name)} up", ns=ns_name, capture_output=False)
+    run_ip_batch([f"link set {shlex.quote(wg_name)} netns {shlex.quote(ns_name)}"])
     
-    # Routing
-    run_cmd("ip route flush table main 2>/dev/null || true", ns=ns_name, capture_output=False)
-    run_cmd("ip route flush table 100 2>/dev/null || true", ns=ns_name, capture_output=False)
-    run_cmd(
-        f"ip route add 10.100.{subnet_octet}.0/24 dev {shlex.quote(veth_ns)} proto kernel scope link src {ns_ip}",
+    # Addresses and routing inside the namespace
+    ns_res = run_ip_batch(
+        tunnel_ns_batch(ns_ip, subnet, veth_ns, host_ip, wg_name, wg_address, endpoint_ip),
         ns=ns_name,
-        capture_output=False,
     )
-    run_cmd(f"ip route add {endpoint_ip}/32 via {host_ip}", ns=ns_name, capture_output=False)
-    run_cmd(f"ip route add default dev {shlex.quote(wg_name)}", ns=ns_name, capture_output=False)
-    run_cmd(f"ip route add default via {host_ip} dev {shlex.quote(veth_ns)} table 100", ns=ns_name, capture_output=False)
-    run_cmd(f"ip rule add fwmark 1 lookup 100", ns=ns_name, capture_output=False)
-    run_cmd(f"iptables -t mangle -A OUTPUT -m conntrack --ctstate ESTABLISHED,RELATED -s {ns_ip} -j MARK --set-mark 1", ns=ns_name, capture_output=False)
-    
-    # NAT & firewall
-    run_cmd("sysctl -w net.ipv4.ip_forward=1 >/dev/null", capture_output=False)
-    run_cmd(f"iptables -t nat -A POSTROUTING -o {shlex.quote(wg_name)} -j MASQUERADE", ns=ns_name, capture_output=False)
-    run_cmd(f"iptables -t nat -D POSTROUTING -s {subnet} ! -o {veth_host} -j MASQUERADE 2>/dev/null || true", capture_output=False)
-    run_cmd(f"iptables -t nat -A POSTROUTING -s {subnet} ! -o {veth_host} -j MASQUERADE", capture_output=False)
-    
-    # DNAT + FORWARD
-    for proto in ("tcp", "udp"):
-        run_cmd(f"iptables -t nat -D PREROUTING -p {proto} --dport {port} -j DNAT --to-destination {ns_ip}:{port} 2>/dev/null || true", capture_output=False)
-        run_cmd(f"iptables -t nat -A PREROUTING -p {proto} --dport {port} -j DNAT --to-destination {ns_ip}:{port}", capture_output=False)
-        run_cmd(f"iptables -D FORWARD -p {proto} -d {ns_ip}/32 --dport {port} -j ACCEPT 2>/dev/null || true", capture_output=False)
-        run_cmd(f"iptables -I FORWARD 1 -p {proto} -d {ns_ip}/32 --dport {port} -j ACCEPT", capture_output=False)
-        run_cmd(f"iptables -D FORWARD -p {proto} -s {ns_ip}/32 -j ACCEPT 2>/dev/null || true", capture_output=False)
-        run_cmd(f"iptables -I FORWARD 1 -p {proto} -s {ns_ip}/32 -j ACCEPT", capture_output=False)
+    if ns_res.returncode != 0:
+        debug_log(f"restore_setup: some namespace ip commands failed: {ns_res.stderr.strip()}")
+    
+    ns_ipt = run_iptables_restore(ns_tunnel_rules(ns_ip, wg_name), ns=ns_name)
+    if ns_ipt.returncode != 0:
+        debug_log(f"restore_setup: namespace iptables-restore failed: {ns_ipt.stderr.strip()}")
+    
+    # NAT & firewall, DNAT + FORWARD
+    run_argv(["sysctl", "-w", "net.ipv4.ip_forward=1"], discard=True)
+    host_ipt = apply_host_tunnel_rules(port, ns_ip, subnet, veth_host)
+    if host_ipt.returncode != 0:
+        debug_log(f"restore_setup: host iptables-restore failed: {host_ipt.stderr.strip()}")
     
     # DNS
-    etc_ns = f"/etc/netns/{ns_name}"
-    os.makedirs(etc_ns, exist_ok=True)
-    with open(os.path.join(etc_ns, "resolv.conf"), "w", encoding="utf-8") as f:
-        f.write("nameserver 1.1.1.1\n")
+    write_netns_resolv_conf(ns_name)
     
     # Start Xray - force restart to ensure it starts after restore
-    if ensure_xray_binary():
+    if start_xray and ensure_xray_binary():
         refresh_uuids_for_all_namespaces(interactive=False, force_restart=True)
     
     print(f"{GREEN}✓ Tunnel on port {port} restored{NC}")
@@ -813,11 +2147,33 @@ def restore_setup(port: int, wg_config_path: str) -> bool:
     return True
 
 
+# First run of digits in a config file name (wg-443.conf, ns443.conf, ...)
+FILENAME_PORT_REGEX = re.compile(r"(\d+)")
+
+
+# Directories find_wg_config_for_port looks in
+WG_CONFIG_DIRS = ("/root", "/etc/wireguard", "/root/.config/wireguard")
+
+
 def find_wg_config_for_port(port: int) -> Optional[str]:
     """Try to find WireGuard config file for a given port.
     
-    Searches common locations and patterns.
+    Searches common locations and patterns. Results are cached until one of
+    the searched directories changes (any file added, removed or renamed
+    bumps the directory's mtime).
     """
+    key = []
+    for search_dir in WG_CONFIG_DIRS:
+        try:
+            key.append(os.stat(search_dir).st_mtime_ns)
+        except OSError:
+            key.append(None)
+    return _find_wg_config_for_port(port, tuple(key))
+
+
+@functools.lru_cache(maxsize=256)
+def _find_wg_config_for_port(port: int, dir_key: Tuple) -> Optional[str]:
+    """Uncached search behind find_wg_config_for_port; `dir_key` only keys the cache."""
     possible_configs = [
         f"/root/wg-{port}.conf",
         f"/root/wg{port}.conf",
@@ -832,31 +2188,28 @@ def find_wg_config_for_port(port: int) -> Optional[str]:
         if os.path.isfile(config_path):
             return config_path
     
-    # Search in /root for any .conf file with port in name
-    if os.path.isdir("/root"):
-        try:
-            for filename in os.listdir("/root"):
-                if filename.endswith(".conf") and str(port) in filename:
-                    config_path = os.path.join("/root", filename)
-                    if os.path.isfile(config_path):
-                        return config_path
-        except OSError:
-            pass
-    
-    # Search in /etc/wireguard
-    if os.path.isdir("/etc/wireguard"):
+    # Search /root, then /etc/wireguard, for any .conf file with port in name
+    port_str = str(port)
+    for search_dir in ("/root", "/etc/wireguard"):
         try:
-            for filename in os.listdir("/etc/wireguard"):
-                if filename.endswith(".conf") and str(port) in filename:
-                    config_path = os.path.join("/etc/wireguard", filename)
-                    if os.path.isfile(config_path):
-                        return config_path
+            with os.scandir(search_dir) as it:
+                for entry in it:
+                    if (
+                        entry.name.endswith(".conf")
+                        and port_str in entry.name
+                        and entry.is_file()
+                    ):
+                        return entry.path
         except OSError:
             pass
     
     return None
 
 
+# How much of a .conf file scan_wg_config_files reads to recognize it
+WG_CONFIG_HEAD_BYTES = 4096
+
+
 def scan_wg_config_files() -> List[Tuple[int, str]]:
     """Scan for WireGuard config files and try to extract port from filename.
     
@@ -867,38 +2220,33 @@ def scan_wg_config_files() -> List[Tuple[int, str]]:
     search_dirs = ["/root", "/etc/wireguard"]
     
     for search_dir in search_dirs:
-        if not os.path.isdir(search_dir):
+        try:
+            with os.scandir(search_dir) as it:
+                entries = [e for e in it if e.name.endswith(".conf") and e.is_file()]
+        except OSError:
             continue
         
-        try:
-            for filename in os.listdir(search_dir):
-                if not filename.endswith(".conf"):
-                    continue
-                
-                config_path = os.path.join(search_dir, filename)
-                if not os.path.isfile(config_path):
-                    continue
-                
-                # Try to extract port from filename
-                # Patterns: wg-{port}.conf, wg{port}.conf, ns-{port}.conf, etc.
-                import re
-                port_match = re.search(r'(\d+)', filename)
-                if port_match:
+        for entry in entries:
+            config_path = entry.path
+            
+            # Try to extract port from filename
+            # Patterns: wg-{port}.conf, wg{port}.conf, ns-{port}.conf, etc.
+            port_match = FILENAME_PORT_REGEX.search(entry.name)
+            if port_match:
+                try:
+                    port = int(port_match.group(1))
+                    # Verify it's a valid WireGuard config; the markers are
+                    # always near the top, so the head of the file is enough
                     try:
-                        port = int(port_match.group(1))
-                        # Verify it's a valid WireGuard config
-                        try:
-                            with open(config_path, 'r', encoding='utf-8') as f:
-                                content = f.read()
-                                if '[Interface]' in content or 'PrivateKey' in content:
-                                    tunnels.append((port, config_path))
-                                    debug_log(f"scan_wg_config_files: found config {config_path} for port {port}")
-                        except (OSError, UnicodeDecodeError):
-                            continue
-                    except ValueError:
+                        with open(config_path, 'rb') as f:
+                            head = f.read(WG_CONFIG_HEAD_BYTES)
+                    except OSError:
                         continue
-        except OSError:
-            continue
+                    if b'[Interface]' in head or b'PrivateKey' in head:
+                        tunnels.append((port, config_path))
+                        debug_log(f"scan_wg_config_files: found config {config_path} for port {port}")
+                except ValueError:
+                    continue
     
     return tunnels
 
@@ -912,8 +2260,7 @@ def detect_existing_tunnels() -> List[Tuple[int, str]]:
     tunnels = []
     
     # First, try to find from existing namespaces
-    res = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'", capture_output=True)
-    namespaces = [n for n in res.stdout.splitlines() if n.startswith("ns-")]
+    namespaces = sorted(n for n in _get_existing_netns() if n.startswith("ns-"))
     
     if namespaces:
         debug_log(f"detect_existing_tunnels: found {len(namespaces)} namespace(s)")
@@ -926,13 +2273,7 @@ def detect_existing_tunnels() -> List[Tuple[int, str]]:
                 continue
             
             # Get namespace IP to verify it's a valid tunnel
-            res_ip = run_cmd(
-                "ip -4 addr show 2>/dev/null "
-                "| grep -E 'inet [0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+' "
-                "| awk '{print $2}' | cut -d'/' -f1 | grep '^10\\.100' | head -1",
-                ns=ns_name,
-            )
-            ns_ip = res_ip.stdout.strip()
+            ns_ip = get_ns_tunnel_ip(ns_name)
             
             if not ns_ip:
                 continue
@@ -985,27 +2326,41 @@ def restore_all_setups() -> None:
     print(f"{BLUE}=== Restoring {len(tunnels)} tunnel(s) after reboot ==={NC}\n")
     debug_log(f"restore_all_setups: found {len(tunnels)} tunnel(s) to restore")
     
-    restored_count = 0
-    for port, wg_config_path in tunnels:
+    existing_ns = _get_existing_netns()
+    
+    def _restore_one(tunnel: Tuple[int, str]) -> bool:
+        port, wg_config_path = tunnel
         try:
             # Check if namespace already exists
             ns_name = f"ns-{port}"
-            ns_list = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'").stdout.split()
-            if ns_name in ns_list:
+            if ns_name in existing_ns:
                 print(f"{YELLOW}⚠ Tunnel on port {port} already exists, skipping{NC}")
                 debug_log(f"restore_all_setups: tunnel {port} already exists")
-                continue
+                return False
             
             if not wg_config_path or not os.path.isfile(wg_config_path):
                 print(f"{RED}✗ Config file not found for port {port}: {wg_config_path}{NC}")
                 debug_log(f"restore_all_setups: config not found for port {port}")
-                continue
+                return False
             
-            if restore_setup(port, wg_config_path):
-                restored_count += 1
+            # Xray is started once for all namespaces below
+            return restore_setup(port, wg_config_path, existing_ns, start_xray=False)
         except Exception as e:
             debug_log(f"restore_all_setups: failed to restore tunnel {port}: {e!r}")
             print(f"{RED}✗ Failed to restore tunnel on port {port}: {e}{NC}")
+            return False
+    
+    # Tunnels are independent and restore_setup mostly waits on ip/iptables,
+    # so restore them in parallel (iptables itself is serialized by
+    # IPTABLES_LOCK); `restore_workers` in the config bounds the pool
+    try:
+        workers = max(1, int(load_config().get("restore_workers", 8)))
+    except (TypeError, ValueError):
+        workers = 8
+    workers = min(len(tunnels), workers)
+    debug_log(f"restore_all_setups: restoring with {workers} worker(s)")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+        restored_count = sum(ex.map(_restore_one, tunnels))
     
     # After restoring all tunnels, ensure Xray is started for all of them
     # This is important because restore_setup() may have been called before panel state was loaded
@@ -1024,13 +2379,178 @@ def restore_all_setups() -> None:
         print(f"\n{YELLOW}No tunnels were restored (they may already be running).{NC}\n")
 
 
-def refresh_uuids_for_all_namespaces_noninteractive() -> None:
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class PanelDbWatch:
+    """Wake the UUID watcher as soon as the panel DB or the tunnel set changes.
+
+    Watches the directory containing the DB with inotify, so changes made
+    through `-journal`/`-wal` files and DB files replaced by rename are
+    seen too, and NETNS_RUN_DIR for tunnels being added or removed. If
+    inotify is unavailable, wait() simply sleeps. interrupt() ends a
+    pending wait() early, e.g. from a signal handler.
+    """
+
+    def __init__(self) -> None:
+        self.fd: Optional[int] = None
+        self.db_path: Optional[str] = None
+        self.netns_wd: Optional[int] = None
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        try:
+            fd = _libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            debug_log(f"panel_db_watch: inotify unavailable: {e!r}")
+            return
+        if fd < 0:
+            debug_log(f"panel_db_watch: inotify_init1 failed: errno={ctypes.get_errno()}")
+            return
+        self.fd = fd
+
+    @property
+    def event_driven(self) -> bool:
+        """True if every change the refresh reacts to arrives as an event."""
+        return self.fd is not None and self.db_path is not None and self.netns_wd is not None
+
+    def _watch_netns(self) -> None:
+        """Watch NETNS_RUN_DIR; retried per wait() until `ip netns` creates it."""
+        if self.fd is None or self.netns_wd is not None:
+            return
+        wd = _libc().inotify_add_watch(self.fd, os.fsencode(NETNS_RUN_DIR), IN_CREATE | IN_DELETE)
+        if wd >= 0:
+            self.netns_wd = wd
+            debug_log(f"panel_db_watch: watching {NETNS_RUN_DIR} for tunnel changes")
+
+    def _watch(self, db_path: str) -> None:
+        """(Re)target the watch when the configured DB path changes."""
+        if self.fd is None or db_path == self.db_path:
+            return
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        wd = _libc().inotify_add_watch(
+            self.fd,
+            os.fsencode(db_dir),
+            IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE,
+        )
+        if wd < 0:
+            debug_log(f"panel_db_watch: cannot watch {db_dir}: errno={ctypes.get_errno()}")
+            return
+        # Old watches are left in place; their events are filtered by name
+        self.db_path = db_path
+        debug_log(f"panel_db_watch: watching {db_dir} for {os.path.basename(db_path)}")
+
+    def _db_event_pending(self) -> bool:
+        """Drain queued events; True if any concerned the DB or its journals."""
+        assert self.fd is not None and self.db_path is not None
+        prefix = os.fsencode(os.path.basename(self.db_path))
+        hit = False
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return hit
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(buf):
+                wd, _, _, name_len = INOTIFY_EVENT.unpack_from(buf, offset)
+                offset += INOTIFY_EVENT.size
+                name = buf[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                if wd == self.netns_wd or name.startswith(prefix):
+                    hit = True
+
+    def interrupt(self) -> None:
+        """Make the current or next wait() return immediately."""
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    def wait(self, db_path: Optional[str], timeout: float) -> bool:
+        """Block until the DB changes, `timeout` seconds pass or interrupt().
+
+        Returns True if a change woke us up, False otherwise.
+        """
+        if db_path:
+            self._watch(db_path)
+        self._watch_netns()
+        fds = [self._wake_r]
+        if self.fd is not None and self.db_path is not None:
+            fds.append(self.fd)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            # Zero timeout still collects events queued in the meantime
+            remaining = max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select(fds, [], [], remaining)
+            if self._wake_r in readable:
+                self._drain_wake()
+                return False
+            if self.fd in readable and self._db_event_pending():
+                return True
+            if remaining <= 0:
+                return False
+
+    def _drain_wake(self) -> None:
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def pause(self, timeout: float) -> bool:
+        """Sleep `timeout` seconds without reacting to DB events.
+
+        Events keep queueing in the inotify fd and are collapsed into one
+        by the next wait(). Returns False if interrupt() cut the pause short.
+        """
+        if timeout <= 0:
+            return True
+        readable, _, _ = select.select([self._wake_r], [], [], timeout)
+        if readable:
+            self._drain_wake()
+            return False
+        return True
+
+
+def wait_for_next_refresh(
+    db_watch: PanelDbWatch, interval_seconds: float, consecutive_errors: int, started: float
+) -> None:
+    """Block the UUID watcher until its next refresh is due.
+
+    Refreshes stay at least `interval_seconds` apart (longer after errors),
+    measured from the start of the previous one: panels write to their DB
+    constantly, so inotify events only pull the next refresh forward to
+    that limit, never beyond it. Without an event the watcher waits up to
+    UUID_WATCHER_SAFETY_INTERVAL when inotify covers every trigger.
+    """
+    delay = _watcher_delay(interval_seconds, consecutive_errors)
+    if consecutive_errors:
+        debug_log(f"UUID watcher: {consecutive_errors} consecutive error(s), retrying in {delay}s")
+    idle = delay
+    if not consecutive_errors and db_watch.event_driven:
+        idle = max(delay, UUID_WATCHER_SAFETY_INTERVAL)
+    if not db_watch.pause(started + delay - time.monotonic()):
+        return
+    db_watch.wait(PANEL_DB_PATH, started + idle - time.monotonic())
+
+
+def refresh_uuids_for_all_namespaces_noninteractive() -> bool:
     """
     Non-interactive wrapper: only refresh if PANEL_DB_PATH is already set
     and points to an existing DB; otherwise just log and skip.
     
     This function is called every 5 seconds to fetch UUIDs from the panel
-    and restart Xray with the new list.
+    and restart Xray with the new list. Errors are logged, never raised;
+    returns False if the refresh failed so watchers can back off.
     """
     global PANEL_DB_PATH
 
@@ -1042,7 +2562,7 @@ def refresh_uuids_for_all_namespaces_noninteractive() -> None:
     if not db_path or not os.path.isfile(db_path):
         # If DB is not set, just log but don't stop the watcher
         # This keeps the watcher always active and waiting for DB to be set
-        return
+        return True
 
     # If DB exists, refresh UUIDs
     try:
@@ -1050,6 +2570,8 @@ def refresh_uuids_for_all_namespaces_noninteractive() -> None:
     except Exception as e:
         # Never stop the watcher, just log
         debug_log(f"refresh_uuids_for_all_namespaces_noninteractive error: {e!r}")
+        return False
+    return True
 
 
 def start_uuid_watcher(interval_seconds: int = 5) -> None:
@@ -1060,45 +2582,36 @@ def start_uuid_watcher(interval_seconds: int = 5) -> None:
     This watcher is always active and reads UUIDs from the panel every interval_seconds
     and restarts Xray with the new list so new users can also connect.
     """
-    global UUID_WATCHER_STARTED, UUID_WATCHER_LOCK
+    global UUID_WATCHER_INTERVAL
     
+    # Lock-free fast path; the lock only makes check-and-set atomic when
+    # two callers race to start the watcher
+    if UUID_WATCHER_STARTED.is_set():
+        debug_log("UUID watcher already started, skipping")
+        return
     with UUID_WATCHER_LOCK:
-        if UUID_WATCHER_STARTED:
+        if UUID_WATCHER_STARTED.is_set():
             debug_log("UUID watcher already started, skipping")
             return
-        UUID_WATCHER_STARTED = True
+        UUID_WATCHER_INTERVAL = interval_seconds
+        UUID_WATCHER_STARTED.set()
 
     def _loop() -> None:
         debug_log(f"UUID watcher started with interval={interval_seconds}s")
-        debug_log(f"Watcher will refresh UUIDs every {interval_seconds} seconds to keep user list updated")
+        debug_log(f"Watcher will refresh UUIDs on panel DB changes, at most every {interval_seconds} seconds")
         
         consecutive_errors = 0
-        max_consecutive_errors = 10
+        db_watch = PanelDbWatch()
         
-        while True:
-            try:
-                # Every interval_seconds, fetch UUIDs from panel and restart Xray
-                refresh_uuids_for_all_namespaces_noninteractive()
+        while not UUID_WATCHER_STOP.is_set():
+            started = time.monotonic()
+            # Every interval_seconds, fetch UUIDs from panel and restart Xray
+            if refresh_uuids_for_all_namespaces_noninteractive():
                 consecutive_errors = 0  # Reset error counter on success
-            except KeyboardInterrupt:
-                # Allow graceful shutdown
-                debug_log("UUID watcher interrupted by user")
-                break
-            except Exception as e:
+            else:
                 consecutive_errors += 1
-                debug_log(f"UUID watcher error (attempt {consecutive_errors}/{max_consecutive_errors}): {e!r}")
-                
-                # If consecutive errors are too many, wait a bit longer
-                if consecutive_errors >= max_consecutive_errors:
-                    debug_log(f"Too many consecutive errors, waiting {interval_seconds * 2}s before retry")
-                    time.sleep(interval_seconds * 2)
-                    consecutive_errors = 0
-                else:
-                    time.sleep(interval_seconds)
-                continue
-            
-            # Sleep after successful refresh
-            time.sleep(interval_seconds)
+            wait_for_next_refresh(db_watch, interval_seconds, consecutive_errors, started)
+        debug_log("UUID watcher stopped")
 
     t = threading.Thread(target=_loop, daemon=True, name="UUID-Watcher")
     t.start()
@@ -1145,25 +2658,25 @@ WantedBy=multi-user.target
             debug_log(f"ensure_uuid_watcher_service: created service file at {service_file}")
             
             # Reload systemd
-            run_cmd("systemctl daemon-reload", capture_output=False)
+            run_argv(["systemctl", "daemon-reload"], capture_output=False)
             debug_log("ensure_uuid_watcher_service: systemd daemon reloaded")
             
             # Enable service
-            run_cmd("systemctl enable setup-wg-uuid-watcher.service", capture_output=False)
+            run_argv(["systemctl", "enable", "setup-wg-uuid-watcher.service"], capture_output=False)
             debug_log("ensure_uuid_watcher_service: service enabled")
         except Exception as e:
             debug_log(f"ensure_uuid_watcher_service: failed to create service: {e!r}")
             return False
     
     # Check if service is running
-    status_cmd = run_cmd("systemctl is-active setup-wg-uuid-watcher.service", capture_output=True)
+    status_cmd = run_argv(["systemctl", "is-active", "setup-wg-uuid-watcher.service"])
     if status_cmd.returncode == 0 and "active" in status_cmd.stdout.lower():
         debug_log("ensure_uuid_watcher_service: service is already running")
         return True
     
     # Try to start the service
     try:
-        start_cmd = run_cmd("systemctl start setup-wg-uuid-watcher.service", capture_output=True)
+        start_cmd = run_argv(["systemctl", "start", "setup-wg-uuid-watcher.service"])
         if start_cmd.returncode == 0:
             debug_log("ensure_uuid_watcher_service: service started successfully")
             return True
@@ -1195,6 +2708,35 @@ def start_background_uuid_watcher() -> bool:
     return True
 
 
+# Matched on raw log bytes, so the other lines are never decoded
+MARZBAN_NEW_USER_REGEX = re.compile(rb'New user "[^"]*" added')
+
+
+def _marzban_log_cmd() -> List[str]:
+    """Command that follows Marzban's log from where the last follow stopped.
+
+    Talks to docker directly when the compose container can be found, so the
+    log can be resumed with --since instead of replaying it; otherwise falls
+    back to `marzban logs`.
+    """
+    if command_exists("docker"):
+        res = subprocess.run(
+            [
+                "docker", "ps",
+                "--filter", "label=com.docker.compose.service=marzban",
+                "--format", "{{.Names}}",
+            ],
+            capture_output=True,
+            text=True,
+        )
+        names = res.stdout.split()
+        if res.returncode == 0 and names:
+            since = get_state("marzban_log_since")
+            window = ["--since", since] if since else ["--tail", "0"]
+            return ["docker", "logs", "-f", *window, names[0]]
+    return ["marzban", "logs"]
+
+
 def start_marzban_log_watcher() -> None:
     """
     Watch Marzban logs (via docker logs -f) and refresh UUIDs whenever a new
@@ -1211,21 +2753,24 @@ def start_marzban_log_watcher() -> None:
     if PANEL_PANEL_NAME != "marzban":
         return
 
-    if not command_exists("marzban"):
-        debug_log("marzban log watcher: 'marzban' CLI not found, disabling watcher")
+    if not command_exists("marzban") and not command_exists("docker"):
+        debug_log("marzban log watcher: neither 'marzban' nor 'docker' found, disabling watcher")
         return
 
     MARZBAN_LOG_WATCHER_STARTED = True
 
     def _loop() -> None:
-        debug_log("marzban log watcher started using 'marzban logs'")
+        debug_log("marzban log watcher started")
+        # Users added before this point are picked up by the regular refresh
+        set_state("marzban_log_since", str(int(time.time())))
         while True:
             try:
                 # Follow logs; restart the loop if the command exits for any reason
                 # Use list format for better security
+                cmd = _marzban_log_cmd()
+                debug_log(f"marzban log watcher: following {' '.join(cmd)}")
                 proc = subprocess.Popen(
-                    ["marzban", "logs"],
-                    text=True,
+                    cmd,
                     stdout=subprocess.PIPE,
                     stderr=subprocess.DEVNULL,
                 )
@@ -1238,21 +2783,124 @@ def start_marzban_log_watcher() -> None:
                     time.sleep(5)
                     continue
 
-                for line in proc.stdout:
-                    line = line.strip()
-                    if not line:
-                        continue
+                for raw in proc.stdout:
                     # Example: marzban-1  | INFO:     New user "cQ0gJY" added
-                    if "New user" in line and "added" in line:
+                    if MARZBAN_NEW_USER_REGEX.search(raw):
+                        line = raw.decode("utf-8", "replace").strip()
                         debug_log(
                             f"marzban log watcher: detected new user in logs: {line}"
                         )
                         refresh_uuids_for_all_namespaces_noninteractive()
+                proc.wait()
             except Exception as e:  # pragma: no cover - defensive
                 debug_log(f"marzban log watcher error: {e}")
+            # Resume from here next time instead of replaying old lines
+            set_state("marzban_log_since", str(int(time.time())))
             # In case of any failure, wait a bit and then re-attach to logs
             time.sleep(5)
 
+
+# Xray is always started as `xray-ns -c /tmp/xray-<port>.json`
+XRAY_CONFIG_PATH_REGEX = re.compile(r"^/tmp/xray-(\d+)\.json$")
+
+
+def find_xray_pids() -> Dict[int, List[int]]:
+    """Map tunnel port -> PIDs of the xray-ns processes serving it.
+
+    One pass over /proc/<pid>/cmdline replaces an `ss -ltnp | grep | sed`
+    inside every namespace; PIDs are global, so no namespace is entered.
+    """
+    pids: Dict[int, List[int]] = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return pids
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                argv = f.read().split(b"\0")
+        except OSError:
+            continue
+        if not argv[0].endswith(b"xray-ns") or b"-c" not in argv:
+            continue
+        i = argv.index(b"-c")
+        if i + 1 >= len(argv):
+            continue
+        m = XRAY_CONFIG_PATH_REGEX.match(argv[i + 1].decode("utf-8", "replace"))
+        if m:
+            pids.setdefault(int(m.group(1)), []).append(int(entry))
+    return pids
+
+
+# Xray processes started by this process, by port; kept so they are reaped
+XRAY_PROCS: Dict[int, subprocess.Popen] = {}
+
+
+def start_xray_in_netns(ns: str, port: int) -> bool:
+    """Start `xray-ns -c /tmp/xray-<port>.json` in `ns`, detached.
+
+    Same as `nohup xray-ns ... > /tmp/xray-<port>.log 2>&1 &` under
+    `ip netns exec`, but without the sh process: ip execs Xray directly,
+    which gets its own session so it outlives us. `ip netns exec` is kept
+    because it bind-mounts /etc/netns/<ns>/resolv.conf for Xray's DNS.
+    """
+    old = XRAY_PROCS.pop(port, None)
+    if old is not None:
+        old.poll()
+    try:
+        with open(f"/tmp/xray-{port}.log", "wb") as log:
+            XRAY_PROCS[port] = subprocess.Popen(
+                ["ip", "netns", "exec", ns,
+                 "/usr/local/bin/xray-ns", "-c", f"/tmp/xray-{port}.json"],
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+    except OSError as e:
+        debug_log(f"start_xray_in_netns: failed to start xray in {ns}: {e!r}")
+        return False
+    return True
+
+
+def _pid_alive(pid: int) -> bool:
+    """True while `pid` exists and has not exited (zombies count as gone)."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return False
+    # State follows the parenthesized command name, which may contain spaces
+    return stat[stat.rfind(b")") + 2:stat.rfind(b")") + 3] != b"Z"
+
+
+def stop_pids(pids: List[int], timeout: float = 2.0) -> None:
+    """SIGTERM `pids` and wait until they are gone, SIGKILLing stragglers.
+
+    Polls every 10 ms instead of sleeping a fixed time, so callers can
+    rebind the ports as soon as the old processes have actually exited.
+    """
+    alive = set()
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            alive.add(pid)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + timeout
+    while alive and time.monotonic() < deadline:
+        time.sleep(0.01)
+        alive = {pid for pid in alive if _pid_alive(pid)}
+    for pid in alive:
+        debug_log(f"stop_pids: {pid} ignored SIGTERM, sending SIGKILL")
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
 def refresh_uuids_for_all_namespaces(interactive: bool = False, force_restart: bool = False) -> None:
     """Reload UUIDs from the configured panel DB and update files/restart Xray only if changed.
 
@@ -1266,7 +2914,14 @@ def refresh_uuids_for_all_namespaces(interactive: bool = False, force_restart: b
         force_restart: If True, restarts Xray even if UUIDs haven't changed.
                       Useful for restore after reboot.
     """
+    with UUID_REFRESH_LOCK:
+        _refresh_uuids_for_all_namespaces(interactive, force_restart)
+
+
+def _refresh_uuids_for_all_namespaces(interactive: bool, force_restart: bool) -> None:
+    """Body of refresh_uuids_for_all_namespaces; caller holds UUID_REFRESH_LOCK."""
     global PANEL_DB_PATH, LAST_UUID_COUNT, LAST_UUID_UPDATE_TS, LAST_UUID_HASH
+    global LAST_REFRESH_NAMESPACES
 
     db_path = PANEL_DB_PATH
     if not db_path or not os.path.isfile(db_path):
@@ -1290,10 +2945,22 @@ def refresh_uuids_for_all_namespaces(interactive: bool = False, force_restart: b
     last_db_mtime = load_last_db_mtime()
     db_file_changed = (last_db_mtime is None or current_db_mtime != last_db_mtime)
     
+    # Nothing to do if neither the DB nor the set of tunnels changed since
+    # the last full refresh in this process: skip SQLite and hashing
+    namespaces = {n for n in _get_existing_netns() if n.startswith("ns-")}
+    if (
+        not db_file_changed
+        and not force_restart
+        and LAST_UUID_HASH is not None
+        and namespaces == LAST_REFRESH_NAMESPACES
+    ):
+        debug_log("refresh: DB mtime and namespaces unchanged, skipping")
+        return
+    
     if db_file_changed:
+        # Only re-read; panels also write usage stats, so a new mtime alone
+        # does not mean the UUID set changed
         debug_log(f"refresh: DB file modified (mtime changed from {last_db_mtime} to {current_db_mtime})")
-        # Reset hash when DB file changes to force refresh
-        save_last_uuid_hash("")  # Clear old hash
     
     uuids = extract_uuids_from_sqlite(db_path)
     if not uuids:
@@ -1323,136 +2990,123 @@ def refresh_uuids_for_all_namespaces(interactive: bool = False, force_restart: b
     # Debug: log hash comparison
     debug_log(f"refresh: hash comparison - old={old_hash[:8] if old_hash else 'None'}, new={current_uuid_hash[:8]}, count={len(uuids)}, db_changed={db_file_changed}")
     
-    # Check if UUIDs actually changed (either hash changed or DB file changed)
+    # Check if the UUID set actually changed
     # If force_restart is True, always restart (useful after restore)
-    uuids_changed = (old_hash is None or old_hash != current_uuid_hash or db_file_changed or force_restart)
+    uuids_changed = (old_hash is None or old_hash != current_uuid_hash or force_restart)
     
+    # Namespaces created by this tool (ns-<port>), with their IP and port
+    bindings = get_tunnel_bindings()
+    xray_pids = find_xray_pids()
+
     if uuids_changed:
         if old_count is not None and old_count != len(uuids):
             debug_log(f"refresh: UUID count changed from {old_count} to {len(uuids)}")
         else:
             debug_log(f"refresh: UUID list changed (same count: {len(uuids)})")
     else:
-        debug_log(f"refresh: UUIDs unchanged ({len(uuids)} UUIDs), skipping restart")
         # Still update the file even if no restart needed
-        # Discover namespaces to update files
-        res = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'")
-        namespaces = [n for n in res.stdout.splitlines() if n.startswith("ns-")]
-        for ns in namespaces:
-            res_ip = run_cmd(
-                "ip -4 addr show 2>/dev/null "
-                "| grep -E 'inet [0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+' "
-                "| awk '{print $2}' | cut -d'/' -f1 | grep '^10\\.100' | head -1",
-                ns=ns,
-            )
-            ns_ip = res_ip.stdout.strip()
-            if not ns_ip:
-                continue
-            res_port = run_cmd(
-                f"iptables -t nat -S PREROUTING 2>/dev/null | grep 'to-destination {ns_ip}' "
-                "| head -1 | awk -F':' '{print $NF}' | awk '{print $1}'"
-            )
-            port_str = res_port.stdout.strip()
-            if port_str.isdigit():
-                port = int(port_str)
-                save_uuids_to_file(port, uuids)
-        return  # No restart needed
-
-    # Discover namespaces created by this tool (ns-<port>)
-    res = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'")
-    namespaces = [n for n in res.stdout.splitlines() if n.startswith("ns-")]
-    if not namespaces:
+        for _, port in bindings.values():
+            save_uuids_to_file(port, uuids)
+        # Tunnels without a running Xray (e.g. just created) are started;
+        # the others keep serving the unchanged list
+        bindings = {ns: b for ns, b in bindings.items() if b[1] not in xray_pids}
+        if not bindings:
+            debug_log(f"refresh: UUIDs unchanged ({len(uuids)} UUIDs), skipping restart")
+            LAST_REFRESH_NAMESPACES = namespaces
+            return  # No restart needed
+        debug_log(f"refresh: UUIDs unchanged, starting Xray in {len(bindings)} namespace(s) without it")
+
+    LAST_REFRESH_NAMESPACES = namespaces
+    if not bindings:
         debug_log("refresh: no namespaces found")
         return
 
-    debug_log(f"refresh: UUIDs changed, updating {len(namespaces)} namespace(s) with {len(uuids)} UUID(s)")
-
-    for ns in namespaces:
-        # Derive NS IP (10.100.X.2) from interface address
-        res_ip = run_cmd(
-            "ip -4 addr show 2>/dev/null "
-            "| grep -E 'inet [0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+' "
-            "| awk '{print $2}' | cut -d'/' -f1 | grep '^10\\.100' | head -1",
-            ns=ns,
-        )
-        ns_ip = res_ip.stdout.strip()
-        if not ns_ip:
-            debug_log(f"refresh: {ns} has no 10.100.x.x IP")
-            continue
-
-        res_port = run_cmd(
-            f"iptables -t nat -S PREROUTING 2>/dev/null | grep 'to-destination {ns_ip}' "
-            "| head -1 | awk -F':' '{print $NF}' | awk '{print $1}'"
-        )
-        port_str = res_port.stdout.strip()
-        if not port_str.isdigit():
-            debug_log(f"refresh: could not infer port for {ns} (ns_ip={ns_ip})")
-            continue
+    debug_log(f"refresh: UUIDs changed, updating {len(bindings)} namespace(s) with {len(uuids)} UUID(s)")
 
-        port = int(port_str)
-        
+    for ns, (ns_ip, port) in bindings.items():
         # Save UUIDs to file (always update file)
         save_uuids_to_file(port, uuids)
-        
-        debug_log(f"refresh: syncing {ns} on port {port} with {len(uuids)} UUID(s)")
 
-        if not ensure_xray_binary():
-            debug_log(f"refresh: ensure_xray_binary failed for {ns}")
-            continue
+    if not ensure_xray_binary():
+        debug_log("refresh: ensure_xray_binary failed, not restarting xray")
+        return
 
-        xray_config = f"/tmp/xray-{port}.json"
+    # Write every config first, then stop all old Xray processes at once so
+    # the wait for them to exit is paid once rather than per namespace
+    pids_to_kill = []
+    for ns, (ns_ip, port) in bindings.items():
+        debug_log(f"refresh: syncing {ns} on port {port} with {len(uuids)} UUID(s)")
         create_xray_config(
-            xray_config,
+            f"/tmp/xray-{port}.json",
             port,
             uuids,
             use_http_header=True,
             http_host="iran.ir",
             http_path="/",
         )
-
-        # Kill existing Xray processes on this port
-        res_pids = run_cmd(
-            f"ss -ltnp 2>/dev/null | grep ':{port} ' | sed -n 's/.*pid=\\([0-9]*\\).*/\\1/p'",
-            ns=ns,
-        )
-        pids = res_pids.stdout.split()
+        pids = xray_pids.get(port, [])
         if pids:
-            debug_log(f"refresh: killing old xray PIDs in {ns}: {' '.join(pids)}")
-            run_cmd(
-                f"kill {' '.join(pids)} 2>/dev/null || true",
-                ns=ns,
-                capture_output=False,
-            )
-            # Wait a bit for process to terminate
-            time.sleep(0.5)
+            debug_log(f"refresh: killing old xray PIDs in {ns}: {' '.join(map(str, pids))}")
+            pids_to_kill.extend(pids)
 
+    if pids_to_kill:
+        stop_pids(pids_to_kill)
+
+    for ns, (ns_ip, port) in bindings.items():
         # Start new Xray with updated config
-        run_cmd(
-            f"nohup /usr/local/bin/xray-ns -c {shlex.quote(xray_config)} "
-            f"> /tmp/xray-{port}.log 2>&1 &",
-            ns=ns,
-            capture_output=False,
-        )
-        debug_log(f"refresh: restarted xray-ns in {ns} on port {port} with {len(uuids)} UUID(s)")
+        if start_xray_in_netns(ns, port):
+            debug_log(f"refresh: restarted xray-ns in {ns} on port {port} with {len(uuids)} UUID(s)")
         
-    debug_log(f"refresh: completed updating all {len(namespaces)} namespace(s)")
+    debug_log(f"refresh: completed updating all {len(bindings)} namespace(s)")
+
+
+IPV4_REGEX = re.compile(r"[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+")
+
+
+GEO_API_HOST = "ip-api.com"
+GEO_API_TIMEOUT = 0.8  # seconds, per socket operation
+_GEO_CONN: Optional[http.client.HTTPConnection] = None
+_GEO_LOCK = threading.Lock()
+
+
+def _geo_api_get(path: str) -> str:
+    """GET `path` from the geo API over a kept-alive connection.
+
+    Returns the stripped body, or "" on any error. A reused connection the
+    server has since closed is retried once on a fresh one.
+    """
+    global _GEO_CONN
+    with _GEO_LOCK:
+        while True:
+            fresh = _GEO_CONN is None
+            if fresh:
+                _GEO_CONN = http.client.HTTPConnection(GEO_API_HOST, timeout=GEO_API_TIMEOUT)
+            try:
+                _GEO_CONN.request("GET", path)
+                return _GEO_CONN.getresponse().read().decode("utf-8", "replace").strip()
+            except (OSError, http.client.HTTPException) as e:
+                _GEO_CONN.close()
+                _GEO_CONN = None
+                if fresh:
+                    debug_log(f"geo_lookup: request failed: {e!r}")
+                    return ""
 
 
 def geo_lookup(ip: str) -> str:
     if not ip or ip == "N/A":
         return ""
-    if not re.match(r"^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+$", ip):
+    if not IPV4_REGEX.fullmatch(ip):
         return ""
     if ip in GEO_CACHE:
         return GEO_CACHE[ip]
 
-    try:
-        resp = run_cmd(
-            f'curl -s --max-time 0.8 "http://ip-api.com/csv/{ip}?fields=status,country,city"'
-        )
-        line = resp.stdout.strip()
-    except Exception:
-        line = ""
+    # Locations are kept across runs; an IP's location practically never moves
+    geo = get_state(f"geo:{ip}")
+    if geo is not None:
+        GEO_CACHE[ip] = geo
+        return geo
+
+    line = _geo_api_get(f"/csv/{ip}?fields=status,country,city")
 
     geo = ""
     if line:
@@ -1464,6 +3118,8 @@ def geo_lookup(ip: str) -> str:
                 geo = f"{city}, {country}"
 
     GEO_CACHE[ip] = geo
+    if geo:
+        set_state(f"geo:{ip}", geo)
     return geo
 
 
@@ -1477,9 +3133,13 @@ class VlessConfig:
     path: str = "/"
 
 
+# Compiled once at import; callers use the pattern's own methods so no
+# call goes through the re module's pattern cache. The bytes sibling is
+# derived from the same source so the two can never drift apart.
 UUID_REGEX = re.compile(
     r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
 )
+UUID_REGEX_BYTES = re.compile(UUID_REGEX.pattern.encode("ascii"))
 
 
 def parse_vless_uri(uri: str) -> Optional[VlessConfig]:
@@ -1490,52 +3150,55 @@ def parse_vless_uri(uri: str) -> Optional[VlessConfig]:
         return None
 
     config = VlessConfig()
-    # strip scheme
-    uri = uri.replace("vless://", "", 1)
-    # remove fragment
-    uri = uri.split("#", 1)[0]
-
-    if "?" in uri:
-        base, query = uri.split("?", 1)
-    else:
-        base, query = uri, ""
+    try:
+        parts = urlsplit(uri if "://" in uri else f"vless://{uri}")
+    except ValueError:
+        print(f"{RED}Invalid VLESS URI.{NC}")
+        return None
 
-    # base is uuid@host:port or just uuid
-    if "@" in base:
-        config.uuid = base.split("@", 1)[0]
-    else:
-        config.uuid = base
+    # netloc is uuid@host:port or just uuid
+    config.uuid = parts.netloc.split("@", 1)[0]
 
-    if query:
-        for p in query.split("&"):
-            if "=" not in p:
-                continue
-            key, val = p.split("=", 1)
-            if key == "type":
-                config.network = val
-            elif key == "security":
-                config.security = val
-            elif key == "headerType":
-                config.header_type = val
-            elif key == "host":
-                config.host_header = val
-            elif key == "path":
-                config.path = val
+    params = dict(parse_qsl(parts.query))
+    config.network = params.get("type", config.network)
+    config.security = params.get("security", config.security)
+    config.header_type = params.get("headerType", config.header_type)
+    config.host_header = params.get("host", config.host_header)
+    config.path = params.get("path", config.path)
 
     if config.network != "tcp":
         print(f"{RED}Only TCP VLESS URIs are supported by this script.{NC}")
         return None
 
-    uuid_re = re.compile(
-        r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$"
-    )
-    if not uuid_re.match(config.uuid):
+    if not UUID_REGEX.fullmatch(config.uuid):
         print(f"{RED}Invalid UUID in VLESS URI.{NC}")
         return None
 
     return config
 
 
+def _scan_uuid_bytes(data) -> Set[bytes]:
+    """Find every UUID in a bytes-like buffer.
+
+    Instead of trying the regex at every offset, jump between dashes with
+    find() (memchr) and only try a UUID starting 8 bytes before each one;
+    on random SQLite pages that skips the vast majority of the file.
+    """
+    found = set()
+    find = data.find
+    match = UUID_REGEX_BYTES.match
+    i = find(b"-", 8)
+    while i != -1:
+        m = match(data, i - 8)
+        if m:
+            found.add(m.group(0))
+            # The next UUID's first dash is at least 36 bytes further on
+            i = find(b"-", i + 36)
+        else:
+            i = find(b"-", i + 1)
+    return found
+
+
 def _extract_uuids_raw_file(db_path: str) -> List[str]:
     """Fallback: scan the raw SQLite file bytes and extract all UUID-looking substrings.
     
@@ -1550,39 +3213,85 @@ def _extract_uuids_raw_file(db_path: str) -> List[str]:
             f"raw_uuid_scan: reading {db_path} (size={size} bytes, "
             f"mtime={time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime))})"
         )
+        if size == 0:
+            # mmap refuses empty files and there is nothing to scan anyway
+            return []
         with open(db_path, "rb") as f:
-            data = f.read()
-    except OSError as e:
+            # Scan the page cache directly instead of copying the whole DB
+            # into the Python heap
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
         print(f"{RED}Failed to read database file {db_path}: {e}{NC}")
         debug_log(f"raw_uuid_scan: failed to read {db_path}: {e!r}")
         return []
 
-    # Try UTF-8 decode first (most common case)
-    text = data.decode("utf-8", errors="ignore")
-    matches = set()
-    if text:
-        matches = set(UUID_REGEX.findall(text))
-    
-    # Also scan raw bytes by sliding window to catch UUIDs that might be
-    # stored in binary format or with different encoding
-    # UUID format: 8-4-4-4-12 hex digits with dashes (36 bytes total)
-    for i in range(len(data) - 35):  # UUID is 36 chars, but we check 35 to be safe
-        try:
-            # Try to decode a 36-byte chunk as UTF-8
-            chunk = data[i:i+36]
-            chunk_str = chunk.decode("utf-8", errors="ignore")
-            # Check if this chunk matches UUID pattern
-            if len(chunk_str) == 36 and UUID_REGEX.match(chunk_str):
-                matches.add(chunk_str)
-        except (UnicodeDecodeError, IndexError):
-            # Skip invalid UTF-8 sequences
-            continue
+    # UUIDs are ASCII whether the surrounding page holds text or a blob, so
+    # the raw bytes are scanned without decoding the file
+    try:
+        matches = {u.decode("ascii") for u in _scan_uuid_bytes(data)}
+    finally:
+        data.close()
     
     all_matches = sorted(matches)
     debug_log(f"raw_uuid_scan: found {len(all_matches)} unique UUID(s) in file bytes")
     return all_matches
 
 
+def _scan_panel_tables(cur: sqlite3.Cursor, schema: Dict[str, List[str]], uuids: List[str]) -> None:
+    """Append UUIDs from the proxies/users tables of a panel DB to `uuids`."""
+    # 1) Marzban-style: UUIDs in proxies.settings JSON field
+    proxies_found = False
+    if "proxies" in schema:
+        cols = schema["proxies"]
+        debug_log(f"sqlite_uuid_scan: proxies table columns: {cols}")
+        if "settings" in cols and "user_id" in cols:
+            proxy_count = 0
+            rows = cur.execute(
+                'SELECT settings, user_id FROM "proxies" '
+                'WHERE type="VLESS" AND settings IS NOT NULL AND user_id IS NOT NULL'
+            ).fetchall()
+            for (settings_json, user_id) in rows:
+                proxy_count += 1
+                if settings_json and user_id:
+                    try:
+                        settings = json.loads(settings_json) if isinstance(settings_json, str) else settings_json
+                        if isinstance(settings, dict) and "id" in settings:
+                            uuid_val = settings["id"]
+                            if isinstance(uuid_val, str) and uuid_val.strip():
+                                uuids.append(uuid_val.strip())
+                                proxies_found = True
+                    except (json.JSONDecodeError, TypeError, AttributeError) as e:
+                        debug_log(f"sqlite_uuid_scan: error parsing proxy settings: {e!r}")
+                        continue
+            debug_log(f"sqlite_uuid_scan: processed {proxy_count} VLESS proxy(ies), found {len([u for u in uuids if u])} UUID(s) from proxies")
+    
+    # 2) Fallback: users.uuid column (for Marzban or x-ui)
+    # Always check users table - it's the primary source for Marzban
+    # This ensures we get all UUIDs even if proxies table is incomplete
+    if "users" in schema:
+        cols = schema["users"]
+        if "uuid" in cols:
+            users_count = 0
+            users_before = len(uuids)
+            seen: Set[str] = set(uuids)
+            # Let SQLite drop NULL, non-text and blank values during the scan
+            rows = cur.execute(
+                'SELECT uuid FROM "users" '
+                "WHERE typeof(uuid) = 'text' AND TRIM(uuid) != ''"
+            ).fetchall()
+            for (val,) in rows:
+                users_count += 1
+                v = val.strip()
+                if v and v not in seen:  # Avoid duplicates
+                    uuids.append(v)
+                    seen.add(v)
+            users_added = len(uuids) - users_before
+            debug_log(f"sqlite_uuid_scan: processed {users_count} user(s) from users table, added {users_added} new UUID(s)")
+            debug_log(f"sqlite_uuid_scan: processed {users_count} user(s) from users table")
+
+    debug_log(f"sqlite_uuid_scan: extracted {len(uuids)} UUID value(s) via SQL")
+
+
 def extract_uuids_from_sqlite(db_path: str) -> List[str]:
     """Prefer structured extraction for known schemas, then fall back to raw scan.
 
@@ -1597,75 +3306,16 @@ def extract_uuids_from_sqlite(db_path: str) -> List[str]:
     uuids: List[str] = []
 
     # Try structured extraction first (helpful for Marzban's users.uuid, etc.)
-    try:
-        debug_log(f"sqlite_uuid_scan: opening DB {db_path}")
-        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
-        cur = conn.cursor()
-
-        tables = [
-            r[0]
-            for r in cur.execute(
-                "SELECT name FROM sqlite_master WHERE type='table'"
-            ).fetchall()
-        ]
-
-        # 1) Marzban-style: UUIDs in proxies.settings JSON field
-        proxies_found = False
-        if "proxies" in tables:
-            cols = [
-                r[1]
-                for r in cur.execute('PRAGMA table_info("proxies")').fetchall()
-            ]
-            debug_log(f"sqlite_uuid_scan: proxies table columns: {cols}")
-            if "settings" in cols and "user_id" in cols:
-                proxy_count = 0
-                for (settings_json, user_id) in cur.execute('SELECT settings, user_id FROM "proxies" WHERE type="VLESS"'):
-                    proxy_count += 1
-                    if settings_json and user_id:
-                        try:
-                            settings = json.loads(settings_json) if isinstance(settings_json, str) else settings_json
-                            if isinstance(settings, dict) and "id" in settings:
-                                uuid_val = settings["id"]
-                                if isinstance(uuid_val, str) and uuid_val.strip():
-                                    uuids.append(uuid_val.strip())
-                                    proxies_found = True
-                        except (json.JSONDecodeError, TypeError, AttributeError) as e:
-                            debug_log(f"sqlite_uuid_scan: error parsing proxy settings: {e!r}")
-                            continue
-                debug_log(f"sqlite_uuid_scan: processed {proxy_count} VLESS proxy(ies), found {len([u for u in uuids if u])} UUID(s) from proxies")
-        
-        # 2) Fallback: users.uuid column (for Marzban or x-ui)
-        # Always check users table - it's the primary source for Marzban
-        # This ensures we get all UUIDs even if proxies table is incomplete
-        if "users" in tables:
-            cols = [
-                r[1]
-                for r in cur.execute('PRAGMA table_info("users")').fetchall()
-            ]
-            if "uuid" in cols:
-                users_count = 0
-                users_before = len(uuids)
-                for (val,) in cur.execute('SELECT uuid FROM "users"'):
-                    users_count += 1
-                    if isinstance(val, str):
-                        v = val.strip()
-                        if v and v not in uuids:  # Avoid duplicates
-                            uuids.append(v)
-                users_added = len(uuids) - users_before
-                debug_log(f"sqlite_uuid_scan: processed {users_count} user(s) from users table, added {users_added} new UUID(s)")
-                debug_log(f"sqlite_uuid_scan: processed {users_count} user(s) from users table")
-
-        debug_log(f"sqlite_uuid_scan: extracted {len(uuids)} UUID value(s) via SQL")
-
-        # 2) If nothing from known structured sources, fall back to raw scan
-    except sqlite3.Error as e:
-        # Log and fall back to raw
-        debug_log(f"sqlite_uuid_scan: sqlite error for {db_path}: {e!r}")
-    finally:
+    # over the connection kept open across watcher refreshes
+    with _PANEL_RO_LOCK:
         try:
-            conn.close()  # type: ignore[name-defined]
-        except Exception:
-            pass
+            cur = _get_panel_ro_conn(db_path).cursor()
+            schema = _get_panel_ro_schema(cur.connection)
+            _scan_panel_tables(cur, schema, uuids)
+        except (sqlite3.Error, OSError) as e:
+            # Log, drop the connection and fall back to raw
+            debug_log(f"sqlite_uuid_scan: sqlite error for {db_path}: {e!r}")
+            _close_panel_ro_conn()
 
     if not uuids:
         return _extract_uuids_raw_file(db_path)
@@ -1749,6 +3399,128 @@ def choose_uuids_from_panel() -> List[str]:
     return uuids
 
 
+# ns name -> (tunnel state key, vpn ip, location, monotonic fetch time)
+_VPN_IP_CACHE: Dict[str, Tuple[Tuple, str, str, float]] = {}
+VPN_IP_CACHE_TTL = 60.0
+
+
+def get_vpn_ip(ns: str, tunnel_status: str) -> Tuple[str, str]:
+    """Return (public IP, location) seen from namespace `ns`.
+
+    The public IP only changes when the tunnel is rebuilt or flaps, so a
+    result is reused for VPN_IP_CACHE_TTL seconds as long as the namespace
+    inode and the tunnel status are unchanged; only then is icanhazip.com
+    asked again.
+    """
+    try:
+        st = os.stat(os.path.join(NETNS_RUN_DIR, ns))
+        state_key: Tuple = (st.st_dev, st.st_ino, tunnel_status)
+    except OSError:
+        state_key = (None, None, tunnel_status)
+    now = time.monotonic()
+    cached = _VPN_IP_CACHE.get(ns)
+    if cached and cached[0] == state_key and now - cached[3] < VPN_IP_CACHE_TTL:
+        return cached[1], cached[2]
+
+    # Get VPN IP (with timeout to avoid hanging). Stays on the shell branch of
+    # run_cmd: `ip netns exec` bind-mounts the namespace's resolv.conf
+    vpn_ip_res = run_cmd(
+        "timeout 2 curl -s --max-time 1 http://icanhazip.com 2>/dev/null || echo 'N/A'",
+        ns=ns,
+    )
+    vpn_ip = vpn_ip_res.stdout.strip() or "N/A"
+    geo = geo_lookup(vpn_ip)
+    if vpn_ip != "N/A":
+        _VPN_IP_CACHE[ns] = (state_key, vpn_ip, geo, now)
+    else:
+        _VPN_IP_CACHE.pop(ns, None)
+    return vpn_ip, geo
+
+
+# Upper bound on namespaces probed in parallel by list_setups
+LIST_PROBE_WORKERS = 32
+
+
+def _probe_setup(ns: str, dnat_ports) -> Optional[Tuple[str, str, str, str, str, str]]:
+    """Collect the list_setups row for namespace `ns`, or None to skip it.
+
+    `dnat_ports` returns the host DNAT ip -> port map; it is shared by all
+    probes so the NAT table is read at most once per listing.
+    """
+    # The namespace may have been deleted since the listing
+    if not os.path.exists(os.path.join(NETNS_RUN_DIR, ns)):
+        debug_log(f"list_setups: namespace {ns} not found in netns list")
+        return None
+
+    if ns == "nsxray":
+        ns_ip = "10.200.200.2"
+        port = "9349"
+    else:
+        # Extract port from namespace name (ns-{port})
+        try:
+            port = ns.split("-")[1]
+        except (ValueError, IndexError):
+            port = "Unknown"
+        
+        ns_ip = get_ns_tunnel_ip(ns) or ""
+        
+        # If port extraction failed, try from iptables (one snapshot
+        # of the NAT table serves every namespace in the listing)
+        if port == "Unknown" and ns_ip:
+            dnat_map = dnat_ports()
+            if ns_ip in dnat_map:
+                port = str(dnat_map[ns_ip])
+
+    if not ns_ip:
+        # Debug: log why namespace was skipped
+        debug_log(f"list_setups: skipping {ns} - no IP found")
+        return None
+
+    # Check WireGuard tunnel status. `wg show all dump` prints one
+    # tab-separated line per interface (5 fields) and per peer (9 fields,
+    # latest handshake in the 6th as a unix time, 0 for never)
+    wg_output = run_argv(["wg", "show", "all", "dump"], ns=ns)
+    t_status = f"{RED}Down{NC}"
+    wg_iface = None
+    has_handshake = False
+    for line in wg_output.stdout.splitlines():
+        parts = line.split("\t")
+        if len(parts) == 5 and not wg_iface:
+            wg_iface = parts[0]
+        elif len(parts) >= 9:
+            wg_iface = wg_iface or parts[0]
+            if parts[5].isdigit() and int(parts[5]) > 0:
+                has_handshake = True
+
+    if wg_iface:
+        link_state = get_ns_link_states(ns).get(wg_iface, "")
+        if has_handshake:
+            # Has handshake = active connection
+            if link_state in ("UP", "UNKNOWN"):
+                t_status = f"{GREEN}Active{NC}"
+            else:
+                t_status = f"{YELLOW}Connecting{NC}"
+        elif link_state == "UP":
+            # No handshake but interface is up
+            t_status = f"{YELLOW}Connecting{NC}"
+
+    # Check Xray status
+    if port != "Unknown":
+        try:
+            port_int = int(port)
+            if port_int in get_ns_listening_tcp_ports(ns):
+                x_status = f"{GREEN}Running{NC}"
+            else:
+                x_status = f"{RED}Stopped{NC}"
+        except ValueError:
+            x_status = f"{YELLOW}?{NC}"
+    else:
+        x_status = f"{YELLOW}?{NC}"
+
+    vpn_ip, geo = get_vpn_ip(ns, t_status)
+    return (ns, port, t_status, x_status, vpn_ip, geo)
+
+
 def list_setups() -> None:
     print(f"{YELLOW}Active Setups:{NC}")
     print("------------------------------------------------------------------------")
@@ -1757,162 +3529,31 @@ def list_setups() -> None:
     )
     print("------------------------------------------------------------------------")
 
-    res = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'", capture_output=True)
-    namespaces = [
-        n for n in res.stdout.splitlines() if n.startswith("ns-") or n == "nsxray"
-    ]
+    namespaces = sorted(
+        n for n in _get_existing_netns() if n.startswith("ns-") or n == "nsxray"
+    )
     if not namespaces:
         print("No active setups found.\n")
         print("To create a new setup, select option 1 from the menu.\n")
         return
 
-    found_any = False
-    for ns in namespaces:
-        # verify still exists - ip netns list returns "ns-xxx (id: N)" format
-        # So we check if any line starts with the namespace name
-        ns_check = run_cmd("ip netns list 2>/dev/null", capture_output=True)
-        if ns_check.returncode != 0:
-            continue
-        # Check if namespace exists (handle "ns-xxx (id: N)" format)
-        ns_exists = any(line.strip().startswith(ns) for line in ns_check.stdout.splitlines())
-        if not ns_exists:
-            debug_log(f"list_setups: namespace {ns} not found in netns list")
-            continue
-
-        if ns == "nsxray":
-            ns_ip = "10.200.200.2"
-            port = "9349"
-        else:
-            # Extract port from namespace name (ns-{port})
-            try:
-                port = ns.split("-")[1]
-            except (ValueError, IndexError):
-                port = "Unknown"
-            
-            res_ip = run_cmd(
-                "ip -4 addr show 2>/dev/null "
-                "| grep -E 'inet [0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+' "
-                "| awk '{print $2}' | cut -d'/' -f1 | grep '^10\\.100' | head -1",
-                ns=ns,
-            )
-            ns_ip = res_ip.stdout.strip()
-            
-            # If port extraction failed, try from iptables
-            if port == "Unknown" and ns_ip:
-                res_port = run_cmd(
-                    f"iptables -t nat -S PREROUTING 2>/dev/null | grep 'to-destination {ns_ip}' "
-                    "| head -1 | awk -F':' '{{print $NF}}' | awk '{{print $1}}'",
-                    capture_output=True,
-                )
-                port = res_port.stdout.strip() or "Unknown"
-
-        if not ns_ip:
-            # Debug: log why namespace was skipped
-            debug_log(f"list_setups: skipping {ns} - no IP found")
-            continue
-
-        found_any = True
-
-        # Check WireGuard tunnel status
-        wg_output = run_cmd("wg show 2>/dev/null", ns=ns)
-        t_status = f"{RED}Down{NC}"
-        wg_iface = None
-        
-        if wg_output.stdout.strip():
-            # Parse wg show output to find interface name and handshake status
-            lines = wg_output.stdout.splitlines()
-            has_handshake = False
-            
-            for i, line in enumerate(lines):
-                line_stripped = line.strip()
-                # Interface name is usually the first non-empty line or after "interface:"
-                if "interface:" in line_stripped.lower():
-                    # Next line or same line might have interface name
-                    if ":" in line_stripped:
-                        wg_iface = line_stripped.split(":")[-1].strip()
-                elif line_stripped and not line_stripped.startswith("interface:") and not wg_iface:
-                    # First meaningful line is usually interface name
-                    if ":" in line_stripped:
-                        wg_iface = line_stripped.split(":")[0].strip()
-                
-                # Check for handshake
-                if "latest handshake" in line_stripped.lower() or "handshake" in line_stripped.lower():
-                    # Extract handshake time if present
-                    has_handshake = True
-            
-            # If no interface found, try to get from ip link
-            if not wg_iface:
-                wg_list = run_cmd("ip link show type wireguard 2>/dev/null | grep -o '^[0-9]*: [^:]*' | cut -d' ' -f2", ns=ns)
-                if wg_list.stdout.strip():
-                    wg_iface = wg_list.stdout.strip().split()[0] if wg_list.stdout.strip() else None
-            
-            # Determine status based on handshake and interface state
-            if has_handshake:
-                # Has handshake = active connection
-                if wg_iface:
-                    link_state_res = run_cmd(
-                        f"ip link show {shlex.quote(wg_iface)} 2>/dev/null | grep -o 'state [A-Z]*'",
-                        ns=ns,
-                    )
-                    link_state = link_state_res.stdout.strip()
-                    if "UP" in link_state or "UNKNOWN" in link_state:
-                        t_status = f"{GREEN}Active{NC}"
-                    else:
-                        t_status = f"{YELLOW}Connecting{NC}"
-                else:
-                    t_status = f"{GREEN}Active{NC}"
-            elif wg_iface:
-                # No handshake but interface exists - check if it's up
-                link_state_res = run_cmd(
-                    f"ip link show {shlex.quote(wg_iface)} 2>/dev/null | grep -o 'state [A-Z]*'",
-                    ns=ns,
-                )
-                link_state = link_state_res.stdout.strip()
-                if "UP" in link_state:
-                    t_status = f"{YELLOW}Connecting{NC}"
-                else:
-                    t_status = f"{RED}Down{NC}"
-            else:
-                # Interface exists but no clear status
-                t_status = f"{YELLOW}Connecting{NC}"
-
-        # Check Xray status
-        if port != "Unknown":
-            try:
-                port_int = int(port)
-                xray_check = run_cmd(
-                    f"ss -ltnp 2>/dev/null | grep -q ':{port_int} '", 
-                    ns=ns, 
-                    capture_output=False
-                )
-                if xray_check.returncode == 0:
-                    x_status = f"{GREEN}Running{NC}"
-                else:
-                    x_status = f"{RED}Stopped{NC}"
-            except ValueError:
-                x_status = f"{YELLOW}?{NC}"
-        else:
-            x_status = f"{YELLOW}?{NC}"
+    # Probes are independent and mostly wait on sockets, so run them side
+    # by side; ex.map keeps the rows in namespace order
+    dnat_ports = functools.lru_cache(maxsize=1)(get_dnat_port_map)
+    workers = min(len(namespaces), LIST_PROBE_WORKERS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+        rows = [
+            row
+            for row in ex.map(lambda ns: _probe_setup(ns, dnat_ports), namespaces)
+            if row is not None
+        ]
 
-        # Get VPN IP (with timeout to avoid hanging)
-        vpn_ip_res = run_cmd(
-            "timeout 2 curl -s --max-time 1 http://icanhazip.com 2>/dev/null || echo 'N/A'",
-            ns=ns,
-        )
-        vpn_ip = vpn_ip_res.stdout.strip() or "N/A"
-        if not vpn_ip or vpn_ip == "":
-            vpn_ip = "N/A"
-        geo = geo_lookup(vpn_ip)
-
-        # Format output - remove color codes from status for proper alignment
-        t_status_clean = t_status.replace(GREEN, "").replace(RED, "").replace(YELLOW, "").replace(NC, "")
-        x_status_clean = x_status.replace(GREEN, "").replace(RED, "").replace(YELLOW, "").replace(NC, "")
-        
+    for ns, port, t_status, x_status, vpn_ip, geo in rows:
         print(
             f"{ns:<12} {port:<8} {t_status:<10} {x_status:<10} {vpn_ip:<15} {geo:<25}"
         )
 
-    if not found_any:
+    if not rows:
         print("No active setups found.\n")
         print("To create a new setup, select option 1 from the menu.")
     print()
@@ -1939,8 +3580,7 @@ def read_port(prompt: str) -> int:
             print(f"{RED}Invalid port.{NC}")
             continue
         # check in use
-        res = run_cmd(f"ss -ltn | grep -q ':{port} '", capture_output=False)
-        if res.returncode == 0:
+        if port in _read_listening_tcp_ports():
             ans = input(
                 f"{YELLOW}Port {port} is in use. Continue? (y/n){NC}\n> "
             ).strip()
@@ -1949,40 +3589,54 @@ def read_port(prompt: str) -> int:
         return port
 
 
-def resolve_endpoint_ip(wg_config: str) -> Tuple[str, str]:
+@functools.lru_cache(maxsize=128)
+def _resolve_ipv4(host: str) -> str:
+    """Resolve `host` to its first IPv4 address through the system resolver.
+
+    Failures raise (socket.gaierror) and so are not cached; a later call
+    tries again.
+    """
+    return socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_DGRAM)[0][4][0]
+
+
+def resolve_endpoint_ip(endpoint: str) -> Tuple[str, str]:
     """
-    Resolve WireGuard endpoint hostname to IP address.
+    Resolve a WireGuard Endpoint value ("host:port") to an IP address.
     
     Args:
-        wg_config: Path to WireGuard configuration file
+        endpoint: Endpoint value from the config, e.g. from parse_wg_config
         
     Returns:
         Tuple of (hostname, ip_address). IP may be empty if resolution fails.
     """
-    with open(wg_config, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-    endpoint_line = ""
-    for line in lines:
-        if line.strip().lower().startswith("endpoint"):
-            endpoint_line = line
-            break
-    endpoint = endpoint_line.split("=", 1)[1].strip() if "=" in endpoint_line else ""
     host = endpoint.split(":", 1)[0] if endpoint else ""
     endpoint_ip = ""
     if host:
-        for cmd in (
-            f"getent ahosts {shlex.quote(host)} 2>/dev/null | awk '{{print $1}}' | head -1",
-            f"host {shlex.quote(host)} 2>/dev/null | grep 'has address' | head -1 | awk '{{print $4}}'",
-            f"dig +short {shlex.quote(host)} 2>/dev/null | grep -E '^[0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+$' | head -1",
-        ):
-            res = run_cmd(cmd)
-            ip = res.stdout.strip()
-            if ip:
-                endpoint_ip = ip
-                break
+        try:
+            endpoint_ip = _resolve_ipv4(host)
+        except (OSError, UnicodeError) as e:
+            debug_log(f"resolve_endpoint_ip: cannot resolve {host}: {e!r}")
     return host, endpoint_ip
 
 
+XRAY_DOWNLOAD_URL = "https://github.com/XTLS/Xray-core/releases/latest/download/Xray-linux-64.zip"
+XRAY_DOWNLOAD_TIMEOUT = 30
+
+
+XRAY_SEARCH_DIRS = ("/usr/local/x-ui/bin", "/usr/bin", "/usr/local/bin")
+XRAY_BINARY_NAMES = ("xray-linux-amd64", "xray")
+
+
+def find_existing_xray() -> str:
+    """Return the first xray binary found under XRAY_SEARCH_DIRS, or ""."""
+    for top in XRAY_SEARCH_DIRS:
+        for root, _dirs, files in os.walk(top):
+            for name in files:
+                if name in XRAY_BINARY_NAMES:
+                    return os.path.join(root, name)
+    return ""
+
+
 def ensure_xray_binary() -> bool:
     """
     Ensure Xray binary exists at /usr/local/bin/xray-ns.
@@ -1996,11 +3650,7 @@ def ensure_xray_binary() -> bool:
         return True
 
     # search for existing xray
-    res = run_cmd(
-        "find /usr/local/x-ui/bin /usr/bin /usr/local/bin "
-        "-name 'xray-linux-amd64' -o -name 'xray' 2>/dev/null | head -1"
-    )
-    xray_bin = res.stdout.strip()
+    xray_bin = find_existing_xray()
     if xray_bin and os.path.isfile(xray_bin) and os.access(xray_bin, os.X_OK):
         try:
             subprocess.run(
@@ -2012,51 +3662,35 @@ def ensure_xray_binary() -> bool:
             pass
 
     print(f"{YELLOW}Xray binary not found. Downloading...{NC}")
-    os.chdir("/tmp")
-    download_ok = False
-    if command_exists("wget"):
-        r = run_cmd(
-            "wget -q https://github.com/XTLS/Xray-core/releases/latest/download/Xray-linux-64.zip -O xray.zip",
-            capture_output=False,
-        )
-        download_ok = r.returncode == 0
-    elif command_exists("curl"):
-        r = run_cmd(
-            "curl -L -s https://github.com/XTLS/Xray-core/releases/latest/download/Xray-linux-64.zip -o xray.zip",
-            capture_output=False,
-        )
-        download_ok = r.returncode == 0
-    else:
-        print(f"{RED}Neither wget nor curl found. Cannot download Xray.{NC}")
-        return False
-
-    if not download_ok or not os.path.isfile("xray.zip"):
+    zip_path = "/tmp/xray.zip"
+    tmp_bin = "/tmp/xray-ns.tmp"
+    try:
+        # Stream straight to disk; the archive is ~20 MB
+        with urllib.request.urlopen(XRAY_DOWNLOAD_URL, timeout=XRAY_DOWNLOAD_TIMEOUT) as resp, \
+                open(zip_path, "wb") as out:
+            shutil.copyfileobj(resp, out, 1 << 20)
+    except (OSError, ValueError) as e:
+        debug_log(f"ensure_xray_binary: download failed: {e!r}")
         print(f"{RED}Failed to download Xray{NC}")
         return False
 
-    if not command_exists("unzip"):
-        print(f"{YELLOW}unzip not found. Trying to install...{NC}")
-        if command_exists("apt-get"):
-            run_cmd("apt-get update >/dev/null 2>&1 && apt-get install -y unzip >/dev/null 2>&1",
-                    capture_output=False)
-        elif command_exists("yum"):
-            run_cmd("yum install -y unzip >/dev/null 2>&1", capture_output=False)
-        elif command_exists("dnf"):
-            run_cmd("dnf install -y unzip >/dev/null 2>&1", capture_output=False)
-
-    if not command_exists("unzip"):
-        print(f"{RED}unzip is required but not available. Please install unzip manually.{NC}")
-        return False
-
-    unzip_res = run_cmd("unzip -q -o xray.zip xray 2>/dev/null", capture_output=False)
-    if unzip_res.returncode != 0 or not os.path.isfile("xray"):
+    try:
+        with zipfile.ZipFile(zip_path) as zf, zf.open("xray") as src, \
+                open(tmp_bin, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        debug_log(f"ensure_xray_binary: extract failed: {e!r}")
         print(f"{RED}Failed to extract Xray{NC}")
         return False
+    finally:
+        try:
+            os.remove(zip_path)
+        except OSError:
+            pass
 
-    os.chmod("xray", 0o755)
+    os.chmod(tmp_bin, 0o755)
     os.makedirs("/usr/local/bin", exist_ok=True)
-    os.replace("xray", "/usr/local/bin/xray-ns")
-    os.remove("xray.zip")
+    os.replace(tmp_bin, "/usr/local/bin/xray-ns")
     print(f"{GREEN}Xray downloaded and installed to /usr/local/bin/xray-ns{NC}")
     return True
 
@@ -2083,89 +3717,61 @@ def create_xray_config(
         else:
             debug_log(f"create_xray_config: no UUIDs provided and file not found for port {port}")
     
-    # Build clients JSON array from list of UUIDs
-    clients_entries = ",\n                    ".join(
-        f'{{\n                        "id": "{u}",\n                        "flow": ""\n                    }}'
-        for u in uuids
-    )
-
+    stream_settings: Dict = {"network": "tcp", "security": "none"}
     if use_http_header:
-        config = f"""
-{{
-    "log": {{
-        "loglevel": "warning"
-    }},
-    "inbounds": [
-        {{
-            "listen": "0.0.0.0",
-            "port": {port},
-            "protocol": "vless",
-            "settings": {{
-                "clients": [
-                    {clients_entries}
-                ],
-                "decryption": "none"
-            }},
-            "streamSettings": {{
-                "network": "tcp",
-                "security": "none",
-                "tcpSettings": {{
-                    "header": {{
-                        "type": "http",
-                        "request": {{
-                            "version": "1.1",
-                            "method": "GET",
-                            "path": ["{http_path}"],
-                            "headers": {{
-                                "Host": ["{http_host}"]
-                            }}
-                        }}
-                    }}
-                }}
-            }}
-        }}
-    ],
-    "outbounds": [
-        {{
-            "protocol": "freedom",
-            "tag": "direct"
-        }}
-    ]
-}}
-"""
-    else:
-        config = f"""
-{{
-    "log": {{
-        "loglevel": "warning"
-    }},
-    "inbounds": [
-        {{
-            "listen": "0.0.0.0",
-            "port": {port},
-            "protocol": "vless",
-            "settings": {{
-                "clients": [
-                    {clients_entries}
-                ],
-                "decryption": "none"
-            }},
-            "streamSettings": {{
-                "network": "tcp",
-                "security": "none"
-            }}
-        }}
-    ],
-    "outbounds": [
-        {{
-            "protocol": "freedom",
-            "tag": "direct"
-        }}
-    ]
-}}
-"""
+        stream_settings["tcpSettings"] = {
+            "header": {
+                "type": "http",
+                "request": {
+                    "version": "1.1",
+                    "method": "GET",
+                    "path": [http_path],
+                    "headers": {"Host": [http_host]},
+                },
+            }
+        }
+
+    config = {
+        "log": {"loglevel": "warning"},
+        "inbounds": [
+            {
+                "listen": "0.0.0.0",
+                "port": port,
+                "protocol": "vless",
+                "settings": {
+                    "clients": [{"id": u, "flow": ""} for u in uuids],
+                    "decryption": "none",
+                },
+                "streamSettings": stream_settings,
+            }
+        ],
+        "outbounds": [{"protocol": "freedom", "tag": "direct"}],
+    }
     with open(path, "w", encoding="utf-8") as f:
-        f.write(config.strip() + "\n")
+        f.write(json.dumps(config, indent=4) + "\n")
+
+
+def start_setup_xray(port: int, ns_name: str, interactive: bool = False) -> bool:
+    """Start Xray for a freshly created tunnel; False if no Xray binary.
+
+    With `interactive` the UUID refresh may ask for the panel DB, so only
+    the main thread may pass it.
+    """
+    if not ensure_xray_binary():
+        print(f"{RED}Failed to ensure Xray binary. Skipping Xray auto-start.{NC}")
+        return False
+
+    # Under the refresh lock, so a refresh from the watcher cannot start
+    # Xray between the kill and our own refresh
+    with UUID_REFRESH_LOCK:
+        # kill existing Xray on port
+        pids = get_listening_pids(port, ns_name)
+        if pids:
+            stop_pids(pids)
+
+        # --- configure Xray using current DB and start it for this one namespace ---
+        refresh_uuids_for_all_namespaces(interactive=interactive)
+    return True
 
 
 def create_setup() -> None:
@@ -2173,235 +3779,65 @@ def create_setup() -> None:
     wg_config = read_nonempty_path(f"{YELLOW}Enter WireGuard config file path:{NC}\n> ")
     port = read_port(f"{YELLOW}Enter port number:{NC}\n> ")
 
-    # Calculate subnet octet: use port % 250 + 2 to avoid conflicts
-    # (port 250 and 500 would both map to 1, so we use +2)
-    subnet_octet = (port % 250) + 2
-    ns_name = f"ns-{port}"
-    veth_host = f"veth-{port}"
-    veth_ns = f"vpeer-{port}"
-    host_ip = f"10.100.{subnet_octet}.1"
-    ns_ip = f"10.100.{subnet_octet}.2"
-    subnet = f"10.100.{subnet_octet}.0/24"
+    topo = tunnel_topology(port)
+    ns_name, veth_host, veth_ns = topo.ns_name, topo.veth_host, topo.veth_ns
+    host_ip, ns_ip, subnet = topo.host_ip, topo.ns_ip, topo.subnet
 
     print(f"{BLUE}Setting up {ns_name} on port {port}...{NC}")
 
+    wg_name = wg_interface_name(port)
+    host_batch, cleanup_batch = tunnel_link_batches(ns_name, veth_host, veth_ns, host_ip, wg_name)
+
     # cleanup existing
     print(f"{YELLOW}Cleaning up any existing setup...{NC}")
-    run_cmd(f"ip netns delete {shlex.quote(ns_name)} 2>/dev/null || true", capture_output=False)
-    run_cmd(f"ip link delete {shlex.quote(veth_host)} 2>/dev/null || true", capture_output=False)
+    run_ip_batch(cleanup_batch, discard=True)
 
     # iptables cleanup
-    run_cmd(
-        f"iptables -t nat -D PREROUTING -p tcp --dport {port} -j DNAT --to-destination {ns_ip}:{port} 2>/dev/null || true",
-        capture_output=False,
-    )
-    run_cmd(
-        f"iptables -t nat -D PREROUTING -p udp --dport {port} -j DNAT --to-destination {ns_ip}:{port} 2>/dev/null || true",
-        capture_output=False,
-    )
-    run_cmd(
-        f"iptables -t nat -D POSTROUTING -s {subnet} ! -o {veth_host} -j MASQUERADE 2>/dev/null || true",
-        capture_output=False,
-    )
-    for proto in ("tcp", "udp"):
-        run_cmd(
-            f"iptables -D FORWARD -p {proto} -d {ns_ip}/32 --dport {port} -j ACCEPT 2>/dev/null || true",
-            capture_output=False,
-        )
-        run_cmd(
-            f"iptables -D FORWARD -p {proto} -s {ns_ip}/32 -j ACCEPT 2>/dev/null || true",
-            capture_output=False,
-        )
+    iptables_delete_rules(host_tunnel_rules(port, ns_ip, subnet, veth_host))
 
-    # resolve endpoint
-    endpoint_host, endpoint_ip = resolve_endpoint_ip(wg_config)
+    # read the config once; resolve endpoint
+    wg_address, wg_endpoint, wg_setconf_text = parse_wg_config(wg_config)
+    endpoint_host, endpoint_ip = resolve_endpoint_ip(wg_endpoint)
     if not endpoint_ip:
         print(f"{RED}Could not resolve endpoint: {endpoint_host}{NC}")
         return
 
-    print(f"{BLUE}Creating namespace and veth pair...{NC}")
-    # namespace and veth
-    if run_cmd(f"ip netns add {shlex.quote(ns_name)}", capture_output=False).returncode != 0:
-        run_cmd(f"ip netns delete {shlex.quote(ns_name)} 2>/dev/null || true",
-                capture_output=False)
-        time.sleep(2)
-        if run_cmd(f"ip netns add {shlex.quote(ns_name)}", capture_output=False).returncode != 0:
-            print(
-                f"{RED}Failed to create namespace after cleanup. Please check manually.{NC}"
-            )
-            return
-
-    run_cmd(f"ip link delete {shlex.quote(veth_host)} 2>/dev/null || true", capture_output=False)
-    time.sleep(1)
-    if run_cmd(
-        f"ip link add {shlex.quote(veth_host)} type veth peer name {shlex.quote(veth_ns)}",
-        capture_output=False,
-    ).returncode != 0:
-        print(f"{RED}Failed to create veth pair. Cleaning up...{NC}")
-        run_cmd(f"ip netns delete {shlex.quote(ns_name)} 2>/dev/null || true",
-                capture_output=False)
+    print(f"{BLUE}Creating namespace, veth pair and WireGuard interface...{NC}")
+    host_res = create_tunnel_links(host_batch, cleanup_batch)
+    if host_res.returncode != 0:
+        print(
+            f"{RED}Failed to create namespace/interfaces: {host_res.stderr.strip()}. "
+            f"Please check manually.{NC}"
+        )
         return
 
-    run_cmd(f"ip link set {shlex.quote(veth_host)} up", capture_output=False)
-    run_cmd(f"ip addr flush dev {shlex.quote(veth_host)} 2>/dev/null || true", capture_output=False)
-    run_cmd(f"ip addr add {host_ip}/24 dev {shlex.quote(veth_host)}", capture_output=False)
-
-    run_cmd(
-        f"ip link set {shlex.quote(veth_ns)} netns {shlex.quote(ns_name)}",
-        capture_output=False,
-    )
-    run_cmd("ip link set lo up", ns=ns_name, capture_output=False)
-    run_cmd(f"ip link set {shlex.quote(veth_ns)} up", ns=ns_name, capture_output=False)
-    run_cmd(
-        f"ip addr flush dev {shlex.quote(veth_ns)} 2>/dev/null || true",
-        ns=ns_name,
-        capture_output=False,
-    )
-    run_cmd(
-        f"ip addr add {ns_ip}/24 dev {shlex.quote(veth_ns)}",
-        ns=ns_name,
-        capture_output=False,
-    )
-
     print(f"{BLUE}Setting up WireGuard...{NC}")
-    # WG name
-    wg_name = ""
-    if command_exists("md5sum"):
-        res = run_cmd(f"echo {port} | md5sum | cut -c1-8")
-        wg_name = f"wg-{res.stdout.strip()}"
-    elif command_exists("md5"):
-        res = run_cmd(f"echo {port} | md5 | cut -c1-8")
-        wg_name = f"wg-{res.stdout.strip()}"
-    else:
-        wg_name = f"wg-{(port * 31):08x}"[:11]
-
-    wg_address = "10.0.0.2/32"
-    with open(wg_config, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip().lower().startswith("address"):
-                wg_address = line.split("=", 1)[1].strip()
-                break
-
-    # cleanup existing WG
-    run_cmd(
-        f"ip netns exec {shlex.quote(ns_name)} ip link delete {shlex.quote(wg_name)} 2>/dev/null || true",
-        capture_output=False,
-    )
-    run_cmd(f"ip link delete {shlex.quote(wg_name)} 2>/dev/null || true", capture_output=False)
-    time.sleep(1)
-
-    if run_cmd(f"ip link add {shlex.quote(wg_name)} type wireguard", capture_output=False).returncode != 0:
-        print(f"{RED}Failed to create WireGuard interface. Cleaning up...{NC}")
-        run_cmd(f"ip link delete {shlex.quote(veth_host)} 2>/dev/null || true",
-                capture_output=False)
-        run_cmd(f"ip netns delete {shlex.quote(ns_name)} 2>/dev/null || true",
-                capture_output=False)
-        return
-
-    # configure wg
-    filter_cmd = (
-        r"grep -vE '^(Address|DNS|Table|MTU|PreUp|PostUp|PreDown|PostDown)' "
-        f"{shlex.quote(wg_config)} | wg setconf {shlex.quote(wg_name)} /dev/stdin"
-    )
-    if run_cmd(filter_cmd, capture_output=False).returncode != 0:
+    if not wg_setconf(wg_name, wg_setconf_text):
         print(f"{RED}Failed to configure WireGuard interface. Please check your config file.{NC}")
-        run_cmd(f"ip link delete {shlex.quote(wg_name)} 2>/dev/null || true",
-                capture_output=False)
-        run_cmd(f"ip link delete {shlex.quote(veth_host)} 2>/dev/null || true",
-                capture_output=False)
-        run_cmd(f"ip netns delete {shlex.quote(ns_name)} 2>/dev/null || true",
-                capture_output=False)
+        run_ip_batch(cleanup_batch, discard=True)
         return
 
-    run_cmd(
-        f"ip link set {shlex.quote(wg_name)} netns {shlex.quote(ns_name)}",
-        capture_output=False,
-    )
-    run_cmd(
-        f"ip addr add {wg_address} dev {shlex.quote(wg_name)}",
-        ns=ns_name,
-        capture_output=False,
-    )
-    run_cmd(f"ip link set {shlex.quote(wg_name)} up", ns=ns_name, capture_output=False)
-
-    # routing
-    run_cmd("ip route flush table main 2>/dev/null || true", ns=ns_name, capture_output=False)
-    run_cmd("ip route flush table 100 2>/dev/null || true", ns=ns_name, capture_output=False)
-    run_cmd(
-        f"ip route add 10.100.{subnet_octet}.0/24 dev {shlex.quote(veth_ns)} proto kernel scope link src {ns_ip}",
-        ns=ns_name,
-        capture_output=False,
-    )
-    run_cmd(
-        f"ip route add {endpoint_ip}/32 via {host_ip}",
-        ns=ns_name,
-        capture_output=False,
-    )
-    run_cmd(f"ip route add default dev {shlex.quote(wg_name)}", ns=ns_name, capture_output=False)
-    run_cmd(
-        f"ip route add default via {host_ip} dev {shlex.quote(veth_ns)} table 100",
-        ns=ns_name,
-        capture_output=False,
-    )
-    run_cmd(
-        f"ip rule add fwmark 1 lookup 100",
-        ns=ns_name,
-        capture_output=False,
-    )
-    run_cmd(
-        f"iptables -t mangle -A OUTPUT -m conntrack --ctstate ESTABLISHED,RELATED -s {ns_ip} -j MARK --set-mark 1",
-        ns=ns_name,
-        capture_output=False,
-    )
+    run_ip_batch([f"link set {shlex.quote(wg_name)} netns {shlex.quote(ns_name)}"])
 
-    # NAT & firewall
-    run_cmd("sysctl -w net.ipv4.ip_forward=1 >/dev/null", capture_output=False)
-    run_cmd(
-        f"iptables -t nat -A POSTROUTING -o {shlex.quote(wg_name)} -j MASQUERADE",
+    # addresses and routing inside the namespace
+    ns_res = run_ip_batch(
+        tunnel_ns_batch(ns_ip, subnet, veth_ns, host_ip, wg_name, wg_address, endpoint_ip),
         ns=ns_name,
-        capture_output=False,
-    )
-    run_cmd(
-        f"iptables -t nat -D POSTROUTING -s {subnet} ! -o {veth_host} -j MASQUERADE 2>/dev/null || true",
-        capture_output=False,
     )
-    run_cmd(
-        f"iptables -t nat -A POSTROUTING -s {subnet} ! -o {veth_host} -j MASQUERADE",
-        capture_output=False,
-    )
-
-    # DNAT + FORWARD
-    for proto in ("tcp", "udp"):
-        run_cmd(
-            f"iptables -t nat -D PREROUTING -p {proto} --dport {port} -j DNAT --to-destination {ns_ip}:{port} 2>/dev/null || true",
-            capture_output=False,
-        )
-        run_cmd(
-            f"iptables -t nat -A PREROUTING -p {proto} --dport {port} -j DNAT --to-destination {ns_ip}:{port}",
-            capture_output=False,
-        )
-        run_cmd(
-            f"iptables -D FORWARD -p {proto} -d {ns_ip}/32 --dport {port} -j ACCEPT 2>/dev/null || true",
-            capture_output=False,
-        )
-        run_cmd(
-            f"iptables -I FORWARD 1 -p {proto} -d {ns_ip}/32 --dport {port} -j ACCEPT",
-            capture_output=False,
-        )
-        run_cmd(
-            f"iptables -D FORWARD -p {proto} -s {ns_ip}/32 -j ACCEPT 2>/dev/null || true",
-            capture_output=False,
-        )
-        run_cmd(
-            f"iptables -I FORWARD 1 -p {proto} -s {ns_ip}/32 -j ACCEPT",
-            capture_output=False,
-        )
+    if ns_res.returncode != 0:
+        print(f"{YELLOW}Warning: some namespace ip commands failed: {ns_res.stderr.strip()}{NC}")
+    ns_ipt = run_iptables_restore(ns_tunnel_rules(ns_ip, wg_name), ns=ns_name)
+    if ns_ipt.returncode != 0:
+        print(f"{YELLOW}Warning: namespace iptables rules failed: {ns_ipt.stderr.strip()}{NC}")
+
+    # NAT & firewall, DNAT + FORWARD in one iptables-restore transaction
+    run_argv(["sysctl", "-w", "net.ipv4.ip_forward=1"], discard=True)
+    host_ipt = apply_host_tunnel_rules(port, ns_ip, subnet, veth_host)
+    if host_ipt.returncode != 0:
+        print(f"{YELLOW}Warning: host iptables rules failed: {host_ipt.stderr.strip()}{NC}")
 
     # DNS for namespace
-    etc_ns = f"/etc/netns/{ns_name}"
-    os.makedirs(etc_ns, exist_ok=True)
-    with open(os.path.join(etc_ns, "resolv.conf"), "w", encoding="utf-8") as f:
-        f.write("nameserver 1.1.1.1\n")
+    write_netns_resolv_conf(ns_name)
 
     print(f"{GREEN}Setup complete!{NC}")
     
@@ -2411,35 +3847,36 @@ def create_setup() -> None:
 
     # Auto-start Xray
     print(f"{BLUE}Automatically starting Xray inbound...{NC}")
-    if not ensure_xray_binary():
-        print(f"{RED}Failed to ensure Xray binary. Skipping Xray auto-start.{NC}")
+    config = load_config()
+    xray_start = None
+    db_path = PANEL_DB_PATH or config.get("panel_db_path")
+    if db_path and os.path.isfile(db_path):
+        # Nothing to ask the user: start Xray while the watcher is checked and
+        # the final prompt is shown. The binary check may download and print,
+        # so it runs here first rather than over the prompt
+        if not ensure_xray_binary():
+            print(f"{RED}Failed to ensure Xray binary. Skipping Xray auto-start.{NC}")
+            input("Press Enter to continue...")
+            return
+        xray_start = threading.Thread(target=start_setup_xray, args=(port, ns_name), daemon=True)
+        xray_start.start()
+    elif not start_setup_xray(port, ns_name, interactive=True):
         input("Press Enter to continue...")
         return
 
-    # kill existing Xray on port
-    res_pids = run_cmd(
-        f"ss -ltnp 2>/dev/null | grep ':{port} ' | sed -n 's/.*pid=\\([0-9]*\\).*/\\1/p'",
-        ns=ns_name,
-    )
-    pids = res_pids.stdout.split()
-    if pids:
-        run_cmd(f"kill {' '.join(pids)} 2>/dev/null || true", ns=ns_name, capture_output=False)
-        time.sleep(1)
-
-    # --- configure Xray using current DB and start it for this one namespace ---
-    refresh_uuids_for_all_namespaces(interactive=True)
-    
     # Ensure UUID watcher is running in background after setup
-    config = load_config()
     if config.get("panel_type") and config.get("panel_db_path"):
         print(f"\n{BLUE}Ensuring UUID auto-refresh watcher is running...{NC}")
         if start_background_uuid_watcher():
             interval = config.get("uuid_refresh_interval", 5)
-            print(f"{GREEN}✓ UUID Auto-Refresh Watcher is active (every {interval} seconds){NC}")
+            print(f"{GREEN}✓ UUID Auto-Refresh Watcher is active (on panel DB changes, at most every {interval} seconds){NC}")
         else:
             print(f"{YELLOW}⚠ UUID watcher not started, but setup is complete{NC}")
 
     input("Press Enter to continue...")
+    if xray_start is not None and xray_start.is_alive():
+        print(f"{BLUE}Waiting for Xray to start...{NC}")
+        xray_start.join()
 
 
 def manage_xray(target_port: Optional[int] = None, action: Optional[str] = None) -> None:
@@ -2457,7 +3894,7 @@ def manage_xray(target_port: Optional[int] = None, action: Optional[str] = None)
 
     ns_name = f"ns-{target_port}"
     # fallback to nsxray for 9349 like bash version
-    ns_list = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'").stdout.split()
+    ns_list = _get_existing_netns()
     if ns_name not in ns_list:
         if target_port == 9349 and "nsxray" in ns_list:
             ns_name = "nsxray"
@@ -2487,29 +3924,19 @@ def manage_xray(target_port: Optional[int] = None, action: Optional[str] = None)
             return
 
         # kill existing on port
-        res_pids = run_cmd(
-            f"ss -ltnp 2>/dev/null | grep ':{target_port} ' | sed -n 's/.*pid=\\([0-9]*\\).*/\\1/p'",
-            ns=ns_name,
-        )
-        pids = res_pids.stdout.split()
+        pids = get_listening_pids(target_port, ns_name)
         if pids:
             print(f"{YELLOW}Stopping existing Xray processes...{NC}")
-            run_cmd(f"kill {' '.join(pids)} 2>/dev/null || true", ns=ns_name,
-                    capture_output=False)
-            time.sleep(1)
+            stop_pids(pids)
 
         # Re-sync all namespaces from the DB (single source of truth)
         refresh_uuids_for_all_namespaces(interactive=True)
 
     elif action == "stop":
         print(f"{BLUE}Stopping Xray...{NC}")
-        res_pids = run_cmd(
-            f"ss -ltnp 2>/dev/null | grep ':{target_port} ' | sed -n 's/.*pid=\\([0-9]*\\).*/\\1/p'",
-            ns=ns_name,
-        )
-        pids = res_pids.stdout.split()
+        pids = get_listening_pids(target_port, ns_name)
         if pids:
-            run_cmd(f"kill {' '.join(pids)}", ns=ns_name, capture_output=False)
+            stop_pids(pids)
             print(f"{GREEN}Stopped.{NC}")
         else:
             print(f"{YELLOW}Not running.{NC}")
@@ -2519,9 +3946,7 @@ def manage_xray(target_port: Optional[int] = None, action: Optional[str] = None)
             f"{BLUE}Last 20 lines of log (/tmp/xray-{target_port}.log):{NC}"
         )
         try:
-            with open(f"/tmp/xray-{target_port}.log", "r", encoding="utf-8") as f:
-                lines = f.readlines()[-20:]
-            for line in lines:
+            for line in tail_lines(f"/tmp/xray-{target_port}.log", 20):
                 print(line.rstrip())
         except FileNotFoundError:
             print(f"{YELLOW}Log file not found.{NC}")
@@ -2535,7 +3960,15 @@ def manage_xray(target_port: Optional[int] = None, action: Optional[str] = None)
 def manage_xray_all() -> None:
     """Start/Restart Xray for all managed namespaces in one go, using current DB."""
     print(f"{BLUE}Starting/Restarting Xray for all namespaces...{NC}")
-    refresh_uuids_for_all_namespaces(interactive=True)
+    # Restart even if the UUID list is unchanged: that is what was asked for
+    refresh_uuids_for_all_namespaces(interactive=True, force_restart=True)
+
+
+# Handshake wait in restart_wireguard: netlink polls are cheap, `wg show`
+# fallback polls are not
+WG_HANDSHAKE_TIMEOUT = 20.0
+WG_HANDSHAKE_POLL_INTERVAL = 0.2
+WG_HANDSHAKE_FALLBACK_INTERVAL = 2.0
 
 
 def restart_wireguard() -> None:
@@ -2547,7 +3980,7 @@ def restart_wireguard() -> None:
         return
 
     ns_name = f"ns-{port}"
-    ns_list = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'").stdout.split()
+    ns_list = _get_existing_netns()
     if ns_name not in ns_list:
         if port == 9349 and "nsxray" in ns_list:
             ns_name = "nsxray"
@@ -2557,103 +3990,90 @@ def restart_wireguard() -> None:
             return
 
     print(f"{BLUE}Restarting WireGuard in {ns_name}...{NC}")
-    wg_show = run_cmd("wg show 2>/dev/null", ns=ns_name)
-    first_line = wg_show.stdout.splitlines()[0] if wg_show.stdout.splitlines() else ""
-    wg_iface = first_line.split()[1].rstrip(":") if len(first_line.split()) > 1 else ""
+    # `wg show interfaces` prints just the interface names
+    wg_show = run_argv(["wg", "show", "interfaces"], ns=ns_name)
+    wg_ifaces = wg_show.stdout.split()
+    wg_iface = wg_ifaces[0] if wg_ifaces else ""
     if not wg_iface:
         print(f"{RED}WireGuard interface not found in namespace.{NC}")
         input("Press Enter to continue...")
         return
 
-    # Calculate subnet octet: use port % 250 + 2 to avoid conflicts
-    # (port 250 and 500 would both map to 1, so we use +2)
-    subnet_octet = (port % 250) + 2
-    ns_ip = f"10.100.{subnet_octet}.2"
-    host_ip = f"10.100.{subnet_octet}.1"
+    topo = tunnel_topology(port)
+    ns_ip, host_ip = topo.ns_ip, topo.host_ip
 
-    wg_conf_tmp = f"/tmp/wg-restart-{port}.conf"
-    run_cmd(f"wg showconf {shlex.quote(wg_iface)} > {shlex.quote(wg_conf_tmp)} 2>/dev/null",
-            ns=ns_name, capture_output=False)
-
-    endpoint_host = ""
-    endpoint_ip = ""
-    if os.path.isfile(wg_conf_tmp):
-        with open(wg_conf_tmp, "r", encoding="utf-8") as f:
-            for line in f:
-                if line.strip().lower().startswith("endpoint"):
-                    endpoint_field = line.split("=", 1)[1].strip()
-                    endpoint_host = endpoint_field.split(":", 1)[0]
-                    break
-    if endpoint_host:
-        for cmd in (
-            f"getent ahosts {shlex.quote(endpoint_host)} 2>/dev/null | awk '{{print $1}}' | head -1",
-            f"host {shlex.quote(endpoint_host)} 2>/dev/null | grep 'has address' | head -1 | awk '{{print $4}}'",
-            f"dig +short {shlex.quote(endpoint_host)} 2>/dev/null | grep -E '^[0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+$' | head -1",
-        ):
-            res = run_cmd(cmd)
-            ip = res.stdout.strip()
-            if ip:
-                endpoint_ip = ip
-                break
+    # The running config already carries the endpoint as IP:port, so this
+    # resolves without DNS (getaddrinfo accepts the literal)
+    showconf = run_argv(["wg", "showconf", wg_iface], ns=ns_name)
+    _, wg_endpoint, _ = parse_wg_config_text(showconf.stdout or "")
+    endpoint_host, endpoint_ip = resolve_endpoint_ip(wg_endpoint)
 
     print(f"{YELLOW}Bringing WireGuard interface DOWN...{NC}")
-    run_cmd(f"ip link set {shlex.quote(wg_iface)} down 2>/dev/null", ns=ns_name,
-            capture_output=False)
-    time.sleep(2)
+    run_argv(["ip", "link", "set", wg_iface, "down"], ns=ns_name, discard=True)
+    wait_for_link_state(ns_name, wg_iface, up=False)
 
     print(f"{YELLOW}Bringing WireGuard interface UP...{NC}")
-    run_cmd(f"ip link set {shlex.quote(wg_iface)} up 2>/dev/null", ns=ns_name,
-            capture_output=False)
-    time.sleep(2)
+    run_argv(["ip", "link", "set", wg_iface, "up"], ns=ns_name, discard=True)
+    wait_for_link_state(ns_name, wg_iface, up=True)
 
     print(f"{YELLOW}Refreshing routes...{NC}")
-    vpeer = f"vpeer-{port}"
-    run_cmd(
-        f"ip route replace 10.100.{subnet_octet}.0/24 dev {shlex.quote(vpeer)} "
+    vpeer = shlex.quote(topo.veth_ns)
+    route_batch = [
+        f"route replace {topo.subnet} dev {vpeer} "
         f"proto kernel scope link src {ns_ip}",
-        ns=ns_name,
-        capture_output=False,
-    )
+    ]
     if endpoint_ip:
-        run_cmd(
-            f"ip route replace {endpoint_ip}/32 via {host_ip} dev {shlex.quote(vpeer)}",
-            ns=ns_name,
-            capture_output=False,
-        )
-    run_cmd(
-        f"ip route replace default dev {shlex.quote(wg_iface)}",
-        ns=ns_name,
-        capture_output=False,
-    )
+        route_batch.append(f"route replace {endpoint_ip}/32 via {host_ip} dev {vpeer}")
+    route_batch.append(f"route replace default dev {shlex.quote(wg_iface)}")
+    route_res = run_ip_batch(route_batch, ns=ns_name)
+    if route_res.returncode != 0:
+        print(f"{YELLOW}Warning: some route updates failed: {route_res.stderr.strip()}{NC}")
 
     print(f"{YELLOW}Waiting for WireGuard handshake...{NC}")
     handshake_detected = False
-    for _ in range(10):
-        time.sleep(2)
-        wg_status = run_cmd(f"wg show {shlex.quote(wg_iface)} 2>/dev/null", ns=ns_name)
-        if "latest handshake" in wg_status.stdout:
-            handshake_detected = True
+    # Kept from the successful poll so the result is printed without
+    # asking wg again
+    handshake_line = ""
+    deadline = time.monotonic() + WG_HANDSHAKE_TIMEOUT
+    next_dot = time.monotonic() + WG_HANDSHAKE_FALLBACK_INTERVAL
+    while time.monotonic() < deadline:
+        handshakes = get_wg_last_handshakes(ns_name, wg_iface)
+        if handshakes is None:
+            # No WireGuard netlink: poll `wg show` at the old, slower pace
+            wg_status = run_argv(["wg", "show", wg_iface], ns=ns_name)
+            handshake_line = next(
+                (line.strip() for line in wg_status.stdout.splitlines()
+                 if "latest handshake" in line),
+                "",
+            )
+            handshake_detected = bool(handshake_line)
+            interval = WG_HANDSHAKE_FALLBACK_INTERVAL
+        else:
+            latest = max(handshakes, default=0)
+            handshake_detected = latest > 0
+            if handshake_detected:
+                age = max(0, int(time.time()) - latest)
+                handshake_line = f"latest handshake: {age} seconds ago"
+            interval = WG_HANDSHAKE_POLL_INTERVAL
+        if handshake_detected:
             break
-        print(".", end="", flush=True)
+        if time.monotonic() >= next_dot:
+            print(".", end="", flush=True)
+            next_dot += WG_HANDSHAKE_FALLBACK_INTERVAL
+        time.sleep(interval)
     print()
 
     if handshake_detected:
         print(f"{GREEN}WireGuard restarted successfully!{NC}")
-        wg_status = run_cmd(f"wg show {shlex.quote(wg_iface)} 2>/dev/null", ns=ns_name)
-        for line in wg_status.stdout.splitlines():
-            if "latest handshake" in line:
-                print(f"{BLUE}{line.strip()}{NC}")
-                break
+        print(f"{BLUE}{handshake_line}{NC}")
         print(f"{YELLOW}Current routing table in namespace:{NC}")
-        routes = run_cmd("ip route show", ns=ns_name)
+        routes = run_argv(["ip", "route", "show"], ns=ns_name)
         print(routes.stdout)
     else:
         print(
             f"{YELLOW}WireGuard restarted but no handshake detected yet. It may take a few moments.{NC}"
         )
 
-    if os.path.isfile(wg_conf_tmp):
-        os.remove(wg_conf_tmp)
     input("Press Enter to continue...")
 
 
@@ -2676,7 +4096,7 @@ def delete_setup(port: Optional[int] = None, skip_confirm: bool = False) -> None
         print(f"{YELLOW}Deleting tunnel on port {port}...{NC}")
 
     ns_name = f"ns-{port}"
-    ns_list = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'").stdout.split()
+    ns_list = _get_existing_netns()
     namespace_exists = False
     if ns_name in ns_list:
         namespace_exists = True
@@ -2695,54 +4115,21 @@ def delete_setup(port: Optional[int] = None, skip_confirm: bool = False) -> None
         ns_ip = "10.200.200.2"
         subnet = "10.200.200.0/24"
     else:
-        # Calculate subnet octet: use port % 250 + 2 to avoid conflicts
-        # (port 250 and 500 would both map to 1, so we use +2)
-        subnet_octet = (port % 250) + 2
-        veth_host = f"veth-{port}"
-        ns_ip = f"10.100.{subnet_octet}.2"
-        subnet = f"10.100.{subnet_octet}.0/24"
+        topo = tunnel_topology(port)
+        veth_host, ns_ip, subnet = topo.veth_host, topo.ns_ip, topo.subnet
 
+    link_batch = [f"link delete {shlex.quote(veth_host)}"]
     if namespace_exists:
-        run_cmd(f"ip netns delete {shlex.quote(ns_name)} 2>/dev/null || true",
-                capture_output=False)
-    run_cmd(f"ip link delete {shlex.quote(veth_host)} 2>/dev/null || true",
-            capture_output=False)
+        link_batch.insert(0, f"netns delete {shlex.quote(ns_name)}")
+    run_ip_batch(link_batch, discard=True)
 
-    # iptables cleanup
-    for proto in ("tcp", "udp"):
-        run_cmd(
-            f"iptables -t nat -D PREROUTING -p {proto} --dport {port} -j DNAT --to-destination {ns_ip}:{port} 2>/dev/null || true",
-            capture_output=False,
-        )
-    run_cmd(
-        f"iptables -t nat -D POSTROUTING -s {subnet} ! -o {veth_host} -j MASQUERADE 2>/dev/null || true",
-        capture_output=False,
+    # iptables cleanup: tunnel NAT/FORWARD rules and any LOG rules left by
+    # real-time logging, all in one iptables-save + iptables-restore
+    iptables_delete_rules(
+        host_tunnel_rules(port, ns_ip, subnet, veth_host) + tunnel_log_rules(port, ns_ip)
     )
-    for proto in ("tcp", "udp"):
-        run_cmd(
-            f"iptables -D FORWARD -p {proto} -d {ns_ip}/32 --dport {port} -j ACCEPT 2>/dev/null || true",
-            capture_output=False,
-        )
-        run_cmd(
-            f"iptables -D FORWARD -p {proto} -s {ns_ip}/32 -j ACCEPT 2>/dev/null || true",
-            capture_output=False,
-        )
-
-    # LOG rules cleanup
-    for proto in ("tcp", "udp"):
-        run_cmd(
-            f"iptables -t nat -D PREROUTING -p {proto} --dport {port} -j LOG --log-prefix '[DNAT-{port}] ' --log-level 4 2>/dev/null || true",
-            capture_output=False,
-        )
-    for proto in ("tcp", "udp"):
-        run_cmd(
-            f"iptables -D FORWARD -p {proto} -d {ns_ip}/32 --dport {port} -j LOG --log-prefix '[FWD-{port}] ' --log-level 4 2>/dev/null || true",
-            capture_output=False,
-        )
-        run_cmd(
-            f"iptables -D FORWARD -p {proto} -s {ns_ip}/32 -j LOG --log-prefix '[RET-{port}] ' --log-level 4 2>/dev/null || true",
-            capture_output=False,
-        )
+    if command_exists("ipset"):
+        run_ipset_restore([f"del {entry}" for entry in forward_set_entries(ns_ip, port)])
 
     # Remove saved state
     delete_setup_state(port)
@@ -2752,6 +4139,10 @@ def delete_setup(port: Optional[int] = None, skip_confirm: bool = False) -> None
         input("Press Enter to continue...")
 
 
+# Diagnostic commands debug_setup runs at the same time
+DEBUG_WORKERS = 8
+
+
 def debug_setup() -> None:
     print(f"{BLUE}=== Debug Setup ==={NC}")
     print(f"{YELLOW}Enter Port number to debug:{NC}")
@@ -2761,7 +4152,7 @@ def debug_setup() -> None:
         return
 
     ns_name = f"ns-{port}"
-    ns_list = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'").stdout.split()
+    ns_list = _get_existing_netns()
     namespace_exists = False
     if ns_name in ns_list:
         namespace_exists = True
@@ -2774,96 +4165,59 @@ def debug_setup() -> None:
         )
 
     log_file = f"/tmp/debug-{port}.log"
-    with open(log_file, "w", encoding="utf-8") as f:
-        f.write(f"=== Debug Log for Port {port} ({ns_name}) ===\n")
-        f.write(f"Timestamp: {time.ctime()}\n\n")
-
-    print(f"{BLUE}Collecting debug information...{NC}")
+    veth_host = tunnel_topology(port).veth_host
+    host_filter = f"grep -E '({port}|10.100)'"
 
-    def append_cmd(title: str, cmd: str, ns: Optional[str] = None) -> None:
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(f"=== {title} ===\n")
-        out = run_cmd(cmd, ns=ns)
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(out.stdout)
-            f.write("\n")
-
-    # 1. Namespace info
-    append_cmd("Namespace Info", f"ip netns list | grep '{ns_name}' 2>&1")
-
-    # 2. IP addresses
+    # (title, command, namespace) in the order they appear in the log
+    sections: List[Tuple[str, str, Optional[str]]] = [
+        # 1. Namespace info
+        ("Namespace Info", f"ip netns list | grep '{ns_name}' 2>&1", None),
+    ]
     if namespace_exists:
-        append_cmd("IP Addresses", "ip addr show", ns=ns_name)
-        # 3. Routing
-        append_cmd("Routing Table", "ip route show", ns=ns_name)
-        append_cmd("IP Rules", "ip rule show", ns=ns_name)
-        # 4. WireGuard status
-        append_cmd("WireGuard Status", "wg show 2>&1", ns=ns_name)
-        # 5. Listening ports
-        append_cmd("Listening Ports", "ss -tulnp 2>&1", ns=ns_name)
-
-        # 6. Namespace iptables
-        append_cmd("Namespace iptables", "iptables -t nat -L -n -v 2>&1", ns=ns_name)
-
-        # 7. Connectivity test
-        append_cmd("Route to 8.8.8.8", "ip route get 8.8.8.8 2>&1", ns=ns_name)
-        append_cmd(
-            "Curl Test",
-            "curl -s --max-time 5 http://icanhazip.com 2>&1",
-            ns=ns_name,
-        )
-
-    # 6/8. Host iptables
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write("=== Host iptables NAT PREROUTING ===\n")
-    out = run_cmd(
-        f"iptables -t nat -L PREROUTING -n -v | grep -E '({port}|10.100)' 2>&1"
-    )
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(out.stdout + "\n")
-
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write("=== Host iptables FORWARD ===\n")
-    out = run_cmd(
-        f"iptables -L FORWARD -n -v | grep -E '({port}|10.100)' 2>&1"
-    )
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(out.stdout + "\n")
+        sections += [
+            # 2. IP addresses
+            ("IP Addresses", "ip addr show", ns_name),
+            # 3. Routing
+            ("Routing Table", "ip route show", ns_name),
+            ("IP Rules", "ip rule show", ns_name),
+            # 4. WireGuard status
+            ("WireGuard Status", "wg show 2>&1", ns_name),
+            # 5. Listening ports
+            ("Listening Ports", "ss -tulnp 2>&1", ns_name),
+            # 6. Namespace iptables
+            ("Namespace iptables", "iptables -t nat -L -n -v 2>&1", ns_name),
+            # 7. Connectivity test
+            ("Route to 8.8.8.8", "ip route get 8.8.8.8 2>&1", ns_name),
+            ("Curl Test", "curl -s --max-time 5 http://icanhazip.com 2>&1", ns_name),
+        ]
+    sections += [
+        # 6/8. Host iptables
+        ("Host iptables NAT PREROUTING", f"iptables -t nat -L PREROUTING -n -v | {host_filter} 2>&1", None),
+        ("Host iptables FORWARD", f"iptables -L FORWARD -n -v | {host_filter} 2>&1", None),
+        ("Host iptables NAT POSTROUTING", f"iptables -t nat -L POSTROUTING -n -v | {host_filter} 2>&1", None),
+        # 8. Connection tracking
+        ("Connection Tracking", f"conntrack -L -n 2>&1 | {host_filter} | head -10", None),
+        # 9. Veth interface
+        ("Veth Interface", f"ip addr show {shlex.quote(veth_host)} 2>&1", None),
+    ]
 
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write("=== Host iptables NAT POSTROUTING ===\n")
-    out = run_cmd(
-        f"iptables -t nat -L POSTROUTING -n -v | grep -E '({port}|10.100)' 2>&1"
-    )
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(out.stdout + "\n")
-
-    # 8. Connection tracking
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write("=== Connection Tracking ===\n")
-    out = run_cmd(
-        f"conntrack -L -n 2>&1 | grep -E '({port}|10.100)' | head -10"
-    )
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(out.stdout + "\n")
+    print(f"{BLUE}Collecting debug information...{NC}")
 
-    # 9. Veth interface
-    # Calculate subnet octet: use port % 250 + 2 to avoid conflicts
-    # (port 250 and 500 would both map to 1, so we use +2)
-    subnet_octet = (port % 250) + 2
-    veth_host = f"veth-{port}"
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write("=== Veth Interface ===\n")
-    out = run_cmd(f"ip addr show {shlex.quote(veth_host)} 2>&1")
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(out.stdout + "\n")
+    # The commands are read-only and independent, so run them side by side
+    # (the curl test alone can take 5 seconds) and write the log in one go
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DEBUG_WORKERS) as ex:
+        futures = [ex.submit(run_cmd, cmd, ns=ns) for _, cmd, ns in sections]
+        with open(log_file, "w", encoding="utf-8") as f:
+            f.write(f"=== Debug Log for Port {port} ({ns_name}) ===\n")
+            f.write(f"Timestamp: {time.ctime()}\n\n")
+            for (title, _, _), future in zip(sections, futures):
+                f.write(f"=== {title} ===\n")
+                f.write(future.result().stdout + "\n")
 
     print(f"{GREEN}Debug information saved to: {log_file}{NC}\n")
     print(f"{YELLOW}Last 50 lines of log:{NC}")
     try:
-        with open(log_file, "r", encoding="utf-8") as f:
-            lines = f.readlines()[-50:]
-        for line in lines:
+        for line in tail_lines(log_file, 50):
             print(line.rstrip())
     except FileNotFoundError:
         pass
@@ -2876,11 +4230,77 @@ def debug_setup() -> None:
     input("Press Enter to continue...")
 
 
+KERN_LOG_PATH = "/var/log/kern.log"
+KERN_LOG_POLL_INTERVAL = 0.2
+
+
+def _follow_log_file(path: str, pattern) -> None:
+    """`tail -F path | grep pattern`: print new matching lines forever.
+
+    The file is reopened when it is rotated (its inode changes).
+    """
+    f = open(path, "rb")
+    try:
+        f.seek(0, os.SEEK_END)
+        ino = os.fstat(f.fileno()).st_ino
+        partial = b""
+        while True:
+            chunk = f.readline()
+            if chunk:
+                partial += chunk
+                if partial.endswith(b"\n"):
+                    if pattern.search(partial):
+                        print(partial.decode("utf-8", "replace").rstrip(), flush=True)
+                    partial = b""
+                continue
+            time.sleep(KERN_LOG_POLL_INTERVAL)
+            try:
+                if os.stat(path).st_ino != ino:
+                    f.close()
+                    f = open(path, "rb")
+                    ino = os.fstat(f.fileno()).st_ino
+                    partial = b""
+            except OSError:
+                pass
+    finally:
+        f.close()
+
+
+def _follow_kmsg(pattern) -> None:
+    """Print new kernel ring buffer messages matching `pattern` forever.
+
+    Each read() of /dev/kmsg returns one record, "prefix;message\n...".
+    """
+    fd = os.open("/dev/kmsg", os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        os.lseek(fd, 0, os.SEEK_END)
+        while True:
+            try:
+                record = os.read(fd, 8192)
+            except BrokenPipeError:
+                # Records were overwritten before we read them; carry on
+                continue
+            message = record.split(b";", 1)[-1].split(b"\n", 1)[0]
+            if pattern.search(message):
+                print(message.decode("utf-8", "replace"), flush=True)
+    finally:
+        os.close(fd)
+
+
+def follow_kernel_log(pattern) -> None:
+    """Print kernel log lines matching the bytes regex `pattern` until Ctrl+C.
+
+    Follows /var/log/kern.log in-process when syslog writes one, otherwise
+    reads /dev/kmsg directly, instead of a `tail -f | grep` pipeline.
+    """
+    if os.path.isfile(KERN_LOG_PATH):
+        _follow_log_file(KERN_LOG_PATH, pattern)
+    else:
+        _follow_kmsg(pattern)
+
+
 def enable_realtime_logging(port: int, ns_name: str) -> None:
-    # Calculate subnet octet: use port % 250 + 2 to avoid conflicts
-    # (port 250 and 500 would both map to 1, so we use +2)
-    subnet_octet = (port % 250) + 2
-    ns_ip = f"10.100.{subnet_octet}.2"
+    ns_ip = tunnel_topology(port).ns_ip
 
     print(
         f"{BLUE}Enabling real-time packet logging for port {port}...{NC}\n"
@@ -2888,54 +4308,40 @@ def enable_realtime_logging(port: int, ns_name: str) -> None:
     )
 
     # Add LOG rules
-    for proto in ("tcp", "udp"):
-        run_cmd(
-            f"iptables -t nat -I PREROUTING 1 -p {proto} --dport {port} "
-            f"-j LOG --log-prefix '[DNAT-{port}] ' --log-level 4",
-            capture_output=False,
-        )
-        run_cmd(
-            f"iptables -I FORWARD 1 -p {proto} -d {ns_ip}/32 --dport {port} "
-            f"-j LOG --log-prefix '[FWD-{port}] ' --log-level 4",
-            capture_output=False,
-        )
-        run_cmd(
-            f"iptables -I FORWARD 1 -p {proto} -s {ns_ip}/32 "
-            f"-j LOG --log-prefix '[RET-{port}] ' --log-level 4",
-            capture_output=False,
-        )
+    log_rules = tunnel_log_rules(port, ns_ip)
+    res = run_iptables_restore(log_rules)
+    if res.returncode != 0:
+        print(f"{YELLOW}Warning: could not add LOG rules: {res.stderr.strip()}{NC}")
 
     # monitor kernel log
-    # try /var/log/kern.log, else fall back to dmesg -w
+    # try /var/log/kern.log, else fall back to the kernel ring buffer
     print()
     try:
-        cmd = (
-            f"tail -f /var/log/kern.log 2>/dev/null | grep -E '\\[(DNAT|FWD|RET)-{port}\\]'"
-        )
-        proc = subprocess.Popen(
-            cmd, shell=True, text=True
-        )
-        proc.wait()
+        follow_kernel_log(re.compile(rf"\[(DNAT|FWD|RET)-{port}\]".encode("ascii")))
     except KeyboardInterrupt:
         pass
     finally:
         # cleanup logging rules
-        for proto in ("tcp", "udp"):
-            run_cmd(
-                f"iptables -t nat -D PREROUTING -p {proto} --dport {port} "
-                f"-j LOG --log-prefix '[DNAT-{port}] ' --log-level 4 2>/dev/null || true",
-                capture_output=False,
-            )
-            run_cmd(
-                f"iptables -D FORWARD -p {proto} -d {ns_ip}/32 --dport {port} "
-                f"-j LOG --log-prefix '[FWD-{port}] ' --log-level 4 2>/dev/null || true",
-                capture_output=False,
-            )
-            run_cmd(
-                f"iptables -D FORWARD -p {proto} -s {ns_ip}/32 "
-                f"-j LOG --log-prefix '[RET-{port}] ' --log-level 4 2>/dev/null || true",
-                capture_output=False,
-            )
+        iptables_delete_rules(log_rules)
+
+
+WG_CONFIG_MARKER_REGEX = re.compile(rb"\[Interface\]|PrivateKey")
+
+
+def is_wg_config_file(path: str) -> bool:
+    """True if `path` looks like a WireGuard config ([Interface] or PrivateKey).
+
+    The file is searched through mmap, so it is neither read into memory
+    nor decoded just to look for the two markers.
+    """
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return WG_CONFIG_MARKER_REGEX.search(data) is not None
+    except (OSError, ValueError):
+        return False
 
 
 def restore_from_config_file() -> None:
@@ -2944,22 +4350,14 @@ def restore_from_config_file() -> None:
     
     # Find all .conf files in /root
     config_files = []
-    if os.path.isdir("/root"):
-        try:
-            for filename in os.listdir("/root"):
-                if filename.endswith(".conf"):
-                    config_path = os.path.join("/root", filename)
-                    if os.path.isfile(config_path):
-                        # Try to verify it's a WireGuard config
-                        try:
-                            with open(config_path, 'r', encoding='utf-8') as f:
-                                content = f.read()
-                                if '[Interface]' in content or 'PrivateKey' in content:
-                                    config_files.append(config_path)
-                        except (OSError, UnicodeDecodeError):
-                            continue
-        except OSError:
-            pass
+    try:
+        # DirEntry.is_file() uses the type from readdir, no stat per file
+        with os.scandir("/root") as entries:
+            for entry in entries:
+                if entry.name.endswith(".conf") and entry.is_file() and is_wg_config_file(entry.path):
+                    config_files.append(entry.path)
+    except OSError:
+        pass
     
     if not config_files:
         print(f"{RED}No WireGuard config files found in /root{NC}")
@@ -2990,7 +4388,7 @@ def restore_from_config_file() -> None:
     
     # Check if namespace already exists
     ns_name = f"ns-{port}"
-    ns_list = run_cmd("ip netns list 2>/dev/null | awk '{print $1}'").stdout.split()
+    ns_list = _get_existing_netns()
     if ns_name in ns_list:
         print(f"{YELLOW}⚠ Tunnel on port {port} already exists.{NC}")
         ans = input(f"{YELLOW}Do you want to recreate it? (y/n): {NC}").strip().lower()
@@ -3027,21 +4425,7 @@ def setup_auto_restore_service() -> None:
     if ans != "y":
         return
     
-    service_content = f"""[Unit]
-Description=WireGuard Namespace Manager - Restore Tunnels After Reboot
-After=network.target
-Wants=network.target
-
-[Service]
-Type=oneshot
-ExecStart=/usr/bin/python3 {script_path} --restore
-RemainAfterExit=yes
-StandardOutput=journal
-StandardError=journal
-
-[Install]
-WantedBy=multi-user.target
-"""
+    service_content = restore_service_unit(script_path)
     
     try:
         with open(service_file, "w", encoding="utf-8") as f:
@@ -3049,11 +4433,11 @@ WantedBy=multi-user.target
         print(f"{GREEN}✓ Service file created{NC}")
         
         # Reload systemd
-        run_cmd("systemctl daemon-reload", capture_output=False)
+        run_argv(["systemctl", "daemon-reload"], capture_output=False)
         print(f"{GREEN}✓ Systemd daemon reloaded{NC}")
         
         # Enable service
-        run_cmd("systemctl enable setup-wg-restore.service", capture_output=False)
+        run_argv(["systemctl", "enable", "setup-wg-restore.service"], capture_output=False)
         print(f"{GREEN}✓ Service enabled (will run on boot){NC}")
         
         print(f"\n{GREEN}Auto-restore service setup complete!{NC}")
@@ -3085,12 +4469,42 @@ def auto_refresh_main(interval_seconds: Optional[int] = None) -> None:
     
     # Try to load previously selected panel DB (if any)
     load_panel_state()
-    while True:
-        try:
-            refresh_uuids_for_all_namespaces_noninteractive()
-        except Exception as e:
-            debug_log(f"auto_refresh_mode: error during refresh: {e!r}")
-        time.sleep(interval_seconds)
+    db_watch = PanelDbWatch()
+
+    def _on_sigterm(signum, frame) -> None:
+        UUID_WATCHER_STOP.set()
+        db_watch.interrupt()
+
+    # Let systemd stop/restart finish the current refresh and exit cleanly
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    consecutive_errors = 0
+    while not UUID_WATCHER_STOP.is_set():
+        started = time.monotonic()
+        if refresh_uuids_for_all_namespaces_noninteractive():
+            consecutive_errors = 0
+        else:
+            consecutive_errors += 1
+        wait_for_next_refresh(db_watch, interval_seconds, consecutive_errors, started)
+    debug_log("auto_refresh_mode: stopped")
+
+
+def _restore_all_from_menu() -> None:
+    restore_all_setups()
+    input("Press Enter to continue...")
+
+
+# Main menu: option key -> (label, action)
+MAIN_MENU = {
+    "1": ("Create New Setup", create_setup),
+    "2": ("Manage Xray", manage_xray),
+    "3": ("Restart WireGuard", restart_wireguard),
+    "4": ("Delete Setup", delete_setup),
+    "5": ("Debug Setup", debug_setup),
+    "6": ("Restore All Tunnels", _restore_all_from_menu),
+    "7": ("Restore Tunnel from Config File", restore_from_config_file),
+    "8": ("Setup Auto-Restore", setup_auto_restore_service),
+    "9": ("Exit", lambda: sys.exit(0)),
+}
 
 
 def main() -> None:
@@ -3134,8 +4548,8 @@ def main() -> None:
     if config.get("panel_type") and config.get("panel_db_path"):
         interval = config.get("uuid_refresh_interval", 5)
         if start_background_uuid_watcher():
-            print(f"{GREEN}✓ UUID Auto-Refresh Watcher started (every {interval} seconds){NC}")
-            print(f"{BLUE}  UUIDs will be automatically updated from panel every {interval} seconds{NC}")
+            print(f"{GREEN}✓ UUID Auto-Refresh Watcher started{NC}")
+            print(f"{BLUE}  UUIDs will be updated from the panel when its DB changes, at most every {interval} seconds{NC}")
             print(f"{BLUE}  New users will be able to connect automatically{NC}\n")
         else:
             print(f"{YELLOW}⚠ UUID watcher could not be started automatically{NC}")
@@ -3147,87 +4561,146 @@ def main() -> None:
     while True:
         show_header()
         list_setups()
-        print("1. Create New Setup")
-        print("2. Manage Xray")
-        print("3. Restart WireGuard")
-        print("4. Delete Setup")
-        print("5. Debug Setup")
-        print("6. Restore All Tunnels")
-        print("7. Restore Tunnel from Config File")
-        print("8. Setup Auto-Restore")
-        print("9. Exit\n")
-        opt = input("Select option (1-9): ").strip()
-        if opt == "1":
-            create_setup()
-        elif opt == "2":
-            manage_xray()
-        elif opt == "3":
-            restart_wireguard()
-        elif opt == "4":
-            delete_setup()
-        elif opt == "5":
-            debug_setup()
-        elif opt == "6":
-            restore_all_setups()
-            input("Press Enter to continue...")
-        elif opt == "7":
-            restore_from_config_file()
-        elif opt == "8":
-            setup_auto_restore_service()
-        elif opt == "9":
-            sys.exit(0)
+        for key, (label, _) in MAIN_MENU.items():
+            print(f"{key}. {label}")
+        print()
+        entry = MAIN_MENU.get(input(f"Select option (1-{len(MAIN_MENU)}): ").strip())
+        if entry:
+            entry[1]()
         else:
             print("Invalid option")
             time.sleep(1)
 
 
-if __name__ == "__main__":
-    # If run with specific switch, only auto-refresh without menu is executed
-    if len(sys.argv) > 1 and sys.argv[1] in ("--auto-refresh", "--watch"):
-        auto_refresh_main(interval_seconds=None)  # Will load from config
-    elif len(sys.argv) > 1 and sys.argv[1] == "--restore":
-        # Restore all tunnels (called by systemd service)
-        # This runs silently without any user interaction
-        require_root()
-        
-        # Load config and panel state silently
-        config = load_config()
-        load_panel_state()
-        
-        # Restore tunnels immediately without prompts
-        restore_all_setups()
-        
-        # Start UUID watcher if panel is configured
-        if config.get("panel_type") and config.get("panel_db_path"):
-            if start_background_uuid_watcher():
-                interval = config.get("uuid_refresh_interval", 5)
-                debug_log(f"restore: started UUID watcher with interval {interval}s")
-            else:
-                debug_log("restore: failed to start UUID watcher")
-        
-        # Exit silently (systemd will log output to journal)
-        sys.exit(0)
-    elif len(sys.argv) > 1 and sys.argv[1] == "--start-watcher":
-        # Start watcher using systemd service (preferred) or as background process
-        require_root()
-        if ensure_uuid_watcher_service():
-            print("UUID Watcher started via systemd service")
-            print("To check status: systemctl status setup-wg-uuid-watcher")
-            print("To stop: systemctl stop setup-wg-uuid-watcher")
-            print("Logs: tail -f /tmp/setup-wg-watch.log")
+def restore_main() -> None:
+    """`--restore`: restore all tunnels (called by the systemd service).
+
+    Runs silently without any user interaction.
+    """
+    require_root()
+    
+    # Load config silently; restore_all_setups loads the panel state itself,
+    # and only when there are saved or detected tunnels to start Xray for
+    config = load_config()
+    
+    # Restore tunnels immediately without prompts
+    restore_all_setups()
+    # Units ordered after us may start now; the watcher is not a dependency
+    sd_notify("READY=1\nSTATUS=Tunnels restored")
+    
+    # Start UUID watcher if panel is configured
+    if config.get("panel_type") and config.get("panel_db_path"):
+        if start_background_uuid_watcher():
+            interval = config.get("uuid_refresh_interval", 5)
+            debug_log(f"restore: started UUID watcher with interval {interval}s")
         else:
-            # Fallback: start as background process
-            script_path = os.path.abspath(__file__)
-            subprocess.Popen(
-                [sys.executable, script_path, "--auto-refresh"],
-                stdout=open("/tmp/watcher.log", "w"),
-                stderr=subprocess.STDOUT,
-                start_new_session=True
+            debug_log("restore: failed to start UUID watcher")
+    
+    # Exit silently (systemd will log output to journal)
+    sys.exit(0)
+
+
+WATCHER_FALLBACK_LOG = "/tmp/watcher.log"
+WATCHER_JOURNAL_ID = "wgnm-watcher"
+JOURNAL_STDOUT_SOCKET = "/run/systemd/journal/stdout"
+
+
+def journal_stream(identifier: str) -> Optional[socket.socket]:
+    """Open a journald stdout stream tagged `identifier`, like systemd-cat.
+
+    Whatever is written to the socket becomes journal entries, one per
+    line, rate-limited and rotated by journald. None without journald.
+    """
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+    except OSError:
+        return None
+    try:
+        sock.connect(JOURNAL_STDOUT_SOCKET)
+        sock.shutdown(socket.SHUT_RD)
+        # identifier, unit id, priority (info), level prefix, then no
+        # forwarding to syslog / kmsg / console
+        sock.sendall(f"{identifier}\n\n6\n0\n0\n0\n0\n".encode("utf-8"))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def spawn_detached(argv: List[str], log_path: str, journal_id: Optional[str] = None) -> Tuple[int, bool]:
+    """Start `argv` in a new session with stdout/stderr in `log_path`.
+
+    With `journal_id` the output goes to the journal under that identifier
+    instead, if journald is running. Uses posix_spawn (Python 3.8+), which
+    avoids fork()'s copy of this process and opens the log in the child
+    only; older Pythons fall back to Popen. Returns the child's pid and
+    whether its output went to the journal.
+    """
+    stream = journal_stream(journal_id) if journal_id else None
+    try:
+        # posix_spawn exists since 3.7, but its setsid argument only since 3.8
+        if sys.version_info >= (3, 8) and hasattr(os, "posix_spawn"):
+            if stream is not None:
+                output = [(os.POSIX_SPAWN_DUP2, stream.fileno(), 1)]
+            else:
+                output = [(os.POSIX_SPAWN_OPEN, 1, log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)]
+            pid = os.posix_spawn(
+                argv[0],
+                argv,
+                os.environ,
+                file_actions=output + [(os.POSIX_SPAWN_DUP2, 1, 2)],
+                setsid=True,
             )
-            print("UUID Watcher started in background (fallback mode)")
-            print("To stop: pkill -f 'auto_refresh_main'")
-            print("Logs: tail -f /tmp/setup-wg-watch.log")
+        elif stream is not None:
+            pid = subprocess.Popen(
+                argv, stdout=stream.fileno(), stderr=subprocess.STDOUT, start_new_session=True
+            ).pid
+        else:
+            with open(log_path, "w") as log:
+                pid = subprocess.Popen(
+                    argv, stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+                ).pid
+        return pid, stream is not None
+    finally:
+        if stream is not None:
+            # The child holds its own copy
+            stream.close()
+
+
+def start_watcher_main() -> None:
+    """`--start-watcher`: start the watcher via systemd, or as a background process."""
+    require_root()
+    if ensure_uuid_watcher_service():
+        print("UUID Watcher started via systemd service")
+        print("To check status: systemctl status setup-wg-uuid-watcher")
+        print("To stop: systemctl stop setup-wg-uuid-watcher")
+        print("Logs: tail -f /tmp/setup-wg-watch.log")
     else:
-        main()
+        # Fallback: start as background process
+        pid, journaled = spawn_detached(
+            [sys.executable, os.path.abspath(__file__), "--auto-refresh"],
+            WATCHER_FALLBACK_LOG,
+            journal_id=WATCHER_JOURNAL_ID,
+        )
+        print("UUID Watcher started in background (fallback mode)")
+        print(f"To stop: kill {pid}")
+        print("Logs: tail -f /tmp/setup-wg-watch.log")
+        if journaled:
+            print(f"Output: journalctl -t {WATCHER_JOURNAL_ID} -f")
+        else:
+            print(f"Output: {WATCHER_FALLBACK_LOG}")
+
 
+# Command-line switch -> entry point; anything else opens the menu
+CLI_MODES = {
+    "--auto-refresh": lambda: auto_refresh_main(interval_seconds=None),  # Will load from config
+    "--watch": lambda: auto_refresh_main(interval_seconds=None),
+    "--restore": restore_main,
+    "--start-watcher": start_watcher_main,
+}
 
+
+if __name__ == "__main__":
+    # If run with specific switch, only that mode runs without the menu
+    mode = sys.argv[1] if len(sys.argv) > 1 else ""
+    CLI_MODES.get(mode, main)()
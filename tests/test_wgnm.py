@@ -0,0 +1,152 @@
+"""Tests for WGNM helpers that do not need root, namespaces or iptables."""
+
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import WGNM  # noqa: E402
+
+
+def _completed(stdout=""):
+    return subprocess.CompletedProcess([], 0, stdout, "")
+
+
+class IptablesDeleteLogRulesTest(unittest.TestCase):
+    # As printed by iptables-save for the rules from tunnel_log_rules(8080, ...)
+    SAVED = """# Generated by iptables-save v1.8.7 on Mon Jan  1 00:00:00 2024
+*nat
+:PREROUTING ACCEPT [0:0]
+-A PREROUTING -p udp -m udp --dport 8080 -j LOG --log-prefix "[DNAT-8080] "
+-A PREROUTING -p tcp -m tcp --dport 8080 -j LOG --log-prefix "[DNAT-8080] "
+-A PREROUTING -p tcp -m tcp --dport 8080 -j DNAT --to-destination 10.100.82.2:8080
+COMMIT
+*filter
+:FORWARD ACCEPT [0:0]
+-A FORWARD -s 10.100.82.2/32 -p udp -j LOG --log-prefix "[RET-8080] "
+-A FORWARD -d 10.100.82.2/32 -p udp -m udp --dport 8080 -j LOG --log-prefix "[FWD-8080] "
+-A FORWARD -s 10.100.82.2/32 -p tcp -j LOG --log-prefix "[RET-8080] "
+-A FORWARD -d 10.100.82.2/32 -p tcp -m tcp --dport 8080 -j LOG --log-prefix "[FWD-8080] "
+COMMIT
+"""
+
+    def test_delete_matches_saved_log_rules(self):
+        calls = []
+
+        def fake_run(cmd, **kwargs):
+            calls.append((cmd, kwargs.get("input")))
+            return _completed(self.SAVED if cmd == ["iptables-save"] else "")
+
+        with mock.patch.object(WGNM.subprocess, "run", side_effect=fake_run):
+            res = WGNM.iptables_delete_rules(WGNM.tunnel_log_rules(8080, "10.100.82.2"))
+
+        self.assertIsNotNone(res)
+        restore_input = calls[-1][1]
+        deletions = [line for line in restore_input.splitlines() if line.startswith("-D ")]
+        self.assertEqual(len(deletions), 6)
+        self.assertNotIn("DNAT --to-destination", restore_input)
+
+    def test_explicit_default_log_level_matches(self):
+        saved = '-A FORWARD -s 10.1.0.2/32 -p tcp -j LOG --log-prefix "[X] "'
+        wanted = '-I FORWARD 1 -p tcp -s 10.1.0.2/32 -j LOG --log-prefix "[X] " --log-level 4'
+        self.assertEqual(WGNM._iptables_rule_key(saved), WGNM._iptables_rule_key(wanted))
+
+
+class IptablesRuleKeyTest(unittest.TestCase):
+    def key(self, rule):
+        return WGNM._iptables_rule_key(rule)
+
+    def test_implicit_protocol_match_is_ignored(self):
+        self.assertEqual(
+            self.key("-A PREROUTING -p tcp -m tcp --dport 8080 -j ACCEPT"),
+            self.key("-A PREROUTING -p tcp --dport 8080 -j ACCEPT"),
+        )
+
+    def test_bare_address_gets_host_mask(self):
+        self.assertEqual(
+            self.key("-A OUTPUT -s 10.1.0.2/32 -j ACCEPT"),
+            self.key("-A OUTPUT -s 10.1.0.2 -j ACCEPT"),
+        )
+        self.assertEqual(
+            self.key("-A OUTPUT ! -d 10.1.0.2/32 -j ACCEPT"),
+            self.key("-A OUTPUT ! -d 10.1.0.2 -j ACCEPT"),
+        )
+
+    def test_insert_position_is_ignored(self):
+        self.assertEqual(
+            self.key("-A FORWARD -p udp -d 10.1.0.2/32 -j ACCEPT"),
+            self.key("-I FORWARD 3 -p udp -d 10.1.0.2/32 -j ACCEPT"),
+        )
+
+    def test_values_stay_with_their_option(self):
+        self.assertNotEqual(
+            self.key("-A FORWARD -s 10.1.0.2/32 -d 10.1.0.3/32 -j ACCEPT"),
+            self.key("-A FORWARD -s 10.1.0.3/32 -d 10.1.0.2/32 -j ACCEPT"),
+        )
+        self.assertNotEqual(
+            self.key("-A FORWARD -i veth0 -o wg0 -j ACCEPT"),
+            self.key("-A FORWARD -i wg0 -o veth0 -j ACCEPT"),
+        )
+        self.assertNotEqual(
+            self.key("-A POSTROUTING ! -o veth0 -j MASQUERADE"),
+            self.key("-A POSTROUTING -o veth0 -j MASQUERADE"),
+        )
+
+
+class IptablesReplaceRulesTest(unittest.TestCase):
+    RULES = [
+        ("filter", "-I FORWARD 1 -p tcp -d 10.1.0.2/32 --dport 8080 -j ACCEPT"),
+        ("filter", "-I FORWARD 1 -p tcp -s 10.1.0.2/32 -j ACCEPT"),
+    ]
+    OURS = [
+        "-A FORWARD -s 10.1.0.2/32 -p tcp -j ACCEPT",
+        "-A FORWARD -d 10.1.0.2/32 -p tcp -m tcp --dport 8080 -j ACCEPT",
+    ]
+
+    def replace(self, forward):
+        saved = "*filter\n:FORWARD ACCEPT [0:0]\n" + "".join(r + "\n" for r in forward) + "COMMIT\n"
+        calls = []
+
+        def fake_run(cmd, **kwargs):
+            calls.append((cmd, kwargs.get("input")))
+            return _completed(saved if cmd == ["iptables-save"] else "")
+
+        with mock.patch.object(WGNM.subprocess, "run", side_effect=fake_run):
+            WGNM.iptables_replace_rules(self.RULES)
+        return [payload for cmd, payload in calls if cmd[0] == "iptables-restore"]
+
+    def test_rules_at_the_head_are_left_alone(self):
+        self.assertEqual(self.replace(self.OURS + ["-A FORWARD -j DROP"]), [])
+
+    def test_rules_below_a_later_rule_are_moved_back_up(self):
+        restores = self.replace(["-A FORWARD -j DOCKER-USER"] + self.OURS)
+        self.assertEqual(len(restores), 1)
+        lines = restores[0].splitlines()
+        self.assertEqual(sum(line.startswith("-D FORWARD") for line in lines), 2)
+        self.assertEqual([line for line in lines if line.startswith("-I ")], [r for _, r in self.RULES])
+
+    def test_rules_in_the_wrong_order_are_reinserted(self):
+        self.assertEqual(len(self.replace(self.OURS[::-1])), 1)
+
+
+class WgLastHandshakesTest(unittest.TestCase):
+    NLA_F_NESTED = 0x8000
+
+    def _peer(self, handshake):
+        ts = WGNM._netlink_attr(WGNM.WGPEER_A_LAST_HANDSHAKE_TIME, WGNM.KERNEL_TIMESPEC.pack(handshake, 0))
+        # The kernel numbers every entry of the peers array 0
+        return WGNM._netlink_attr(0 | self.NLA_F_NESTED, ts)
+
+    def test_two_peers_in_one_message(self):
+        family = [{WGNM.CTRL_ATTR_FAMILY_ID: b"\x15\x00"}]
+        peers = self._peer(1700000000) + self._peer(1700000500)
+        device = [{WGNM.WGDEVICE_A_PEERS: peers}]
+        with mock.patch.object(WGNM, "_netlink_dump", side_effect=[family, device]):
+            self.assertEqual(WGNM.get_wg_last_handshakes("ns", "wg0"), [1700000000, 1700000500])
+
+
+if __name__ == "__main__":
+    unittest.main()